@@ -1,68 +1,96 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, g, Response
 from flask_cors import CORS
-import sqlite3
-import websockets
-import asyncio
+import term_stats
+import raw_store
+import importance
+import near_dups
+import retention
+import export
+import metrics
+from profiler import PROFILER
+from ingest_writer import ensure_dedup_index, date_to_epoch
+from ws_hub import ChangeHub
+import storage
 import json
+import base64
 import threading
-import time
-import socket
+import os
 import re
-from collections import Counter
+import sys
+import time
 from datetime import datetime
 
 
 app = Flask(__name__, template_folder='templates')
 CORS(app)
 
-DATABASE = "messages.db"
+DATABASE = storage.DATABASE
+
+# Ключ переписки: group::<chat_id> для чатов с названием, иначе private::<uid>
+GROUP_KEY_SQL = """CASE WHEN chat_title IS NOT NULL AND chat_title != ''
+    THEN 'group::' || COALESCE(chat_id, 'None')
+    ELSE 'private::' || COALESCE(NULLIF(from_user_id, 0), NULLIF(chat_id, 0), NULLIF(from_user_name, ''), 'private')
+END"""
 
-def find_free_port():
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind(("", 0))
-        s.listen(1)
-        port = s.getsockname()[1]
-    return port
+# Поля переписки, вычисляемые по сообщению {m} (NEW/OLD в триггерах или алиас таблицы)
+CONVERSATION_CHAT_ID_SQL = "COALESCE(CAST(COALESCE(NULLIF({m}.chat_id, 0), NULLIF({m}.from_user_id, 0)) AS TEXT), '')"
+CONVERSATION_TITLE_SQL = "CASE WHEN {m}.group_key LIKE 'group::%' THEN {m}.chat_title ELSE COALESCE(NULLIF({m}.from_user_name, ''), 'Пользователь ' || substr({m}.group_key, 10)) END"
+# ISO-дата → секунды UTC силами SQLite (смещение пояса учитывается, дата без пояса — UTC)
+DATE_TS_SQL = "CAST(strftime('%s', {value}) AS INTEGER)"
+# date_ts строки, вставленной без него, триггер заполнит позже — до того момент считается по date
+CONVERSATION_TS_SQL = "COALESCE({m}.date_ts, " + DATE_TS_SQL.format(value="{m}.date") + ", 0)"
+# UPDATE, меняющий date_ts при той же date, — это дозаполнение триггером messages_date_ts_*,
+# а не правка сообщения: журнал его не пишет, переписка пересчитывается только после смены date
+DATE_TS_FILL_SQL = "OLD.date IS NEW.date AND OLD.date_ts IS NOT NEW.date_ts"
 
-WEBSOCKET_PORT = find_free_port()
-print(f"WebSocket запущен на порту: {WEBSOCKET_PORT}")
+CHANGE_LOG_KEEP = 100000      # сколько последних изменений хранить для delta-синхронизации
+DELTA_MAX_CHANGES = 5000      # больше изменений — отдаём клиенту полный снимок
+# Колонки для лент: всё, что показывает клиент, без тяжёлых и служебных полей
+LIST_COLUMNS = ("id", "from_user_id", "from_user_name", "chat_id", "chat_title", "text_content", "media_type",
+                "date", "date_ts", "message_id", "source", "importance", "ai_reply", "app_name", "is_global", "group_key")
 
-# === WebSocket сервер (как было) ===
-websocket_connections = set()
+WEBSOCKET_HOST = os.getenv("WEBSOCKET_HOST", "localhost")
+WEBSOCKET_PORT = int(os.getenv("WEBSOCKET_PORT", "8765"))
+LOCAL_ADDRESSES = ("127.0.0.1", "::1")   # откуда доступны отладочные эндпоинты
+DEBUG = os.getenv("FLASK_DEBUG", "1") != "0"
 
-async def handle_websocket(websocket, path):
-    websocket_connections.add(websocket)
+# === WebSocket: рассылка изменений из журнала message_changes (см. ws_hub) ===
+def load_change_event(since):
+    """Для хаба: (текущая версия, delta-событие после since или None)."""
+    conn = get_db_connection()
+    cur = conn.cursor()
     try:
-        await websocket.wait_closed()
+        version = get_change_version(cur)
+        if since is None or version == since:
+            return version, None
+        delta = _load_groups_delta(cur, since, version, None)
     finally:
-        websocket_connections.discard(websocket)
-
-async def run_websocket_server():
-    server = await websockets.serve(handle_websocket, "localhost", WEBSOCKET_PORT)
-    await server.wait_closed()
+        conn.close()
+    if delta is None:
+        return version, {"action": "resync", "version": version}
+    return version, dict(delta, action="delta", since=since)
 
-def start_websocket_server():
-    asyncio.run(run_websocket_server())
+hub = ChangeHub(load_change_event)
 
 def notify_websockets():
-    print("notified")
-    message = json.dumps({"action": "refresh"})
-    for ws in websocket_connections.copy():
-        if not ws.closed:
-            try:
-                asyncio.run(ws.send(message))
-            except Exception:
-                pass
+    # изменения уже в журнале — просим хаб прочитать его, не дожидаясь опроса
+    hub.poke()
 
 # === DB helpers ===
 def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    # соединение из пула storage; conn.close() возвращает его обратно
+    return storage.get_connection(DATABASE)
 
 def init_db():
+    if not os.path.exists(DATABASE):
+        # в docker-compose база переехала из файла ./messages.db в каталог ./data — пустая база может
+        # означать, что старый файл остался на прежнем месте
+        print(f"Создаётся новая база {DATABASE}. Если данные лежат в ./messages.db, остановите контейнеры "
+              f"и перенесите их: mkdir -p data && mv messages.db* data/")
     conn = get_db_connection()
     cursor = conn.cursor()
+    # до первой таблицы: у новой базы сразу auto_vacuum=INCREMENTAL (см. retention)
+    retention.ensure_incremental_vacuum(conn)
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -74,7 +102,6 @@ def init_db():
             media_type TEXT,
             date TEXT,
             message_id INTEGER,
-            raw_message TEXT,
             source TEXT DEFAULT 'telegram',
             importance INTEGER DEFAULT 3,
             ai_reply TEXT,
@@ -82,66 +109,632 @@ def init_db():
             is_global INTEGER DEFAULT 1
         )
     """)
+
+    # Ключ переписки считается самой БД — его видят и триггеры, и индексы
+    ensure_column(cursor, "messages", "group_key", f"TEXT GENERATED ALWAYS AS ({GROUP_KEY_SQL}) VIRTUAL")
+    # Момент сообщения в UTC (секунды): заполняет IngestWriter, по нему идут все сортировки и фильтры по времени.
+    # Строки date с разными поясами (у писем — пояс отправителя) как строки не сравниваются
+    if ensure_column(cursor, "messages", "date_ts", "INTEGER"):
+        migrate_date_ts(cursor)
+    cursor.executescript(f"""
+        CREATE TRIGGER IF NOT EXISTS messages_date_ts_on_insert AFTER INSERT ON messages
+        WHEN NEW.date_ts IS NULL AND NEW.date IS NOT NULL BEGIN
+            UPDATE messages SET date_ts = {DATE_TS_SQL.format(value='NEW.date')} WHERE id = NEW.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_date_ts_on_update AFTER UPDATE OF date ON messages
+        WHEN NEW.date IS NOT OLD.date BEGIN
+            UPDATE messages SET date_ts = {DATE_TS_SQL.format(value='NEW.date')} WHERE id = NEW.id;
+        END;
+    """)
+    migrate_indexes(cursor)
+    ensure_dedup_index(cursor)   # уникальный (source, chat_id, message_id) для INSERT OR IGNORE ингесторов
+
+    # Журнал изменений для delta-синхронизации: версия = номер записи
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS message_changes (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_row_id INTEGER NOT NULL,
+            group_key TEXT,
+            op TEXT NOT NULL
+        )
+    """)
+    # определения триггеров ниже менялись — пересоздаём их при каждом запуске
+    for trigger in ("messages_log_update", "conversations_on_insert", "conversations_on_update"):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cursor.executescript(f"""
+        CREATE TRIGGER IF NOT EXISTS messages_log_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO message_changes (message_row_id, group_key, op) VALUES (NEW.id, NEW.group_key, 'upsert');
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_log_update AFTER UPDATE ON messages
+        WHEN NOT ({DATE_TS_FILL_SQL}) BEGIN
+            INSERT INTO message_changes (message_row_id, group_key, op)
+                SELECT OLD.id, OLD.group_key, 'delete' WHERE OLD.group_key IS NOT NEW.group_key;
+            INSERT INTO message_changes (message_row_id, group_key, op) VALUES (NEW.id, NEW.group_key, 'upsert');
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_log_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO message_changes (message_row_id, group_key, op) VALUES (OLD.id, OLD.group_key, 'delete');
+        END;
+    """)
+    # Сводки по чатам (заполняются воркером суммаризации / tg.py)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            chat_id TEXT PRIMARY KEY,
+            chat_title TEXT,
+            is_group INTEGER,
+            summary TEXT,
+            ai_reply TEXT,
+            priority INTEGER,
+            total_messages INTEGER,
+            total_chars INTEGER,
+            last_updated TEXT
+        )
+    """)
+
+    # Материализованный список переписок: поддерживается триггерами при любой записи в messages
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            group_key TEXT PRIMARY KEY,
+            chat_id TEXT,
+            title TEXT,
+            is_group INTEGER NOT NULL DEFAULT 0,
+            total_messages INTEGER NOT NULL DEFAULT 0,
+            total_chars INTEGER NOT NULL DEFAULT 0,
+            max_importance INTEGER,
+            priority INTEGER NOT NULL DEFAULT 3,
+            last_date TEXT,
+            last_ts INTEGER NOT NULL DEFAULT 0,
+            last_message_id INTEGER
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_order ON conversations(priority DESC, last_ts DESC)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_chat ON conversations(chat_id)")
+
+    add_sql = _conversation_add_sql('NEW')
+    remove_sql = _conversation_remove_sql('OLD')
+    cursor.executescript(f"""
+        CREATE TRIGGER IF NOT EXISTS conversations_on_insert AFTER INSERT ON messages BEGIN
+            {add_sql}
+        END;
+        CREATE TRIGGER IF NOT EXISTS conversations_on_delete AFTER DELETE ON messages BEGIN
+            {remove_sql}
+        END;
+        CREATE TRIGGER IF NOT EXISTS conversations_on_update
+        AFTER UPDATE OF chat_id, chat_title, from_user_id, from_user_name, text_content, importance, date, date_ts ON messages
+        WHEN NOT ({DATE_TS_FILL_SQL} AND OLD.date_ts IS NULL) BEGIN
+            {remove_sql}
+            {add_sql}
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS conversations_on_summary_insert AFTER INSERT ON chat_summaries BEGIN
+            {_conversation_summary_sql('NEW.chat_id')}
+        END;
+        CREATE TRIGGER IF NOT EXISTS conversations_on_summary_update AFTER UPDATE ON chat_summaries BEGIN
+            {_conversation_summary_sql('OLD.chat_id')}
+            {_conversation_summary_sql('NEW.chat_id')}
+        END;
+        CREATE TRIGGER IF NOT EXISTS conversations_on_summary_delete AFTER DELETE ON chat_summaries BEGIN
+            {_conversation_summary_sql('OLD.chat_id')}
+        END;
+    """)
+
+    cursor.execute("SELECT EXISTS(SELECT 1 FROM conversations), EXISTS(SELECT 1 FROM messages)")
+    has_conversations, has_messages = cursor.fetchone()
+    if has_messages and not has_conversations:
+        rebuild_conversations(cursor)
+
+    # Полнотекстовый индекс (FTS5) по тексту, теме/названию чата и отправителю.
+    # unicode61 приводит регистр кириллицы, ё → е сворачиваем сами; префиксные индексы ускоряют поиск «по мере ввода»
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")
+    fts_exists = cursor.fetchone() is not None
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            text_content, chat_title, from_user_name,
+            content='messages', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    """)
+    new_values = ', '.join(_fts_normalize(f'NEW.{c}') for c in FTS_COLUMNS)
+    old_values = ', '.join(_fts_normalize(f'OLD.{c}') for c in FTS_COLUMNS)
+    cursor.executescript(f"""
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, {', '.join(FTS_COLUMNS)}) VALUES (NEW.id, {new_values});
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, {', '.join(FTS_COLUMNS)}) VALUES ('delete', OLD.id, {old_values});
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF {', '.join(FTS_COLUMNS)} ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, {', '.join(FTS_COLUMNS)}) VALUES ('delete', OLD.id, {old_values});
+            INSERT INTO messages_fts (rowid, {', '.join(FTS_COLUMNS)}) VALUES (NEW.id, {new_values});
+        END;
+    """)
+    if not fts_exists:
+        cursor.execute(f"""
+            INSERT INTO messages_fts (rowid, {', '.join(FTS_COLUMNS)})
+            SELECT id, {', '.join(_fts_normalize(c) for c in FTS_COLUMNS)} FROM messages
+        """)
+
+    term_stats.init_schema(cursor)
+
+    # Исходники сообщений — в сжатой боковой таблице, в messages их нет (см. raw_store)
+    raw_store.init_schema(cursor)
+    importance.init_schema(cursor)
+    near_dups.init_schema(cursor)
+
+    # старые записи журнала не нужны: клиент с устаревшим курсором получит полный снимок
+    cursor.execute(
+        "DELETE FROM message_changes WHERE version <= (SELECT MAX(version) FROM message_changes) - ?",
+        (CHANGE_LOG_KEEP,)
+    )
     conn.commit()
     conn.close()
 
-# старт websocket в треде
-def run_websocket_in_thread():
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(run_websocket_server())
+FTS_COLUMNS = ('text_content', 'chat_title', 'from_user_name')
+
+def _fts_normalize(column):
+    return f"replace(replace({column}, 'ё', 'е'), 'Ё', 'Е')"
+
+def _conversation_priority_sql(where):
+    # приоритет сводки (если задан) важнее максимальной важности сообщений
+    return f"""UPDATE conversations SET priority = COALESCE(
+            (SELECT NULLIF(priority, 0) FROM chat_summaries WHERE chat_id = conversations.chat_id), max_importance, 3)
+        WHERE {where};"""
+
+def _conversation_refresh_sql(where):
+    # пересчёт максимума важности и последнего сообщения по индексам (group_key, importance/date_ts)
+    return f"""UPDATE conversations SET
+            max_importance = (SELECT MAX(importance) FROM messages WHERE group_key = conversations.group_key),
+            (chat_id, title, last_date, last_ts, last_message_id) = (
+                SELECT {CONVERSATION_CHAT_ID_SQL.format(m='m')}, {CONVERSATION_TITLE_SQL.format(m='m')},
+                       m.date, {CONVERSATION_TS_SQL.format(m='m')}, m.id
+                FROM messages m WHERE m.group_key = conversations.group_key
+                ORDER BY m.date_ts DESC, m.id DESC LIMIT 1)
+        WHERE {where};
+        {_conversation_priority_sql(where)}"""
+
+def _conversation_add_sql(ref):
+    where = f"group_key = {ref}.group_key"
+    return f"""INSERT OR IGNORE INTO conversations (group_key, is_group) VALUES ({ref}.group_key, {ref}.group_key LIKE 'group::%');
+            UPDATE conversations SET
+                total_messages = total_messages + 1,
+                total_chars = total_chars + LENGTH(COALESCE({ref}.text_content, '')),
+                max_importance = MAX(COALESCE(max_importance, {ref}.importance), COALESCE({ref}.importance, max_importance))
+            WHERE {where};
+            UPDATE conversations SET
+                chat_id = {CONVERSATION_CHAT_ID_SQL.format(m=ref)},
+                title = {CONVERSATION_TITLE_SQL.format(m=ref)},
+                last_date = {ref}.date,
+                last_ts = {CONVERSATION_TS_SQL.format(m=ref)},
+                last_message_id = {ref}.id
+            WHERE {where} AND (last_message_id IS NULL
+                OR ({CONVERSATION_TS_SQL.format(m=ref)}, {ref}.id) >= (last_ts, last_message_id));
+            {_conversation_priority_sql(where)}"""
+
+def _conversation_remove_sql(ref):
+    where = f"group_key = {ref}.group_key"
+    return f"""UPDATE conversations SET
+                total_messages = total_messages - 1,
+                total_chars = total_chars - LENGTH(COALESCE({ref}.text_content, ''))
+            WHERE {where};
+            DELETE FROM conversations WHERE {where} AND total_messages <= 0;
+            {_conversation_refresh_sql(where)}"""
+
+def _conversation_summary_sql(chat_id_ref):
+    # смена сводки меняет приоритет — фиксируем это в журнале, чтобы delta-клиенты получили переписку
+    return f"""{_conversation_priority_sql(f"chat_id = {chat_id_ref}")}
+            INSERT INTO message_changes (message_row_id, group_key, op)
+                SELECT 0, group_key, 'group' FROM conversations WHERE chat_id = {chat_id_ref};"""
+
+def rebuild_conversations(cursor):
+    """Полный пересчёт таблицы conversations по messages (для существующих баз и ручного восстановления)."""
+    cursor.execute("DELETE FROM conversations")
+    cursor.execute("""
+        INSERT INTO conversations (group_key, is_group, total_messages, total_chars)
+        SELECT group_key, group_key LIKE 'group::%', COUNT(*), SUM(LENGTH(COALESCE(text_content, '')))
+        FROM messages GROUP BY group_key
+    """)
+    cursor.executescript(_conversation_refresh_sql("1=1"))
+
+# Индексы под запросы эндпоинтов; проверяются check_query_plans()
+MESSAGE_INDEXES = {
+    "idx_messages_ts": "messages(date_ts, id)",                             # /api/messages
+    "idx_messages_importance_ts": "messages(importance, date_ts, id)",      # фильтр по важности, срочные в анализе
+    "idx_messages_source_ts": "messages(source, date_ts, id)",              # фильтр по источнику, выгрузка
+    "idx_messages_group_ts": "messages(group_key, date_ts, id)",            # сообщения переписки
+    "idx_messages_group_importance": "messages(group_key, importance)",     # пересчёт max_importance
+}
+# прежние индексы по текстовой date — заменены индексами по date_ts
+OBSOLETE_INDEXES = ("idx_messages_date", "idx_messages_importance_date", "idx_messages_group_date")
+
+def migrate_indexes(cursor):
+    for name in OBSOLETE_INDEXES:
+        cursor.execute(f"DROP INDEX IF EXISTS {name}")
+    for name, target in MESSAGE_INDEXES.items():
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
 
-threading.Thread(target=run_websocket_in_thread, daemon=True).start()
+def migrate_date_ts(cursor):
+    """
+    Одноразовая миграция при появлении колонки date_ts: заполняет её по date и пересоздаёт
+    conversations (триггеры и порядок «последнего сообщения» теперь считаются по date_ts).
+    Триггеры conversations снимаются до заполнения, чтобы не пересчитывать переписку на каждую строку.
+    """
+    for trigger in ("conversations_on_insert", "conversations_on_delete", "conversations_on_update"):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cursor.execute("DROP TABLE IF EXISTS conversations")
+    cursor.execute(f"UPDATE messages SET date_ts = {DATE_TS_SQL.format(value='date')} WHERE date IS NOT NULL")
+
+def ensure_column(cursor, table, column, ddl):
+    """Добавляет колонку в существующую таблицу, если её ещё нет (простая миграция схемы); True — если добавлена."""
+    cursor.execute(f"PRAGMA table_xinfo({table})")
+    if column in {r[1] for r in cursor.fetchall()}:
+        return False
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+    return True
+
+def get_change_version(cursor):
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM message_changes")
+    return cursor.fetchone()[0]
+
+# Окончания для грубого стемминга поисковых слов: «сообщения» ищется как «сообщени*»
+RU_ENDINGS = sorted("""ами ями ого ему ому ыми ими его ой ей ий ый ая яя ое ее ые ие ом ем ам ям ах ях ую юю
+ов ев ия ья ие ье а я о е ы и у ю ь""".split(), key=len, reverse=True)
+SEARCH_TOKEN_RE = re.compile(r'\w+', flags=re.UNICODE)
+
+def _stem_ru(term):
+    for ending in RU_ENDINGS:
+        if term.endswith(ending) and len(term) - len(ending) >= 3:
+            return term[:-len(ending)]
+    return term
+
+def build_fts_query(search):
+    """Строка поиска → запрос FTS5: все слова обязательны, каждое ищется по префиксу основы."""
+    terms = [_stem_ru(t) for t in SEARCH_TOKEN_RE.findall(search.lower().replace('ё', 'е'))]
+    return ' '.join(f'"{t}"*' for t in terms)
+
+def snippet_to_html(snippet):
+    # snippet() отдаёт исходный текст: экранируем его и только потом вставляем подсветку
+    text = (snippet or '').replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return text.replace('\x02', '<mark>').replace('\x03', '</mark>')
+
+def encode_cursor(*values):
+    """Непрозрачный курсор пагинации: base64 от JSON-массива значений."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    except Exception:
+        return None
+    return values if isinstance(values, list) else None
+
+def start_background_services():
+    hub.start(WEBSOCKET_HOST, WEBSOCKET_PORT)
+    threading.Thread(target=term_stats.run_indexer, args=(get_db_connection,), daemon=True).start()
+    threading.Thread(target=importance.run_rescorer, args=(get_db_connection,), daemon=True).start()
+    threading.Thread(target=retention.run_worker, args=(get_db_connection,), daemon=True).start()
+    threading.Thread(target=near_dups.run_indexer, args=(get_db_connection,), daemon=True).start()
+
+# === Метрики запросов и профайлер (см. metrics.py, profiler.py) ===
+HTTP_SECONDS = metrics.histogram("http_request_duration_seconds", "Время обработки запроса", ("route", "method", "status"))
+HTTP_RESPONSE_BYTES = metrics.histogram("http_response_size_bytes", "Размер ответа", ("route",), buckets=metrics.SIZE_BUCKETS)
+
+def _route_label():
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+@app.before_request
+def _start_request_metrics():
+    g.request_started = time.perf_counter()
+    if PROFILER.enabled_for(_route_label()):
+        PROFILER.start_request(_route_label())
+
+@app.after_request
+def _record_request_metrics(response):
+    route = _route_label()
+    HTTP_SECONDS.observe(time.perf_counter() - g.request_started, route=route, method=request.method, status=response.status_code)
+    # у потоковых ответов (выгрузка) размер не считаем: calculate_content_length собрал бы весь поток в память
+    size = None if response.is_streamed else response.calculate_content_length()
+    if size is not None:
+        HTTP_RESPONSE_BYTES.observe(size, route=route)
+    return response
+
+@app.teardown_request
+def _stop_profiling(exc=None):
+    PROFILER.stop_request()
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Метрики веб-процесса и снимки ингесторов из METRICS_DIR в текстовом формате Prometheus."""
+    return Response(metrics.exposition("web"), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route('/debug/profile')
+def debug_profile():
+    """
+    Свёрнутые стеки профайлера (PROFILE_ROUTES); route= — один роут, reset=1 — очистить после выдачи.
+    Стеки раскрывают внутренности кода, поэтому эндпоинт есть только при включённом профайлере
+    и отвечает только на запросы с localhost.
+    """
+    if not PROFILER.routes or request.remote_addr not in LOCAL_ADDRESSES:
+        return Response(status=404)
+    text = PROFILER.folded(request.args.get('route'))
+    if request.args.get('reset') == '1':
+        PROFILER.reset()
+    return Response(text, mimetype="text/plain; charset=utf-8")
 
 # === Роуты ===
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', websocket_port=WEBSOCKET_PORT)
+
+def build_messages_query(importance=None, search='', sort_order='desc', cursor_values=None, limit=50, offset=0,
+                         source=None, date_from=None, date_to=None, by_id=False):
+    """
+    Запрос для /api/messages и /api/export. Возвращает (sql, params, order_columns): по order_columns
+    последней строки строится next_cursor для keyset-пагинации. date_from / date_to — секунды UTC,
+    [date_from, date_to); limit=-1 — без ограничения. by_id — порядок по id (порядок поступления)
+    вместо даты: при поиске его отдаёт сам FTS-индекс, без сортировки всех совпадений.
+    """
+    columns = ", ".join(f"m.{c}" for c in LIST_COLUMNS)
+    if search:
+        query = f"""SELECT {columns}, bm25(messages_fts, 3.0, 2.0, 1.0) AS rank,
+                           snippet(messages_fts, -1, char(2), char(3), '…', 16) AS snippet
+                    FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                    WHERE messages_fts MATCH ?"""
+        params = [build_fts_query(search)]
+    else:
+        query = f"SELECT {columns} FROM messages m WHERE 1=1"
+        params = []
+
+    if importance:
+        query += " AND m.importance = ?"
+        params.append(int(importance))
+    if source:
+        query += " AND m.source = ?"
+        params.append(source)
+    if date_from is not None:
+        query += " AND m.date_ts >= ?"
+        params.append(date_from)
+    if date_to is not None:
+        query += " AND m.date_ts < ?"
+        params.append(date_to)
+
+    # === Сортировка ===
+    if search and sort_order == 'relevance':
+        # rank — вычисляемый столбец, keyset по нему возможен только поверх подзапроса
+        order_columns = ('rank', 'id')
+        query = f"SELECT * FROM ({query})"
+        if cursor_values:
+            query += " WHERE (rank, id) > (?, ?)"
+        order_by = "rank ASC, id ASC"
+    elif by_id:
+        order_columns = ('id',)
+        direction = 'DESC' if sort_order == 'desc' else 'ASC'
+        # rowid FTS5 и есть id сообщения; ORDER BY по m.id планировщик через соединение не протянет
+        key = "messages_fts.rowid" if search else "m.id"
+        if cursor_values:
+            query += f" AND {key} {'<' if direction == 'DESC' else '>'} ?"
+        order_by = f"{key} {direction}"
+    else:
+        order_columns = ('date_ts', 'id')
+        direction = 'DESC' if sort_order == 'desc' else 'ASC'
+        if cursor_values:
+            query += f" AND (m.date_ts, m.id) {'<' if direction == 'DESC' else '>'} (?, ?)"
+        order_by = f"m.date_ts {direction}, m.id {direction}"
+
+    if cursor_values:
+        params.extend(cursor_values)
+        offset = 0
+    query += f" ORDER BY {order_by} LIMIT ? OFFSET ?"
+    params.extend([limit, offset])
+    return query, params, order_columns
+
+def parse_date_param(value):
+    """Граница диапазона дат: секунды UTC или ISO-дата (без пояса — UTC); None, если не задана."""
+    if value is None or value == '':
+        return None
+    if str(value).lstrip('-').isdigit():
+        return int(value)
+    ts = date_to_epoch(value)
+    if ts is None:
+        raise ValueError(f"Не разобрать дату: {value}")
+    return ts
+
+def build_export_query(source=None, importance=None, date_from=None, date_to=None, search='', sort_order='asc'):
+    """
+    Запрос выгрузки: фильтры /api/messages, без LIMIT; ValueError — неверная дата. Порядок — по дате
+    (по индексу), а с search — по id: сортировка совпадений FTS по дате шла бы во временном B-дереве,
+    и память росла бы с размером выгрузки.
+    """
+    query, params, _ = build_messages_query(
+        importance, search, 'desc' if sort_order == 'desc' else 'asc', None, -1, 0,
+        source=source, date_from=parse_date_param(date_from), date_to=parse_date_param(date_to), by_id=bool(search)
+    )
+    return query, params
 
 @app.route('/api/messages', methods=['GET'])
 def get_all_messages():
+    """
+    Список сообщений. Постранично — через cursor: передайте cursor= (пусто для первой страницы),
+    ответ будет {messages, next_cursor}. Без cursor — как раньше, список с limit/offset;
+    курсор следующей страницы в этом случае приходит в заголовке X-Next-Cursor.
+    Фильтры: importance, source, date_from / date_to (ISO-дата или секунды UTC), search.
+    """
     limit = int(request.args.get('limit', 50))
     offset = int(request.args.get('offset', 0))
     importance = request.args.get('importance')
     search = request.args.get('search', '')
-    sort_order = request.args.get('sort_order', 'desc')  # 'asc' или 'desc'
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    query = "SELECT * FROM messages WHERE 1=1"
-    params = []
-
-    if importance:
-        query += " AND importance = ?"
-        params.append(int(importance))
+    # 'asc' или 'desc' по дате; при поиске по умолчанию 'relevance' (bm25)
+    sort_order = request.args.get('sort_order', 'relevance' if search else 'desc')
+    cursor_mode = 'cursor' in request.args
+    cursor_values = decode_cursor(request.args.get('cursor', '')) if cursor_mode else None
+    try:
+        date_from = parse_date_param(request.args.get('date_from'))
+        date_to = parse_date_param(request.args.get('date_to'))
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
 
-    if search:
-        query += " AND text_content LIKE ?"
-        params.append(f"%{search}%")
+    if search and not build_fts_query(search):
+        return jsonify({"messages": [], "next_cursor": None} if cursor_mode else [])
 
-    # === Сортировка ===
-    order_by = "date DESC" if sort_order == 'desc' else "date ASC"
-    query += f" ORDER BY {order_by} LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
+    query, params, order_columns = build_messages_query(importance, search, sort_order, cursor_values, limit, offset,
+                                                        request.args.get('source'), date_from, date_to)
 
+    conn = get_db_connection()
+    cursor = conn.cursor()
     cursor.execute(query, params)
     rows = cursor.fetchall()
     conn.close()
 
     messages = [dict(row) for row in rows]
-    return jsonify(messages)
+    for m in messages:
+        if 'snippet' in m:
+            m['snippet_html'] = snippet_to_html(m.pop('snippet'))
+    next_cursor = encode_cursor(*(rows[-1][c] for c in order_columns)) if len(rows) == limit else None
+
+    if cursor_mode:
+        return jsonify({"messages": messages, "next_cursor": next_cursor})
+    response = jsonify(messages)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+@app.route('/api/export', methods=['GET'])
+def export_messages():
+    """
+    Потоковая выгрузка (см. export.py): format=ndjson|csv, gzip=1 — сжатый файл, фильтры как у
+    /api/messages, sort_order=asc|desc по дате (с search — по id). Память не растёт с объёмом:
+    строки читаются порциями, запрос не сортирует выборку во временном B-дереве.
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in export.FORMATS:
+        return jsonify({"success": False, "error": f"format: {', '.join(export.FORMATS)}"}), 400
+    compress = request.args.get('gzip') in ('1', 'true')
+    search = request.args.get('search', '')
+    try:
+        query, params = build_export_query(request.args.get('source'), request.args.get('importance'),
+                                           request.args.get('date_from'), request.args.get('date_to'),
+                                           search, request.args.get('sort_order', 'asc'))
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    if search and not build_fts_query(search):
+        query, params = build_export_query(date_from=0, date_to=0)   # пустая выгрузка, но с заголовком CSV
+
+    name = export.filename(fmt, compress, datetime.now().strftime('%Y%m%d-%H%M%S'))
+    body = export.stream(get_db_connection, query, params, LIST_COLUMNS, fmt, compress)
+    return Response(body, mimetype='application/gzip' if compress else export.FORMATS[fmt][0],
+                    headers={'Content-Disposition': f'attachment; filename="{name}"'})
 
 @app.route('/api/messages/<int:message_id>', methods=['DELETE'])
 def delete_message(message_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM messages WHERE id = ?", (message_id,))
-    conn.commit()
-    conn.close()
+    storage.write(lambda conn: conn.execute("DELETE FROM messages WHERE id = ?", (message_id,)), database=DATABASE)
     notify_websockets()
     return jsonify({"success": True})
 
+@app.route('/api/messages/<int:message_id>/raw', methods=['GET'])
+def get_message_raw(message_id):
+    """Исходник сообщения (заголовки письма, JSON апдейта и т.п.) — читается из message_raw только по этому запросу."""
+    conn = get_db_connection()
+    raw = raw_store.load(conn.cursor(), message_id)
+    conn.close()
+    if raw is None:
+        return jsonify({"success": False, "error": "Исходник не сохранён"}), 404
+    content_type, data = raw
+    if content_type.startswith("text/") or content_type == "application/json":
+        content_type = content_type.split(";")[0] + "; charset=utf-8"
+    return Response(data, content_type=content_type)
+
+@app.route('/api/archive/months', methods=['GET'])
+def get_archive_months():
+    """Помесячные архивные базы (см. retention): месяц, число сообщений, размер файла."""
+    return jsonify(retention.archive_summary())
+
+@app.route('/api/archive/messages', methods=['GET'])
+def get_archive_messages():
+    """
+    Поиск по архиву — только по запросу, горячую базу не трогает.
+    search — как в /api/messages, months=2024-01,2024-02 — ограничить месяцами,
+    cursor — из next_cursor предыдущей страницы. Ответ: {messages, next_cursor}.
+    """
+    limit = min(int(request.args.get('limit', 50)), 500)
+    search = request.args.get('search', '')
+    fts_query = build_fts_query(search) if search else None
+    if search and not fts_query:
+        return jsonify({"messages": [], "next_cursor": None})
+    months = [m for m in request.args.get('months', '').split(',') if m] or None
+    before = decode_cursor(request.args.get('cursor', '')) if request.args.get('cursor') else None
+    messages = retention.search_archive(fts_query, months, limit, before, request.args.get('importance'))
+    for m in messages:
+        if 'snippet' in m:
+            m['snippet_html'] = snippet_to_html(m.pop('snippet'))
+    next_cursor = encode_cursor(messages[-1]['date_ts'], messages[-1]['id']) if len(messages) == limit else None
+    return jsonify({"messages": messages, "next_cursor": next_cursor})
+
+def build_bulk_filter(body):
+    """
+    Условие WHERE для массовых операций: group_key, ids и/или фильтр {source, importance, older_than}.
+    ValueError — некорректный критерий (его текст уходит клиенту).
+    """
+    conditions, params = [], []
+    if body.get('group_key'):
+        conditions.append("group_key = ?")
+        params.append(body['group_key'])
+    if body.get('ids'):
+        try:
+            ids = [int(i) for i in body['ids']]
+        except (TypeError, ValueError):
+            raise ValueError("ids — список целых чисел")
+        conditions.append(f"id IN ({','.join('?' * len(ids))})")
+        params.extend(ids)
+    flt = body.get('filter') or {}
+    if not isinstance(flt, dict):
+        raise ValueError("filter — объект {source, importance, older_than}")
+    if flt.get('source'):
+        conditions.append("source = ?")
+        params.append(flt['source'])
+    if flt.get('importance'):
+        try:
+            params.append(int(flt['importance']))
+        except (TypeError, ValueError):
+            raise ValueError(f"Некорректная важность: {flt['importance']}")
+        conditions.append("importance = ?")
+    if flt.get('older_than'):
+        conditions.append("date_ts < ?")
+        params.append(parse_date_param(flt['older_than']))
+    return " AND ".join(conditions), params
+
+@app.route('/api/messages/bulk', methods=['POST'])
+def bulk_messages():
+    """
+    Массовое удаление или пометка «обработано».
+    Тело: {"action": "delete" | "archive", "group_key": ..., "ids": [...],
+           "filter": {"source": ..., "importance": ..., "older_than": "<ISO-дата или секунды UTC>"}}
+    Критерии объединяются через AND; хотя бы один обязателен. delete — одной транзакцией;
+    archive копирует сообщения в помесячные архивы и удаляет из горячей базы тоже одной транзакцией
+    (retention.archive_selection), после чего они ищутся через /api/archive/messages.
+    """
+    body = request.get_json(silent=True) or {}
+    action = body.get('action', 'delete')
+    if action not in ('delete', 'archive'):
+        return jsonify({"success": False, "error": f"Неизвестное действие: {action}"}), 400
+    try:
+        where, params = build_bulk_filter(body)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    if not where:
+        return jsonify({"success": False, "error": "Нужен group_key, ids или filter"}), 400
+
+    if action == 'archive':
+        conn = get_db_connection()
+        try:
+            affected = retention.archive_selection(conn, where, params, database=DATABASE)
+        finally:
+            conn.close()
+    else:
+        affected = storage.write(lambda conn: conn.execute(f"DELETE FROM messages WHERE {where}", params).rowcount,
+                                 database=DATABASE)
+
+    if affected:
+        notify_websockets()
+    return jsonify({"success": True, "action": action, "affected": affected})
+
 @app.route('/api/sources', methods=['GET'])
 def get_sources():
     # можно расширить чтением из БД — сейчас отдаём статично, но в массиве включены все имеющиеся источники
@@ -154,74 +747,65 @@ def get_sources():
 @app.route('/api/analysis', methods=['GET'])
 def analysis():
     """
-    Собирает последние сообщения и формирует удобный HTML-блок:
+    Строит удобный HTML-блок по предрассчитанной статистике терминов (term_stats):
     - топ тем (чипы) — кликабельные
     - для каждой темы: краткий обзор + примеры сообщений
     - список срочных сообщений
+    window=hour|day|week ограничивает темы окном времени, по умолчанию — вся история.
+    collapse=1 не считает почти-дубликаты (near_dups), у примеров — «встречалось в N местах».
     Возвращает JSON: { html: "...", prompt: "..." }
     """
+    window = request.args.get('window')
+    collapse = request.args.get('collapse') in ('1', 'true')
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT id, from_user_name, chat_title, text_content, importance, date, source FROM messages ORDER BY date DESC LIMIT 800")
-    rows = cursor.fetchall()
-    conn.close()
+    # очередь term_stats разбирает только фоновый индексатор: GET ничего не пишет в базу
 
-    messages = [dict(r) for r in rows]
-
-    stopwords = set("""и в во не на я он она мы вы ты что это для как до через под без при же так но его её за от по или ли их о об""".split())
-    word_counter = Counter()
-    msg_map = []
-    word_re = re.compile(r'\b[а-яА-Яa-zA-Z0-9]{3,}\b', flags=re.UNICODE)
-
-    for m in messages:
-        txt = (m.get('text_content') or '').lower()
-        words = word_re.findall(txt)
-        filtered = [w for w in words if w not in stopwords]
-        word_counter.update(filtered)
-        msg_map.append({
+    def load_messages(where, params):
+        # дату для подписи форматирует SQLite по date_ts — в Python строки дат не разбираем
+        cursor.execute(f"""SELECT id, from_user_name, text_content, importance, source,
+                                  strftime('%Y-%m-%d %H:%M', date_ts, 'unixepoch', 'localtime') AS date_label
+                           FROM messages WHERE {where}""", params)
+        loaded = [{
             'id': m['id'],
-            'text': m.get('text_content') or '',
-            'importance': int(m.get('importance') or 3),
-            'from': m.get('from_user_name') or '',
-            'date': m.get('date'),
-            'source': m.get('source') or 'telegram'
-        })
-
-    top_words = [w for w,_ in word_counter.most_common(10)]
-    if not top_words:
-        top_words = ["(нет тем)"]
+            'text': m['text_content'] or '',
+            'importance': int(m['importance'] or 3),
+            'from': m['from_user_name'] or '',
+            'date_label': m['date_label'] or '',
+            'source': m['source'] or 'telegram'
+        } for m in cursor.fetchall()]
+        return near_dups.collapse_messages(cursor, loaded) if collapse else loaded
 
-    # Создаём группы: для каждой топ-темы считаем примеры и краткий обзор
+    # Создаём группы: для каждой топ-темы берём примеры и частые соседние слова
     groups = []
-    for kw in top_words[:8]:
-        hits = [m for m in msg_map if kw in (m['text'] or '').lower()]
-        if hits:
-            avg_imp = sum(h['importance'] for h in hits) / len(hits)
-            # пост-обработка: собрать частые слова внутри группы (кроме ключа)
-            local_counter = Counter()
-            for h in hits:
-                words = word_re.findall((h['text'] or '').lower())
-                local_counter.update([w for w in words if w not in stopwords and w != kw])
-            top_local = [w for w,_ in local_counter.most_common(3)]
-            if top_local:
-                summary = f"Коротко: в теме часто встречаются слова «{', '.join(top_local)}» — основные вопросы связаны с ними."
-            else:
-                summary = "Коротко: обсуждается тема, есть разные сообщения по смежным вопросам."
-            groups.append({
-                'keyword': kw,
-                'count': len(hits),
-                'avg_importance': round(avg_imp,2),
-                'examples': hits[:3],
-                'summary': summary
-            })
+    for kw, count, avg_imp in term_stats.top_terms(cursor, limit=8, window=window, collapse=collapse):
+        ids = term_stats.term_message_ids(cursor, kw, limit=3, window=window, collapse=collapse)
+        by_id = {m['id']: m for m in load_messages(f"id IN ({','.join('?' * len(ids))})", ids)} if ids else {}
+        top_local = term_stats.related_terms(cursor, kw, limit=3)
+        if top_local:
+            summary = f"Коротко: в теме часто встречаются слова «{', '.join(top_local)}» — основные вопросы связаны с ними."
+        else:
+            summary = "Коротко: обсуждается тема, есть разные сообщения по смежным вопросам."
+        groups.append({
+            'keyword': kw,
+            'count': count,
+            'avg_importance': round(avg_imp or 0, 2),
+            'examples': [by_id[i] for i in ids if i in by_id],
+            'summary': summary
+        })
 
     # Топ срочных сообщений
-    urgent = sorted([m for m in msg_map if int(m['importance']) >= 4], key=lambda x: -int(x['importance']))[:8]
+    not_duplicate = " AND id NOT IN (SELECT message_id FROM message_duplicates)" if collapse else ""
+    urgent = load_messages(f"importance >= 4{not_duplicate} ORDER BY importance DESC, date_ts DESC LIMIT 8", [])
+    conn.close()
 
     # ==== Формирование HTML ====
     def safe(s):
         return (s or '').replace('<','&lt;').replace('>','&gt;')
 
+    def seen_in(m):
+        return f' • встречалось в {m["seen_in"]} местах' if m.get('seen_in', 1) > 1 else ''
+
     html_parts = []
 
     # Top topics (чипы) — делаем прокручиваемую плитку
@@ -240,16 +824,11 @@ def analysis():
         html_parts.append(f'<div class="small-muted" style="margin-top:6px">{safe(g["summary"])}</div>')
         html_parts.append('<div style="margin-top:10px;">')
         for ex in g['examples']:
-            dstr = ''
-            try:
-                dstr = datetime.fromisoformat(ex['date']).strftime('%Y-%m-%d %H:%M')
-            except Exception:
-                dstr = (ex['date'] or '')[:16]
             html_parts.append(
                 f'<div style="padding:8px;border-radius:8px;margin-bottom:6px;background:#fbfbfd;">'
                 f'<div style="font-weight:600">{safe(ex["from"]) or "—"}</div>'
                 f'<div style="font-size:0.92rem;margin-top:4px">{safe(ex["text"][:350])}</div>'
-                f'<div class="small-muted" style="font-size:0.8rem;margin-top:6px">{dstr} • {safe(ex["source"])} • приоритет: {ex["importance"]}</div>'
+                f'<div class="small-muted" style="font-size:0.8rem;margin-top:6px">{ex["date_label"]} • {safe(ex["source"])} • приоритет: {ex["importance"]}{seen_in(ex)}</div>'
                 f'</div>'
             )
         html_parts.append('</div></div>')
@@ -260,16 +839,11 @@ def analysis():
         html_parts.append('<div style="font-weight:700">Срочные / важные сообщения</div>')
         html_parts.append('<div style="margin-top:8px;">')
         for u in urgent:
-            dstr = ''
-            try:
-                dstr = datetime.fromisoformat(u['date']).strftime('%Y-%m-%d %H:%M')
-            except Exception:
-                dstr = (u['date'] or '')[:16]
             html_parts.append(
                 f'<div style="padding:8px;border-radius:8px;margin-bottom:6px;background:linear-gradient(90deg, rgba(255,240,240,0.95), #fff);">'
                 f'<div style="font-weight:600">{safe(u["from"]) or "—"}</div>'
                 f'<div style="font-size:0.92rem;margin-top:4px">{safe(u["text"][:400])}</div>'
-                f'<div class="small-muted" style="font-size:0.8rem;margin-top:6px">{dstr} • {safe(u["source"])} • приоритет: {u["importance"]}</div>'
+                f'<div class="small-muted" style="font-size:0.8rem;margin-top:6px">{u["date_label"]} • {safe(u["source"])} • приоритет: {u["importance"]}{seen_in(u)}</div>'
                 f'</div>'
             )
         html_parts.append('</div></div>')
@@ -278,92 +852,275 @@ def analysis():
     return jsonify({'html': html, 'prompt': ""})
 
 
+GROUP_MESSAGE_COLUMNS = "id, from_user_id, from_user_name, chat_id, chat_title, text_content, importance, date, date_ts, source, ai_reply, group_key"
+
+def _format_group_message(m):
+    return {
+        "id": m['id'],
+        "from_user_id": m['from_user_id'],
+        "from_user_name": m['from_user_name'],
+        "text_content": m['text_content'],
+        "importance": m['importance'],
+        "date": m['date'],
+        "date_ts": m['date_ts'],
+        "source": m['source'],
+        "ai_reply": m['ai_reply'] or ''
+    }
+
+def _key_filter(group_keys, column='group_key'):
+    if group_keys is None:
+        return "", []
+    return f" WHERE {column} IN ({','.join('?' * len(group_keys))})", list(group_keys)
+
+def _load_conversations(cur, group_keys=None):
+    """Переписки из материализованной таблицы в порядке (priority DESC, last_ts DESC) — чтение по индексу."""
+    where, params = _key_filter(group_keys, 'c.group_key')
+    cur.execute(f"""
+        SELECT c.group_key, c.chat_id, c.title, c.is_group, c.total_messages, c.total_chars, c.priority, c.last_date,
+               c.last_ts, c.last_message_id, s.summary, s.ai_reply
+        FROM conversations c LEFT JOIN chat_summaries s ON s.chat_id = c.chat_id{where}
+        ORDER BY c.priority DESC, c.last_ts DESC
+    """, params)
+    return cur.fetchall()
+
+def _load_group_messages(cur, group_keys=None, limit=None):
+    """Сообщения переписок по возрастанию даты; при limit — только последние limit в каждой."""
+    grouped = {}
+    if limit is None:
+        where, params = _key_filter(group_keys)
+        cur.execute(f"SELECT {GROUP_MESSAGE_COLUMNS} FROM messages{where} ORDER BY date_ts ASC, id ASC", params)
+        for r in cur.fetchall():
+            grouped.setdefault(r['group_key'], []).append(_format_group_message(r))
+        return grouped
+    # по индексу (group_key, date_ts, id) берём хвост каждой переписки, не трогая остальную историю
+    for gk in group_keys:
+        cur.execute(
+            f"SELECT {GROUP_MESSAGE_COLUMNS} FROM messages WHERE group_key = ? ORDER BY date_ts DESC, id DESC LIMIT ?",
+            (gk, limit)
+        )
+        grouped[gk] = [_format_group_message(r) for r in reversed(cur.fetchall())]
+    return grouped
+
+def _messages_cursor(conv, messages):
+    """
+    Курсор догрузки (date_ts, id) < cursor: от самого старого из отданных сообщений. Если сообщений
+    в ответе нет (в delta пришли только удаления), курсор стоит сразу за последним сообщением
+    переписки — первая догрузка вернёт и его.
+    """
+    if messages:
+        return encode_cursor(messages[0]['date_ts'], messages[0]['id'])
+    if conv['last_message_id'] is None:
+        return None
+    return encode_cursor(conv['last_ts'], conv['last_message_id'] + 1)
+
+def _build_group(conv, messages):
+    total_messages = conv['total_messages']
+    total_chars = conv['total_chars']
+    collapsed = True if total_chars > 800 or total_messages > 6 else False
+
+    return {
+        "group_key": conv['group_key'],
+        "chat_id": conv['chat_id'] or '',
+        "chat_title": conv['title'],
+        "is_group": bool(conv['is_group']),
+        "messages": messages,
+        "summary": conv['summary'] or '',
+        "ai_reply": conv['ai_reply'] or '',
+        "priority": conv['priority'],
+        "collapsed": collapsed,
+        "total_messages": total_messages,
+        "total_chars": total_chars,
+        "last_date": conv['last_date'],
+        "last_ts": conv['last_ts'],
+        "has_more_messages": len(messages) < total_messages,
+        "messages_cursor": _messages_cursor(conv, messages)
+    }
+
+def _collapse_groups(cur, groups):
+    """
+    Почти-дубликаты (near_dups) убираются из переписок, у канонических сообщений — seen_in и copies.
+    Переписка, все сообщения которой оказались копиями, пропадает; счётчики и курсор догрузки не меняются.
+    """
+    messages = [m for g in groups for m in g['messages']]
+    kept = {m['id'] for m in near_dups.collapse_messages(cur, messages)}
+    result = []
+    for g in groups:
+        if g['messages'] and not g['has_more_messages'] and not any(m['id'] in kept for m in g['messages']):
+            continue
+        g['messages'] = [m for m in g['messages'] if m['id'] in kept]
+        result.append(g)
+    return result
+
+def _load_groups(cur, group_keys=None, limit=None, messages_by_group=None, collapse=False):
+    conversations = _load_conversations(cur, group_keys)
+    if messages_by_group is None:
+        messages_by_group = _load_group_messages(cur, [c['group_key'] for c in conversations] if limit else group_keys, limit)
+    groups = [_build_group(c, messages_by_group.get(c['group_key'], [])) for c in conversations]
+    return _collapse_groups(cur, groups) if collapse else groups
+
+def _load_groups_delta(cur, since, version, limit, collapse=False):
+    """
+    Изменения с версии since: переписки, в которых что-то добавилось/удалилось, и id удалённых сообщений.
+    Клиент сначала убирает deleted_messages, затем сливает messages из groups (переписка приходит
+    с актуальными счётчиками), а переписки из deleted_groups удаляет целиком.
+    Возвращает None, если изменений слишком много или журнал уже обрезан — тогда нужен полный снимок.
+    """
+    cur.execute("SELECT MIN(version) FROM message_changes")
+    min_version = cur.fetchone()[0]
+    if since > version or (min_version is not None and since < min_version - 1):
+        return None
+    cur.execute(
+        "SELECT message_row_id, group_key, op FROM message_changes WHERE version > ? ORDER BY version LIMIT ?",
+        (since, DELTA_MAX_CHANGES + 1)
+    )
+    changes = cur.fetchall()
+    if len(changes) > DELTA_MAX_CHANGES:
+        return None
+
+    touched, upserted, deleted = set(), set(), set()
+    for c in changes:
+        touched.add(c['group_key'])
+        if c['op'] == 'delete':
+            deleted.add(c['message_row_id'])
+            upserted.discard(c['message_row_id'])
+        elif c['op'] == 'upsert':
+            upserted.add(c['message_row_id'])
+
+    messages_by_group = {}
+    if upserted:
+        ids = list(upserted)
+        cur.execute(f"SELECT {GROUP_MESSAGE_COLUMNS} FROM messages WHERE id IN ({','.join('?' * len(ids))}) ORDER BY date_ts ASC, id ASC", ids)
+        for r in cur.fetchall():
+            messages_by_group.setdefault(r['group_key'], []).append(_format_group_message(r))
+
+    groups = _load_groups(cur, touched, limit, messages_by_group, collapse) if touched else []
+    alive = {g['group_key'] for g in groups}
+    return {
+        "version": version,
+        "reset": False,
+        "groups": groups,
+        "deleted_groups": sorted(k for k in touched if k not in alive),
+        "deleted_messages": sorted(deleted)
+    }
+
 @app.route('/api/grouped_messages', methods=['GET'])
 def get_grouped_messages():
+    """
+    Без параметров — полный список переписок (как раньше).
+    messages_limit=N — только последние N сообщений каждой переписки, остальные догружаются
+    через /api/grouped_messages/<group_key>/messages.
+    since=<version> — delta-режим: {version, reset, groups, deleted_groups, deleted_messages};
+    since=0 или устаревший курсор дают полный снимок с reset=true.
+    collapse=1 — почти-дубликаты (пересылки, цитаты) не показываются, у оригинала seen_in — в скольких
+    переписках он встречался, и copies — число копий.
+    Ответ помечается ETag по версии журнала изменений, при совпадении If-None-Match — 304.
+    """
+    since = request.args.get('since', type=int)
+    limit = request.args.get('messages_limit', type=int)
+    collapse = request.args.get('collapse') in ('1', 'true')
+
     conn = get_db_connection()
     cur = conn.cursor()
+    version = get_change_version(cur)
+    etag = f'W/"{version}-{limit or 0}{"" if since is None else "-delta"}{"-collapse" if collapse else ""}"'
+    if request.headers.get('If-None-Match') == etag:
+        conn.close()
+        return '', 304, {'ETag': etag}
 
-    # Получаем предварительно посчитанные сводки
-    cur.execute("SELECT chat_id, chat_title, is_group, summary, ai_reply, priority, total_messages, total_chars, last_updated FROM chat_summaries")
-    rows = cur.fetchall()
-    summaries = {r['chat_id']: dict(r) for r in rows}
+    if since is None:
+        payload = _load_groups(cur, limit=limit, collapse=collapse)
+    else:
+        payload = _load_groups_delta(cur, since, version, limit, collapse) if since > 0 else None
+        if payload is None:
+            payload = {"version": version, "reset": True, "groups": _load_groups(cur, limit=limit, collapse=collapse),
+                       "deleted_groups": [], "deleted_messages": []}
+    conn.close()
+
+    response = jsonify(payload)
+    response.headers['ETag'] = etag
+    return response
+
+@app.route('/api/grouped_messages/<path:group_key>/messages', methods=['GET'])
+def get_group_messages_page(group_key):
+    """Более старые сообщения переписки: cursor из messages_cursor, ответ по возрастанию даты."""
+    limit = request.args.get('limit', 50, type=int)
+    cursor_values = decode_cursor(request.args.get('cursor', ''))
 
-    # Получаем последние сообщения по всем чатам
-    cur.execute("SELECT id, from_user_id, from_user_name, chat_id, chat_title, text_content, importance, date, source, ai_reply FROM messages ORDER BY date ASC")
+    query = f"SELECT {GROUP_MESSAGE_COLUMNS} FROM messages WHERE group_key = ?"
+    params = [group_key]
+    if cursor_values and len(cursor_values) == 2:
+        query += " AND (date_ts, id) < (?, ?)"
+        params.extend(cursor_values)
+    query += " ORDER BY date_ts DESC, id DESC LIMIT ?"
+    params.append(limit + 1)
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(query, params)
     rows = cur.fetchall()
     conn.close()
-    msgs = [dict(r) for r in rows]
-
-    groups = {}
-    for m in msgs:
-        if m.get('chat_title'):
-            key = f"group::{m.get('chat_id')}"
-            title = m.get('chat_title')
-            is_group = True
-        else:
-            uid = m.get('from_user_id') or m.get('chat_id') or (m.get('from_user_name') or 'private')
-            key = f"private::{uid}"
-            title = m.get('from_user_name') or f"Пользователь {uid}"
-            is_group = False
-
-        if key not in groups:
-            groups[key] = {"group_key": key, "chat_id": m.get('chat_id') or m.get('from_user_id'), "chat_title": title, "is_group": is_group, "messages": []}
-        groups[key]['messages'].append({
-            "id": m.get('id'),
-            "from_user_id": m.get('from_user_id'),
-            "from_user_name": m.get('from_user_name'),
-            "text_content": m.get('text_content'),
-            "importance": m.get('importance'),
-            "date": m.get('date'),
-            "source": m.get('source'),
-            "ai_reply": m.get('ai_reply') or ''
-        })
 
-    result = []
-    for gk, g in groups.items():
-        chat_id = str(g.get('chat_id') or '')
-        summary_row = summaries.get(chat_id) or {}
-        # if summary not found, fallback to inline computation (optional)
-        summary = summary_row.get('summary') or ''
-        ai_reply = summary_row.get('ai_reply') or ''
-        priority = int(summary_row.get('priority') or (max((m['importance'] for m in g['messages']), default=3)))
-
-        total_messages = len(g['messages'])
-        total_chars = sum(len(m.get('text_content') or '') for m in g['messages'])
-        collapsed = True if total_chars > 800 or total_messages > 6 else False
-
-        result.append({
-            "group_key": gk,
-            "chat_id": chat_id,
-            "chat_title": g.get('chat_title'),
-            "is_group": g.get('is_group'),
-            "messages": g['messages'],
-            "summary": summary,
-            "ai_reply": ai_reply,
-            "priority": priority,
-            "collapsed": collapsed,
-            "total_messages": total_messages,
-            "total_chars": total_chars
-        })
+    has_more = len(rows) > limit
+    messages = [_format_group_message(r) for r in reversed(rows[:limit])]
+    return jsonify({
+        "group_key": group_key,
+        "messages": messages,
+        "has_more": has_more,
+        "cursor": encode_cursor(messages[0]['date_ts'], messages[0]['id']) if has_more else None
+    })
+
 
-    # сортируем: по приоритету, затем по времени последнего сообщения (новые сверху)
-    def group_sort_key(item):
-        last_date = item['messages'][-1].get('date') if item['messages'] else None
-        ts = 0
-        if last_date:
-            try:
-                ts = datetime.fromisoformat(last_date).timestamp()
-            except:
-                try:
-                    ts = float(last_date)
-                except:
-                    ts = 0
-        return (-int(item['priority']), -int(ts or 0))
+STREAMED_CHECKS = ("export", "export_source", "export_importance_desc", "export_search")
 
-    result_sorted = sorted(result, key=group_sort_key)
-    return jsonify(result_sorted)
+def check_query_plans(conn):
+    """
+    EXPLAIN QUERY PLAN для запросов эндпоинтов: возвращает список запросов,
+    которые читают таблицу полным сканированием вместо индекса. Потоковые запросы выгрузки
+    (STREAMED_CHECKS) не должны и сортировать во временном B-дереве — оно держит в памяти всю выборку.
+    """
+    checks = {
+        "messages": build_messages_query(),
+        "messages_asc": build_messages_query(sort_order='asc'),
+        "messages_cursor": build_messages_query(cursor_values=[1704067200, 1]),
+        "messages_importance": build_messages_query(importance=4),
+        "messages_importance_cursor": build_messages_query(importance=4, cursor_values=[1704067200, 1]),
+        "messages_search": build_messages_query(search='тест'),
+        "messages_source_dates": build_messages_query(source='email', date_from=0, date_to=1704067200),
+        "ingest_dedup": ("SELECT id FROM messages WHERE source = ? AND IFNULL(chat_id, 0) = ? AND message_id = ?", ['email', 0, 'x'], ()),
+        "group_messages": (f"SELECT {GROUP_MESSAGE_COLUMNS} FROM messages WHERE group_key = ? ORDER BY date_ts DESC, id DESC LIMIT ?", ['group::1', 50], ()),
+        "conversations": ("SELECT group_key FROM conversations ORDER BY priority DESC, last_ts DESC", [], ()),
+        "analysis_urgent": ("SELECT id FROM messages WHERE importance >= 4 ORDER BY importance DESC, date_ts DESC LIMIT 8", [], ()),
+        "analysis_window": ("SELECT term, COUNT(*) FROM term_postings WHERE ts >= ? GROUP BY term", [0], ()),
+        "near_dup_bands": ("SELECT message_id FROM minhash_bands WHERE band = ? AND bucket = ? ORDER BY message_id DESC LIMIT ?", [0, 1, 50], ()),
+        "near_dup_copies": ("SELECT message_id FROM message_duplicates WHERE canonical_id IN (?, ?)", [1, 2], ()),
+        "export": build_export_query() + ((),),
+        "export_source": build_export_query(source='email', date_from=0) + ((),),
+        "export_importance_desc": build_export_query(importance=5, sort_order='desc') + ((),),
+        "export_search": build_export_query(search='тест', source='email', date_from=0) + ((),),
+    }
+    problems = []
+    cur = conn.cursor()
+    for name, (query, params, _) in checks.items():
+        cur.execute("EXPLAIN QUERY PLAN " + query, params)
+        for row in cur.fetchall():
+            detail = row[3]
+            if detail.startswith('SCAN ') and 'USING' not in detail and 'VIRTUAL TABLE' not in detail:
+                problems.append(f"{name}: {detail}")
+            elif name in STREAMED_CHECKS and 'TEMP B-TREE' in detail:
+                problems.append(f"{name}: {detail}")
+    return problems
 
 
 if __name__ == '__main__':
     init_db()
-    app.run(debug=True)
+    if '--check-plans' in sys.argv:
+        conn = get_db_connection()
+        problems = check_query_plans(conn)
+        conn.close()
+        for p in problems:
+            print(f"Плохой план запроса: {p}")
+        sys.exit(1 if problems else 0)
+    # в debug Flask перезапускает скрипт дочерним процессом — фоновые службы нужны только в нём
+    if not DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_services()
+    app.run(debug=DEBUG)
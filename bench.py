@@ -0,0 +1,353 @@
+"""
+Бенчмарки: синтетический корпус, задержки эндпоинтов и скорость приёма почты.
+
+    python bench.py run --sizes 10000 100000 --out results.json
+    python bench.py compare baseline.json results.json --threshold 1.25
+
+run:
+- для каждого размера генерирует (или переиспользует из --data-dir) базу с корпусом:
+  кириллица и латиница, групповые и личные чаты, письма, распределение важности,
+  даты за последние 90 дней с разными часовыми поясами; схема — из app.init_db;
+- каждый сценарий запускается в отдельном процессе через тестовый клиент Flask:
+  p50/p95/p99/max задержки в мс и пиковый RSS процесса;
+- приём почты: email_reader.sync_folder против локального fake_imap, писем в секунду.
+Результат — JSON; compare сравнивает два прогона и возвращает 1, если какой-то
+сценарий стал медленнее порога (по p50 или p95).
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+SEED = 20240101
+DAYS = 90
+IMPORTANCE_WEIGHTS = {1: 5, 2: 15, 3: 55, 4: 18, 5: 7}
+TIMEZONES = [timezone.utc, timezone(timedelta(hours=3)), timezone(timedelta(hours=5)), timezone(timedelta(hours=-5))]
+
+RU_WORDS = """отчёт встреча проект задача срочно договор клиент оплата счёт релиз сервер ошибка база
+данных созвон завтра сегодня неделя квартал бюджет план дизайн макет тестирование выкладка
+доступ пароль почта звонок документ подпись согласование презентация команда отпуск ёлка
+поставка склад заказ доставка возврат претензия юрист налог бухгалтерия премия собеседование""".split()
+EN_WORDS = """report meeting project task urgent contract client payment invoice release server error
+database call tomorrow today week quarter budget plan design mockup testing deploy access
+password mail document signature approval presentation team vacation delivery order refund""".split()
+FILLER = "и в на по с для это как что не уже ещё пожалуйста коллеги спасибо ok please thanks".split()
+
+SCENARIOS = {
+    "messages_latest": lambda n, rnd: "/api/messages?limit=50",
+    "messages_importance": lambda n, rnd: f"/api/messages?limit=50&importance={rnd.choice([4, 5])}",
+    "messages_search": lambda n, rnd: f"/api/messages?limit=20&search={rnd.choice(RU_WORDS + EN_WORDS)}",
+    "messages_search_date": lambda n, rnd: f"/api/messages?limit=20&sort_order=desc&search={rnd.choice(RU_WORDS)}",
+    "messages_deep_offset": lambda n, rnd: f"/api/messages?limit=50&offset={int(n * 0.9)}",
+    "grouped_messages_limited": lambda n, rnd: "/api/grouped_messages?messages_limit=20",
+    "grouped_messages_full": lambda n, rnd: "/api/grouped_messages",
+    "analysis": lambda n, rnd: "/api/analysis",
+    "analysis_day": lambda n, rnd: "/api/analysis?window=day",
+}
+# полный список переписок отдаёт всю историю — на больших корпусах это не замер, а выгрузка
+FULL_HISTORY_MAX = 100000
+
+
+# === Корпус ===
+def synthetic_rows(n, seed=SEED, now=None):
+    """Детерминированный поток строк messages (при одинаковых n, seed и now)."""
+    rnd = random.Random(seed)
+    now = now or datetime.now(timezone.utc).replace(microsecond=0)
+    group_chats = [(-1000000 - i, f"{rnd.choice(['Команда', 'Проект', 'Team', 'Отдел'])} {rnd.choice(RU_WORDS + EN_WORDS)} {i}")
+                   for i in range(max(5, n // 2000))]
+    users = [(100 + i, rnd.choice(["Иван", "Мария", "Alex", "Ольга", "John", "Пётр"]) + f" {i}")
+             for i in range(max(20, n // 500))]
+    importances = list(IMPORTANCE_WEIGHTS)
+    weights = list(IMPORTANCE_WEIGHTS.values())
+
+    for i in range(n):
+        kind = rnd.random()
+        words = RU_WORDS if rnd.random() < 0.75 else EN_WORDS
+        text = " ".join(rnd.choice(words) if rnd.random() < 0.6 else rnd.choice(FILLER)
+                        for _ in range(rnd.randint(4, 40)))
+        moment = now - timedelta(seconds=rnd.randint(0, DAYS * 86400))
+        date = moment.astimezone(rnd.choice(TIMEZONES)).isoformat()
+        user_id, user_name = rnd.choice(users)
+        row = {
+            "text_content": text,
+            "date": date,
+            "importance": rnd.choices(importances, weights)[0],
+            "message_id": str(i),
+        }
+        if kind < 0.6:
+            chat_id, title = rnd.choice(group_chats)
+            row.update(source="telegram", chat_id=chat_id, chat_title=title, from_user_id=user_id, from_user_name=user_name)
+        elif kind < 0.85:
+            row.update(source="telegram", chat_id=user_id, chat_title="", from_user_id=user_id, from_user_name=user_name)
+        else:
+            row.update(source="email", chat_title=f"{rnd.choice(['Re:', 'Fwd:', ''])} {rnd.choice(words)} {rnd.choice(words)}".strip(),
+                       from_user_name=f"{user_name} (user{user_id}@example.com)", message_id=f"<bench-{i}@example.com>")
+        yield row
+
+
+def corpus_path(data_dir, size, seed):
+    return os.path.join(data_dir, f"corpus_{size}_{seed}.db")
+
+
+def build_corpus(database, size, seed):
+    """Создаёт базу корпуса (или переиспользует готовую) и возвращает её описание."""
+    os.environ["DATABASE_PATH"] = database
+    import app as web
+    import storage
+    import term_stats
+    from ingest_writer import IngestWriter
+
+    web.init_db()
+    conn = storage.connect(database)
+    conn.execute("CREATE TABLE IF NOT EXISTS bench_meta (key TEXT PRIMARY KEY, value TEXT)")
+    meta = dict(conn.execute("SELECT key, value FROM bench_meta").fetchall())
+    if meta.get("size") == str(size) and meta.get("seed") == str(seed):
+        conn.close()
+        return {"reused": True, "generated_at": meta.get("generated_at"), "generate_sec": float(meta.get("generate_sec", 0))}
+
+    started = time.perf_counter()
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    with IngestWriter(database, batch_size=5000, flush_interval=3600) as writer:
+        for row in synthetic_rows(size, seed, now):
+            writer.add(row)
+    term_stats.process_queue(conn)
+    conn.execute("DELETE FROM message_changes")
+    conn.execute("ANALYZE")
+    elapsed = round(time.perf_counter() - started, 2)
+    conn.executemany("INSERT OR REPLACE INTO bench_meta (key, value) VALUES (?, ?)", [
+        ("size", str(size)), ("seed", str(seed)), ("generated_at", now.isoformat()), ("generate_sec", str(elapsed)),
+    ])
+    conn.commit()
+    conn.close()
+    return {"reused": False, "generated_at": now.isoformat(), "generate_sec": elapsed}
+
+
+# === Замеры (каждый — в отдельном процессе, чтобы RSS был своим) ===
+def percentiles(samples):
+    samples = sorted(samples)
+
+    def pick(p):
+        return round(samples[min(len(samples) - 1, int(round(p * (len(samples) - 1))))] * 1000, 3)
+    return {
+        "count": len(samples),
+        "p50_ms": pick(0.50),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": round(samples[-1] * 1000, 3),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss в Linux — КиБ, в macOS — байты
+    value = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(value / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_scenario(database, size, name, iterations, warmup, seed, result_queue):
+    os.environ["DATABASE_PATH"] = database
+    try:
+        import app as web
+
+        client = web.app.test_client()
+        rnd = random.Random(seed)
+        rss_before = peak_rss_mb()
+        samples, bytes_out, errors = [], 0, 0
+        for i in range(warmup + iterations):
+            url = SCENARIOS[name](size, rnd)
+            started = time.perf_counter()
+            response = client.get(url)
+            body = response.get_data()
+            elapsed = time.perf_counter() - started
+            if response.status_code != 200:
+                errors += 1
+            if i >= warmup:
+                samples.append(elapsed)
+                bytes_out += len(body)
+        result = dict(percentiles(samples), errors=errors, avg_bytes=bytes_out // max(1, len(samples)),
+                      rss_start_mb=rss_before, peak_rss_mb=peak_rss_mb())
+    except Exception as e:
+        result = {"error": repr(e)}
+    result_queue.put(result)
+
+
+def run_ingest(count, batch, result_queue):
+    workdir = tempfile.mkdtemp(prefix="bench_ingest_")
+    os.environ["DATABASE_PATH"] = os.path.join(workdir, "messages.db")
+    os.environ["IMAP_FETCH_BATCH"] = str(batch)
+    try:
+        import app as web
+        import email_reader
+        from fake_imap import FakeIMAPServer, make_email
+
+        web.init_db()
+        email_reader.init_sync_state()
+        server = FakeIMAPServer().start()
+        for i in range(count):
+            server.mailbox.add(make_email(i))
+        account = email_reader.Account("bench@example.com", "x", "127.0.0.1", server.port, False, ["INBOX"])
+
+        rss_before = peak_rss_mb()
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            mail = email_reader.connect_to_email(account)
+            saved = email_reader.sync_folder(mail, account.address, "INBOX")
+            mail.logout()
+        elapsed = time.perf_counter() - started
+        server.shutdown()
+        result = {
+            "messages": count,
+            "saved": saved,
+            "batch": batch,
+            "seconds": round(elapsed, 3),
+            "messages_per_sec": round(saved / elapsed, 1) if elapsed else None,
+            "imap_bytes": server.bytes_sent,
+            "rss_start_mb": rss_before,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+    except Exception as e:
+        result = {"error": repr(e)}
+    result_queue.put(result)
+
+
+def in_subprocess(target, *args):
+    ctx = multiprocessing.get_context("spawn")
+    result_queue = ctx.Queue()
+    process = ctx.Process(target=target, args=args + (result_queue,))
+    process.start()
+    result = result_queue.get()
+    process.join()
+    return result
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def command_run(args):
+    os.makedirs(args.data_dir, exist_ok=True)
+    report = {"environment": environment(), "seed": args.seed, "iterations": args.iterations, "corpora": {}}
+    scenarios = args.scenarios or list(SCENARIOS)
+
+    for size in args.sizes:
+        database = corpus_path(args.data_dir, size, args.seed)
+        print(f"Корпус {size}: {database}", file=sys.stderr)
+        corpus = in_subprocess(build_corpus_entry, database, size, args.seed)
+        corpus["db_size_mb"] = round(os.path.getsize(database) / (1024 * 1024), 1)
+        corpus["scenarios"] = {}
+        for name in scenarios:
+            if name == "grouped_messages_full" and size > FULL_HISTORY_MAX:
+                corpus["scenarios"][name] = {"skipped": f"корпус больше {FULL_HISTORY_MAX}"}
+                continue
+            print(f"  {name}", file=sys.stderr)
+            corpus["scenarios"][name] = in_subprocess(run_scenario, database, size, name, args.iterations, args.warmup, args.seed)
+        report["corpora"][str(size)] = corpus
+
+    if args.ingest:
+        print(f"Приём почты: {args.ingest} писем", file=sys.stderr)
+        report["ingest"] = in_subprocess(run_ingest, args.ingest, args.ingest_batch)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+def build_corpus_entry(database, size, seed, result_queue):
+    try:
+        result = build_corpus(database, size, seed)
+    except Exception as e:
+        result = {"error": repr(e)}
+    result_queue.put(result)
+
+
+def compare_reports(base, new, threshold, min_delta_ms=0.5):
+    """
+    [(где, метрика, было, стало, отношение, регрессия?)] по общим сценариям двух прогонов.
+    Замедление меньше min_delta_ms регрессией не считается — на субмиллисекундных запросах это шум.
+    """
+    rows = []
+    for size, corpus in new.get("corpora", {}).items():
+        old_corpus = base.get("corpora", {}).get(size, {})
+        for name, stats in corpus.get("scenarios", {}).items():
+            old = old_corpus.get("scenarios", {}).get(name, {})
+            for metric in ("p50_ms", "p95_ms", "p99_ms", "peak_rss_mb"):
+                if metric in stats and old.get(metric):
+                    ratio = stats[metric] / old[metric]
+                    rows.append((f"{size}/{name}", metric, old[metric], stats[metric], ratio,
+                                 metric in ("p50_ms", "p95_ms") and ratio > threshold
+                                 and stats[metric] - old[metric] >= min_delta_ms))
+    old_ingest, new_ingest = base.get("ingest", {}), new.get("ingest", {})
+    if old_ingest.get("messages_per_sec") and new_ingest.get("messages_per_sec"):
+        ratio = old_ingest["messages_per_sec"] / new_ingest["messages_per_sec"]
+        rows.append(("ingest", "messages_per_sec", old_ingest["messages_per_sec"], new_ingest["messages_per_sec"],
+                     ratio, ratio > threshold))
+    return rows
+
+
+def command_compare(args):
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+    rows = compare_reports(base, new, args.threshold, args.min_delta_ms)
+    for where, metric, old, value, ratio, regressed in rows:
+        print(f"{'!!' if regressed else '  '} {where:45} {metric:17} {old:>10} → {value:<10} x{ratio:.2f}")
+    regressions = [r for r in rows if r[5]]
+    print(f"Регрессий: {len(regressions)} (порог x{args.threshold})")
+    sys.exit(1 if regressions else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки эндпоинтов и приёма почты")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="прогнать замеры и вывести JSON")
+    run.add_argument("--sizes", type=int, nargs="+", default=[10000], help="размеры корпусов: 10000 100000 1000000")
+    run.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), help="по умолчанию — все")
+    run.add_argument("--iterations", type=int, default=30)
+    run.add_argument("--warmup", type=int, default=3)
+    run.add_argument("--seed", type=int, default=SEED)
+    run.add_argument("--data-dir", default="bench_data", help="где хранить сгенерированные корпуса")
+    run.add_argument("--ingest", type=int, default=2000, help="писем для замера приёма почты (0 — не мерить)")
+    run.add_argument("--ingest-batch", type=int, default=100)
+    run.add_argument("--out", help="файл для JSON-результата")
+    run.set_defaults(func=command_run)
+
+    compare = sub.add_parser("compare", help="сравнить два JSON-результата")
+    compare.add_argument("base")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=1.25, help="во сколько раз медленнее считать регрессией")
+    compare.add_argument("--min-delta-ms", type=float, default=0.5, help="минимальное замедление в мс, чтобы считать регрессией")
+    compare.set_defaults(func=command_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
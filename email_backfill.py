@@ -0,0 +1,328 @@
+"""
+Первичная загрузка большого ящика: параллельно по нескольким IMAP-соединениям и ядрам.
+
+Обычный email_reader забирает письма одним соединением и разбирает их в одном потоке —
+для ящика на 100k писем это часы. Здесь:
+
+1. список UID папки (UID SEARCH ALL) режется на куски по UID: кусок = uid // BACKFILL_CHUNK;
+2. BACKFILL_CONNECTIONS потоков, у каждого своё соединение, забирают куски из очереди
+   (структура + заголовки + текстовая часть, как в email_reader.fetch_raw);
+3. MIME, заголовки, текст и важность разбираются в пуле из BACKFILL_WORKERS процессов;
+4. готовые строки пишет один IngestWriter пачками по BACKFILL_WRITE_BATCH;
+5. кусок отмечается в imap_backfill_chunks только после того, как все его строки записаны.
+
+Прерванная загрузка продолжается с того же места: сделанные куски пропускаются, а повтор
+незаписанного куска безопасен — дубли отсекает уникальный индекс IngestWriter. Смена UIDVALIDITY
+делает старые отметки недействительными. По завершении last_uid в imap_sync_state сдвигается
+на конец папки, и обычный email_reader продолжает с новых писем.
+
+    python email_backfill.py                               # все папки первого ящика
+    python email_backfill.py --account me@mail.ru --folder Archive --connections 4 --workers 8
+    python email_backfill.py --restart                     # забыть отметки и пройти папку заново
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+import email_reader
+import metrics
+import storage
+from ingest_writer import IngestWriter, INGESTED
+
+load_dotenv()
+
+BACKFILL_CONNECTIONS = int(os.getenv("BACKFILL_CONNECTIONS", "4"))    # одновременных IMAP-соединений
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS") or os.cpu_count() or 2)
+BACKFILL_CHUNK = int(os.getenv("BACKFILL_CHUNK", str(email_reader.FETCH_BATCH)))   # UID на кусок — единица работы и отметки
+BACKFILL_WRITE_BATCH = int(os.getenv("BACKFILL_WRITE_BATCH", "1000"))
+PROGRESS_INTERVAL = 10     # секунд между строками прогресса
+FETCH_RETRIES = 3          # попыток на кусок (с переподключением), потом он остаётся на следующий запуск
+
+DATABASE = storage.DATABASE
+
+REMAINING = metrics.gauge("email_backfill_remaining", "Писем, которые осталось загрузить первичной загрузкой")
+CHUNK_SECONDS = metrics.histogram("email_backfill_chunk_seconds", "Загрузка куска писем с сервера", ("result",))
+
+
+def init_schema():
+    storage.write(lambda conn: conn.execute("""
+        CREATE TABLE IF NOT EXISTS imap_backfill_chunks (
+            account TEXT NOT NULL,
+            folder TEXT NOT NULL,
+            uidvalidity INTEGER NOT NULL,
+            chunk INTEGER NOT NULL,
+            messages INTEGER NOT NULL,
+            done_at TEXT,
+            PRIMARY KEY (account, folder, uidvalidity, chunk)
+        ) WITHOUT ROWID
+    """), database=DATABASE)
+
+
+def load_done_chunks(account, folder, uidvalidity):
+    conn = storage.get_connection(DATABASE)
+    try:
+        rows = conn.execute(
+            "SELECT chunk FROM imap_backfill_chunks WHERE account = ? AND folder = ? AND uidvalidity = ?",
+            (account, folder, uidvalidity)
+        ).fetchall()
+    finally:
+        conn.close()
+    return {r[0] for r in rows}
+
+
+def forget_chunks(account, folder):
+    storage.write(lambda conn: conn.execute(
+        "DELETE FROM imap_backfill_chunks WHERE account = ? AND folder = ?", (account, folder)), database=DATABASE)
+
+
+def mark_chunks_done(conn, account, folder, uidvalidity, chunks):
+    now = datetime.utcnow().isoformat()
+    storage.write(lambda c: c.executemany(
+        "INSERT OR REPLACE INTO imap_backfill_chunks (account, folder, uidvalidity, chunk, messages, done_at) VALUES (?, ?, ?, ?, ?, ?)",
+        [(account, folder, uidvalidity, chunk, count, now) for chunk, count in chunks]
+    ), conn=conn)
+
+
+def open_folder(account, folder):
+    """Соединение с открытой (только чтение) папкой и её UIDVALIDITY."""
+    mail = email_reader.connect_to_email(account)
+    status, _ = email_reader.imap_call('SELECT', mail.select, folder, readonly=True)
+    if status != 'OK':
+        mail.logout()
+        raise RuntimeError(f"Не удалось открыть папку {folder}")
+    _, values = mail.response('UIDVALIDITY')
+    return mail, int(values[0]) if values and values[0] else None
+
+
+def list_chunks(mail):
+    """UID папки, разложенные по кускам: {номер куска: [uid]}."""
+    status, data = email_reader.imap_call('UID SEARCH', mail.uid, 'SEARCH', None, 'ALL')
+    if status != 'OK':
+        raise RuntimeError("Не удалось получить список писем")
+    chunks = {}
+    for uid in (int(u) for u in data[0].split()):
+        chunks.setdefault(uid // BACKFILL_CHUNK, []).append(uid)
+    return chunks
+
+
+def close_quietly(mail):
+    try:
+        mail.logout()
+    except Exception:
+        pass
+
+
+def fetcher(account, folder, uidvalidity, tasks, results, stop_event):
+    """Поток загрузки: своё соединение, куски из tasks → (кусок, [RawMessage] или None) в results."""
+    mail = None
+    while not stop_event.is_set():
+        try:
+            chunk, uids = tasks.get_nowait()
+        except queue.Empty:
+            break
+        fetched = None
+        for attempt in range(FETCH_RETRIES):
+            started = time.perf_counter()
+            try:
+                if mail is None:
+                    mail, validity = open_folder(account, folder)
+                    if validity != uidvalidity:
+                        print(f"UIDVALIDITY папки {folder} сменился во время загрузки — остановка")
+                        stop_event.set()
+                        break
+                fetched = email_reader.fetch_raw(mail, uids)
+                CHUNK_SECONDS.observe(time.perf_counter() - started, result="ok" if fetched is not None else "error")
+                if fetched is not None:
+                    break
+            except Exception as e:
+                CHUNK_SECONDS.observe(time.perf_counter() - started, result="error")
+                print(f"Ошибка загрузки писем {uids[0]}..{uids[-1]} (попытка {attempt + 1}): {e}")
+                if mail is not None:
+                    close_quietly(mail)
+                mail = None
+                time.sleep(min(email_reader.MAX_BACKOFF, 2 ** attempt))
+        results.put((chunk, uids, fetched))
+    if mail is not None:
+        close_quietly(mail)
+
+
+class Progress:
+    """Скорость и оставшееся время по записанным письмам; строка раз в PROGRESS_INTERVAL секунд."""
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.inserted = 0
+        self.started = time.monotonic()
+        self.last_report = self.started
+
+    def add(self, messages, inserted_total):
+        self.done += messages
+        self.inserted = inserted_total
+        REMAINING.set(self.total - self.done)
+
+    def line(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        rate = self.done / elapsed
+        eta = int((self.total - self.done) / rate) if rate else None
+        eta_text = f"{eta // 3600}:{eta % 3600 // 60:02d}:{eta % 60:02d}" if eta is not None else '—'
+        percent = 100 * self.done / self.total if self.total else 100
+        return (f"{self.done}/{self.total} писем ({percent:.1f}%), новых {self.inserted}, "
+                f"{rate:.0f} писем/с, осталось ≈ {eta_text}")
+
+    def maybe_report(self):
+        if time.monotonic() - self.last_report >= PROGRESS_INTERVAL:
+            self.last_report = time.monotonic()
+            print(self.line())
+
+
+def run(account, folder, connections=BACKFILL_CONNECTIONS, workers=BACKFILL_WORKERS,
+        write_batch=BACKFILL_WRITE_BATCH, restart=False):
+    """Загружает папку целиком; возвращает {"messages", "inserted", "failed_chunks"}."""
+    init_schema()
+    email_reader.init_sync_state()
+    if restart:
+        forget_chunks(account.address, folder)
+
+    mail, uidvalidity = open_folder(account, folder)
+    try:
+        chunks = list_chunks(mail)
+    finally:
+        close_quietly(mail)
+    done = load_done_chunks(account.address, folder, uidvalidity)
+    todo = [(chunk, uids) for chunk, uids in sorted(chunks.items()) if chunk not in done]
+    total = sum(len(uids) for _, uids in todo)
+    print(f"Папка {folder}: {sum(len(u) for u in chunks.values())} писем, "
+          f"к загрузке {total} в {len(todo)} кусках (уже загружено кусков: {len(chunks) - len(todo)})")
+
+    tasks = queue.Queue()
+    for item in todo:
+        tasks.put(item)
+    # очередь ограничена: загрузка не убегает вперёд разбора и не копит письма в памяти
+    results = queue.Queue(maxsize=max(2, workers * 2))
+    stop_event = threading.Event()
+    threads = [threading.Thread(target=fetcher, args=(account, folder, uidvalidity, tasks, results, stop_event),
+                                name=f"imap-backfill-{i}", daemon=True)
+               for i in range(max(1, min(connections, len(todo))))]
+    for t in threads:
+        t.start()
+
+    progress = Progress(total)
+    failed = []
+    written = []        # (кусок, писем, позиция его последней строки у writer'а) — отмечаются после записи
+    in_flight = {}      # future → (кусок, uid, загруженные uid)
+    # spawn, а не fork: в процессе уже работают потоки загрузки и открыто соединение с базой
+    with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context("spawn")) as pool, \
+            IngestWriter(DATABASE, batch_size=write_batch, flush_interval=PROGRESS_INTERVAL) as writer:
+
+        queued = [0]       # сколько строк передано writer'у с начала загрузки
+
+        def flushed():
+            # writer пишет строки по порядку: записано total_inserted + total_skipped первых строк,
+            # значит, готов каждый кусок, последняя строка которого не дальше этой позиции
+            position = writer.total_inserted + writer.total_skipped
+            ready = [(chunk, count) for chunk, count, end in written if end <= position]
+            if ready:
+                mark_chunks_done(writer.conn, account.address, folder, uidvalidity, ready)
+                written[:] = [w for w in written if w[2] > position]
+
+        def collect(block):
+            finished, _ = wait(list(in_flight), timeout=0.5 if block else 0, return_when=FIRST_COMPLETED)
+            for future in finished:
+                chunk, uids, fetched_uids = in_flight.pop(future)
+                try:
+                    rows = future.result()
+                except Exception as e:
+                    print(f"Ошибка разбора писем {uids[0]}..{uids[-1]}: {e}")
+                    failed.append(chunk)
+                    continue
+                for _, row in rows:
+                    writer.add(row)
+                queued[0] += len(rows)
+                unparsed = fetched_uids - {uid for uid, _ in rows}
+                if unparsed:
+                    # строки куска записываются, но отметки нет — следующий запуск попробует его снова
+                    print(f"Не разобраны письма {sorted(unparsed)[:10]} — кусок {chunk} будет повторён")
+                    failed.append(chunk)
+                else:
+                    written.append((chunk, len(uids), queued[0]))
+                flushed()
+                progress.add(len(uids), writer.total_inserted)
+            progress.maybe_report()
+
+        try:
+            while any(t.is_alive() for t in threads) or not results.empty() or in_flight:
+                try:
+                    chunk, uids, fetched = results.get(timeout=0.2)
+                except queue.Empty:
+                    if in_flight:
+                        collect(block=True)
+                    continue
+                if fetched is None:
+                    failed.append(chunk)
+                else:
+                    INGESTED.inc(len(fetched), source='email', result='fetched')
+                    in_flight[pool.submit(email_reader.parse_raw_batch, fetched)] = (chunk, uids, {m.uid for m in fetched})
+                collect(block=False)
+                # не больше двух пачек на процесс: остальное ждёт в results, а загрузчики — на put
+                while len(in_flight) >= workers * 2:
+                    collect(block=True)
+        except BaseException:
+            # Ctrl+C: загрузчики больше не берут куски; уже переданное дописывается и отмечается,
+            # остальные куски пройдут при следующем запуске
+            stop_event.set()
+            try:
+                writer.flush()
+                flushed()
+            except Exception as e:
+                print(f"Не удалось дописать последнюю пачку: {e}")
+            raise
+
+        writer.flush()
+        flushed()
+        progress.add(0, writer.total_inserted)
+
+    for t in threads:
+        t.join()
+    print(progress.line())
+    if failed or stop_event.is_set() or not tasks.empty():
+        print(f"Загружено не всё (кусков с ошибкой: {len(failed)}) — повторный запуск продолжит с места остановки")
+    else:
+        # вся папка в базе: обычная синхронизация продолжает с её конца
+        saved_validity, last_uid = email_reader.load_sync_state(account.address, folder)
+        max_uid = max((u for uids in chunks.values() for u in uids), default=0)
+        if saved_validity not in (None, uidvalidity):
+            last_uid = 0
+        email_reader.save_sync_state(account.address, folder, uidvalidity, max(last_uid, max_uid))
+    return {"messages": progress.done, "inserted": progress.inserted, "failed_chunks": len(failed)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Первичная загрузка почтового ящика в несколько потоков и процессов")
+    parser.add_argument('--account', help="адрес ящика из EMAIL_ACCOUNTS_FILE; по умолчанию — первый")
+    parser.add_argument('--folder', help="папка; по умолчанию — все папки ящика")
+    parser.add_argument('--connections', type=int, default=BACKFILL_CONNECTIONS)
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS)
+    parser.add_argument('--write-batch', type=int, default=BACKFILL_WRITE_BATCH)
+    parser.add_argument('--restart', action='store_true', help="забыть отметки о загруженных кусках")
+    args = parser.parse_args()
+
+    metrics.start_file_export("email_backfill")
+    accounts = email_reader.load_accounts()
+    account = next((a for a in accounts if a.address == args.account), None) if args.account else accounts[0]
+    if account is None:
+        parser.error(f"ящик {args.account} не найден")
+    for folder in [args.folder] if args.folder else account.folders:
+        stats = run(account, folder, args.connections, args.workers, args.write_batch, args.restart)
+        print(f"{account.address}/{folder}: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,17 @@ from email.header import decode_header
 import time
 import os
 from datetime import datetime
-import sqlite3
 import json
+import re
+import select
+import threading
+from collections import namedtuple
 from dotenv import load_dotenv
+from ingest_writer import IngestWriter, INGESTED, date_to_epoch
+import importance
+import imap_fetch
+import metrics
+import storage
 
 load_dotenv()
 
@@ -14,21 +22,42 @@ EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS")
 EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 IMAP_SERVER = os.getenv("IMAP_SERVER", "imap.mail.com")
 IMAP_PORT = int(os.getenv("IMAP_PORT", "993"))
+IMAP_SSL = os.getenv("IMAP_SSL", "true").lower() != "false"
+IMAP_FOLDER = os.getenv("IMAP_FOLDER", "INBOX")
+FETCH_BATCH = int(os.getenv("IMAP_FETCH_BATCH", "100"))  # сколько писем забирать одним UID FETCH
+MAX_BODY_BYTES = int(os.getenv("IMAP_MAX_BODY_BYTES", str(256 * 1024)))  # сколько байт текстовой части скачивать
+MAX_UID_ATTEMPTS = int(os.getenv("IMAP_MAX_UID_ATTEMPTS", "5"))  # после стольких неудач письмо пропускается
 
-DATABASE = "messages.db"
+EMAIL_MODE = os.getenv("EMAIL_MODE", "idle")  # idle — постоянные соединения с IDLE, poll — опрос раз в минуту
+EMAIL_ACCOUNTS_FILE = os.getenv("EMAIL_ACCOUNTS_FILE")  # JSON со списком ящиков (см. load_accounts)
+IDLE_TIMEOUT = int(os.getenv("IMAP_IDLE_TIMEOUT", str(25 * 60)))  # RFC 2177: перезапускать IDLE чаще 29 минут
+NOOP_INTERVAL = float(os.getenv("IMAP_NOOP_INTERVAL", "5"))      # опрос NOOP, если сервер не умеет IDLE
+MAX_BACKOFF = 300
+
+FETCH_UID_RE = re.compile(rb'UID (\d+)')
+HEADERS_ITEMS = '(UID RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER])'
+HEADERS_CONTENT_TYPE = "text/rfc822-headers"   # в message_raw — только заголовки: тело целиком не скачивается
+
+CYCLE_SECONDS = metrics.histogram("ingest_cycle_seconds", "Длительность синхронизации папки", ("source",))
+# _count гистограммы — число обращений к серверу (каждая команда — один round-trip)
+IMAP_COMMAND_SECONDS = metrics.histogram("imap_command_seconds", "Время команд IMAP", ("command",))
+FETCHED_BYTES = metrics.counter("imap_fetched_bytes_total", "Скачано с сервера: размер писем целиком и реально загруженное",
+                                ("kind",))
+CONNECTIONS = metrics.counter("imap_connections_total", "Подключения к IMAP-серверу", ("result",))
+
+Account = namedtuple("Account", ["address", "password", "server", "port", "ssl", "folders"])
+
+DATABASE = storage.DATABASE
 
 def calculate_importance(notification):
-    importance = 3
-    if notification.from_email in ["boss@company.com", "ceo@example.com"]:
-        importance = 5
-    elif any(word in notification.text_content.lower() for word in ["срочно", "важно", "пожалуйста"]):
-        importance = 4
-    elif any(word in notification.chat_title.lower() for word in ["срочное", "важное"]):
-        importance = 4
-    return importance
+    """Важность письма по общим правилам (importance.py) — так же посчитает и пересчёт истории."""
+    row = notification_to_row(notification)
+    row["date_ts"] = date_to_epoch(notification.date)
+    return importance.score_row(row)
 
 class Notification:
-    def __init__(self, source, from_email, from_name, chat_title, text_content, date, message_id, raw_message, importance=3):
+    def __init__(self, source, from_email, from_name, chat_title, text_content, date, message_id, raw_message, importance=3,
+                 raw_content_type="message/rfc822"):
         self.source = source
         self.from_email = from_email
         self.from_name = from_name
@@ -37,48 +66,93 @@ class Notification:
         self.date = date
         self.message_id = message_id
         self.raw_message = raw_message
+        self.raw_content_type = raw_content_type
         self.importance = importance
+        self.importance_source = None
         self.status = 'unread'
 
-def message_exists_in_db(notification):
-    conn = sqlite3.connect(DATABASE)
+def notification_to_row(notification):
+    display_name = f"{notification.from_name} ({notification.from_email})" if notification.from_name else notification.from_email
+    return {
+        "source": notification.source,
+        "from_user_name": display_name,
+        "chat_title": notification.chat_title,
+        "text_content": notification.text_content,
+        "date": notification.date,
+        "message_id": notification.message_id,
+        "raw_message": notification.raw_message,     # письмо или его заголовки, хранится сжатым в message_raw
+        "raw_content_type": notification.raw_content_type,
+        "importance": notification.importance,
+        "importance_source": notification.importance_source,
+    }
+
+# === Состояние синхронизации: UIDVALIDITY и последний обработанный UID по ящику/папке ===
+def init_sync_state():
+    def create(conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS imap_sync_state (
+                account TEXT NOT NULL,
+                folder TEXT NOT NULL,
+                uidvalidity INTEGER,
+                last_uid INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT,
+                PRIMARY KEY (account, folder)
+            )
+        """)
+        # письма, которые не удалось получить или разобрать: сколько раз пробовали
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS imap_failed_uids (
+                account TEXT NOT NULL,
+                folder TEXT NOT NULL,
+                uidvalidity INTEGER NOT NULL,
+                uid INTEGER NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT,
+                PRIMARY KEY (account, folder, uidvalidity, uid)
+            ) WITHOUT ROWID
+        """)
+    storage.write(create, database=DATABASE)
+
+def load_sync_state(account, folder):
+    conn = storage.get_connection(DATABASE)
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT id FROM messages
-        WHERE message_id = ? AND source = ?
-    """, (notification.message_id, notification.source))
-    result = cursor.fetchone()
+    cursor.execute("SELECT uidvalidity, last_uid FROM imap_sync_state WHERE account = ? AND folder = ?", (account, folder))
+    row = cursor.fetchone()
     conn.close()
-    return result is not None
+    return (row[0], row[1]) if row else (None, 0)
 
-def save_message_to_db(notification):
-    if message_exists_in_db(notification):
-        print(f"Письмо с ID {notification.message_id} уже существует в базе.")
-        return None
+def save_sync_state(account, folder, uidvalidity, last_uid):
+    storage.write(lambda conn: conn.execute("""
+        INSERT INTO imap_sync_state (account, folder, uidvalidity, last_uid, updated_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(account, folder) DO UPDATE SET
+            uidvalidity = excluded.uidvalidity, last_uid = excluded.last_uid, updated_at = excluded.updated_at
+    """, (account, folder, uidvalidity, last_uid, datetime.utcnow().isoformat())), database=DATABASE)
 
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
+def record_failed_uids(account, folder, uidvalidity, uids):
+    """
+    +1 попытка для каждого UID; возвращает те, что исчерпали MAX_UID_ATTEMPTS, —
+    их курсор пропускает, иначе одно битое письмо заставляло бы каждый цикл
+    заново качать его и всё, что после него.
+    """
+    now = datetime.utcnow().isoformat()
 
-    display_name = f"{notification.from_name} ({notification.from_email})" if notification.from_name else notification.from_email
+    def record(conn):
+        conn.executemany("""
+            INSERT INTO imap_failed_uids (account, folder, uidvalidity, uid, attempts, updated_at) VALUES (?, ?, ?, ?, 1, ?)
+            ON CONFLICT(account, folder, uidvalidity, uid) DO UPDATE SET attempts = attempts + 1, updated_at = excluded.updated_at
+        """, [(account, folder, uidvalidity or 0, uid, now) for uid in uids])
+        rows = conn.execute(
+            f"SELECT uid FROM imap_failed_uids WHERE account = ? AND folder = ? AND uidvalidity = ? "
+            f"AND attempts >= ? AND uid IN ({','.join('?' * len(uids))})",
+            [account, folder, uidvalidity or 0, MAX_UID_ATTEMPTS] + list(uids)).fetchall()
+        return {r[0] for r in rows}
+    return storage.write(record, database=DATABASE)
 
-    cursor.execute("""
-        INSERT INTO messages (
-            source, from_user_name, chat_title, text_content, date, message_id, raw_message, importance
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        notification.source,
-        display_name,
-        notification.chat_title,
-        notification.text_content,
-        notification.date,
-        notification.message_id,
-        json.dumps(notification.raw_message),
-        notification.importance
-    ))
-    conn.commit()
-    msg_id = cursor.lastrowid
-    conn.close()
-    return msg_id
+def forget_failed_uids(account, folder, uidvalidity, uids):
+    storage.write(lambda conn: conn.execute(
+        f"DELETE FROM imap_failed_uids WHERE account = ? AND folder = ? AND uidvalidity = ? "
+        f"AND uid IN ({','.join('?' * len(uids))})",
+        [account, folder, uidvalidity or 0] + list(uids)), database=DATABASE)
 
 def decode_mime_words(s):
     if s is None:
@@ -91,68 +165,394 @@ def decode_mime_words(s):
         parts.append(fragment)
     return ''.join(parts)
 
-def connect_to_email():
-    mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
-    mail.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
+def load_accounts():
+    """
+    Ящики для синхронизации. EMAIL_ACCOUNTS_FILE — JSON-список объектов
+    {"address", "password", "server", "port", "ssl", "folders"}; недостающие поля
+    берутся из переменных IMAP_*. Без файла — один ящик из EMAIL_ADDRESS.
+    """
+    if not EMAIL_ACCOUNTS_FILE:
+        return [Account(EMAIL_ADDRESS, EMAIL_PASSWORD, IMAP_SERVER, IMAP_PORT, IMAP_SSL, [IMAP_FOLDER])]
+    with open(EMAIL_ACCOUNTS_FILE, encoding='utf-8') as f:
+        items = json.load(f)
+    return [Account(
+        item["address"],
+        item["password"],
+        item.get("server", IMAP_SERVER),
+        int(item.get("port", IMAP_PORT)),
+        str(item.get("ssl", IMAP_SSL)).lower() != "false",   # true/false в JSON или "false" строкой, как IMAP_SSL
+        item.get("folders") or [IMAP_FOLDER],
+    ) for item in items]
+
+def imap_call(command, fn, *args, **kwargs):
+    """Команда IMAP с замером времени."""
+    with metrics.timer(IMAP_COMMAND_SECONDS, command=command):
+        return fn(*args, **kwargs)
+
+def connect_to_email(account=None):
+    account = account or load_accounts()[0]
+    try:
+        if account.ssl:
+            mail = imap_call('CONNECT', imaplib.IMAP4_SSL, account.server, account.port)
+        else:
+            mail = imap_call('CONNECT', imaplib.IMAP4, account.server, account.port)
+        imap_call('LOGIN', mail.login, account.address, account.password)
+    except Exception:
+        CONNECTIONS.inc(result="error")
+        raise
+    CONNECTIONS.inc(result="ok")
     return mail
 
-def fetch_unread_emails():
+def build_notification(raw_email, uid, body=None, raw_content_type="message/rfc822"):
+    """raw_email — письмо целиком или только заголовки; во втором случае текст передаётся в body."""
+    msg = email.message_from_bytes(raw_email)
+
+    from_header = msg.get("From", "")
+    from_name, from_email = parse_email_address(from_header)
+
+    subject = decode_mime_words(msg.get("Subject", ""))
+    date_str = msg.get("Date", "")
+    try:
+        email_date = email.utils.parsedate_to_datetime(date_str)
+        date_iso = email_date.isoformat()
+    except:
+        date_iso = datetime.utcnow().isoformat()
+
+    if body is None:
+        body = get_email_body(msg)
+    message_id = msg.get("Message-ID", str(uid))
+
+    notification = Notification(
+        source='email',
+        from_email=from_email,
+        from_name=from_name,
+        chat_title=subject,
+        text_content=body,
+        date=date_iso,
+        message_id=message_id,
+        raw_message=raw_email,
+        raw_content_type=raw_content_type
+    )
+    notification.importance = calculate_importance(notification)
+    notification.importance_source = importance.RULES_SOURCE
+    return notification
+
+def parse_fetch_response(data):
+    """Ответ UID FETCH на пачку писем → [(uid, raw_bytes)]."""
+    result = []
+    for item in data:
+        if isinstance(item, tuple) and len(item) == 2:
+            m = FETCH_UID_RE.search(item[0])
+            if m:
+                result.append((int(m.group(1)), item[1]))
+    return result
+
+# Загруженное письмо до разбора: заголовки + выбранная текстовая часть или, при part=None, письмо целиком (RFC822)
+RawMessage = namedtuple("RawMessage", ["uid", "raw", "part", "body"])
+
+def fetch_full(mail, uids):
+    """Старый путь — письма целиком (RFC822); нужен, если структуру письма не удалось разобрать."""
+    status, data = imap_call('UID FETCH', mail.uid, 'FETCH', ','.join(str(u) for u in uids), '(UID RFC822)')
+    if status != 'OK':
+        return None
+    result = []
+    for uid, raw_email in parse_fetch_response(data):
+        FETCHED_BYTES.inc(len(raw_email), kind='downloaded')
+        FETCHED_BYTES.inc(len(raw_email), kind='message')
+        result.append(RawMessage(uid, raw_email, None, None))
+    return result
+
+def fetch_raw(mail, uids):
+    """
+    Пачка писем без вложений: BODYSTRUCTURE и заголовки одним FETCH, затем текстовые части —
+    по FETCH на каждый встречающийся номер части, не больше MAX_BODY_BYTES. Возвращает
+    [RawMessage] или None, если сервер отказал. Разбор — отдельно (parse_raw), чтобы его можно
+    было вынести в другой процесс.
+    """
+    status, data = imap_call('UID FETCH', mail.uid, 'FETCH', ','.join(str(u) for u in uids), HEADERS_ITEMS)
+    if status != 'OK':
+        return None
     try:
-        mail = connect_to_email()
-        mail.select("INBOX", readonly=True)  # readonly=True, т.к. не отмечаем как прочитанные
-        status, messages = mail.search(None, 'ALL')  # Получаем все письма
+        heads = imap_fetch.parse_fetch(data)
+    except ValueError as e:
+        print(f"Не удалось разобрать структуру писем {uids[0]}..{uids[-1]} ({e}), загружаю целиком")
+        return fetch_full(mail, uids)
+
+    messages = {}     # uid → (заголовки, выбранная часть)
+    by_part = {}      # номер части → [uid]
+    full_uids = []    # письма, которые придётся загрузить целиком
+    for fields in heads:
+        if 'UID' not in fields:
+            continue
+        uid = int(fields['UID'])
+        if not isinstance(fields.get('BODY[HEADER]'), bytes):
+            full_uids.append(uid)
+            continue
+        try:
+            part = imap_fetch.pick_body_part(fields.get('BODYSTRUCTURE'))
+        except Exception as e:
+            print(f"Не удалось разобрать структуру письма {uid} ({e!r}), загружаю целиком")
+            full_uids.append(uid)
+            continue
+        messages[uid] = (fields['BODY[HEADER]'], part)
+        FETCHED_BYTES.inc(len(fields['BODY[HEADER]']), kind='downloaded')
+        if str(fields.get('RFC822.SIZE', '')).isdigit():
+            FETCHED_BYTES.inc(int(fields['RFC822.SIZE']), kind='message')
+        if part is not None:
+            by_part.setdefault(part['part'], []).append(uid)
+
+    bodies = {}
+    for section, part_uids in by_part.items():
+        status, data = imap_call('UID FETCH', mail.uid, 'FETCH', ','.join(str(u) for u in part_uids),
+                                 f'(UID BODY.PEEK[{section}]<0.{MAX_BODY_BYTES}>)')
         if status != 'OK':
-            print("Не удалось получить список писем")
-            return
+            return None
+        for fields in imap_fetch.parse_fetch(data):
+            # сервер отвечает BODY[1]<0>, некоторые — без <0>, если часть поместилась целиком
+            content = next((v for k, v in fields.items() if k.startswith(f'BODY[{section}]')), None)
+            if 'UID' in fields and isinstance(content, bytes):
+                bodies[int(fields['UID'])] = content
+                FETCHED_BYTES.inc(len(content), kind='downloaded')
+
+    result = []
+    for uid, (header, part) in messages.items():
+        # текстовой части может не быть (только вложения) — тогда тело пустое, но не «письмо целиком»
+        if part is None:
+            result.append(RawMessage(uid, header, None, b''))
+            continue
+        try:
+            imap_fetch.decode_transfer(bodies[uid], part['encoding'])
+        except (KeyError, ValueError) as e:
+            # часть не пришла или не декодируется — вместо пустого текста берём письмо целиком
+            print(f"Не удалось получить текст письма {uid} ({e!r}), загружаю целиком")
+            full_uids.append(uid)
+            continue
+        result.append(RawMessage(uid, header, part, bodies[uid]))
 
-        email_ids = messages[0].split()
-        print(f"Найдено писем: {len(email_ids)}")
+    # письма, о которых сервер вообще не ответил, тоже пробуем загрузить целиком
+    full_uids += sorted(set(uids) - set(messages) - set(full_uids))
+    if full_uids:
+        full = fetch_full(mail, full_uids)
+        if full is None:
+            return None
+        result += full
+    return result
 
-        for eid in email_ids:
-            try:
-                status, msg_data = mail.fetch(eid, '(RFC822)')
-                if status != 'OK':
-                    continue
-                raw_email = msg_data[0][1]
-                msg = email.message_from_bytes(raw_email)
+def parse_raw(item):
+    """RawMessage → Notification (MIME, заголовки, текст, важность)."""
+    if item.body is None:
+        return build_notification(item.raw, item.uid)
+    body = imap_fetch.part_text(item.body, item.part) if item.part is not None and item.body else ""
+    return build_notification(item.raw, item.uid, body, HEADERS_CONTENT_TYPE)
 
-                from_header = msg.get("From", "")
-                from_name, from_email = parse_email_address(from_header)
+def parse_raw_batch(items):
+    """Разбор пачки в процессе-обработчике: [(uid, строка messages)]; битые письма пропускаются."""
+    result = []
+    for item in items:
+        try:
+            result.append((item.uid, notification_to_row(parse_raw(item))))
+        except Exception as e:
+            print(f"Ошибка при обработке письма {item.uid}: {e}")
+    return result
+
+def fetch_batch(mail, uids):
+    """Загрузка и разбор пачки писем: [(uid, Notification)] или None, если сервер отказал."""
+    fetched = fetch_raw(mail, uids)
+    if fetched is None:
+        return None
+    result = []
+    retry = []
+    for item in fetched:
+        try:
+            result.append((item.uid, parse_raw(item)))
+        except Exception as e:
+            print(f"Ошибка при обработке письма {item.uid}: {e}")
+            if item.body is not None:
+                retry.append(item.uid)
+    # по заголовкам и части письмо не разобралось — последняя попытка по письму целиком
+    full = fetch_full(mail, retry) if retry else []
+    for item in full or []:
+        try:
+            result.append((item.uid, parse_raw(item)))
+        except Exception as e:
+            print(f"Ошибка при обработке письма {item.uid}: {e}")
+    return result
+
+def sync_folder(mail, account, folder):
+    """
+    Забирает только новые письма папки: UID больше сохранённого last_uid.
+    При смене UIDVALIDITY прежние UID недействительны — папка пересинхронизируется
+    с начала, повторы отсекает проверка по Message-ID.
+    """
+    with metrics.timer(CYCLE_SECONDS, source='email'):
+        return _sync_folder(mail, account, folder)
+
+def _sync_folder(mail, account, folder):
+    status, _ = imap_call('SELECT', mail.select, folder, readonly=True)  # readonly=True, т.к. не отмечаем как прочитанные
+    if status != 'OK':
+        print(f"Не удалось открыть папку {folder}")
+        return 0
+    _, values = mail.response('UIDVALIDITY')
+    uidvalidity = int(values[0]) if values and values[0] else None
+
+    saved_validity, last_uid = load_sync_state(account, folder)
+    if saved_validity is not None and saved_validity != uidvalidity:
+        print(f"UIDVALIDITY папки {folder} изменился ({saved_validity} → {uidvalidity}), полная пересинхронизация")
+        last_uid = 0
+
+    status, data = imap_call('UID SEARCH', mail.uid, 'SEARCH', None, f'UID {last_uid + 1}:*')
+    if status != 'OK':
+        print("Не удалось получить список писем")
+        return 0
+    # диапазон n:* всегда включает последнее письмо, даже если его UID меньше n
+    uids = [int(u) for u in data[0].split() if int(u) > last_uid]
+    print(f"Новых писем в {folder}: {len(uids)}")
+
+    saved = 0
+    blocked = False  # был пропуск: дальше last_uid не двигаем
+    with IngestWriter(DATABASE, batch_size=FETCH_BATCH) as writer:
+        for start in range(0, len(uids), FETCH_BATCH):
+            batch = uids[start:start + FETCH_BATCH]
+            inserted_before, skipped_before = writer.total_inserted, writer.total_skipped
+            fetched = fetch_batch(mail, batch)
+            if fetched is None:
+                print(f"Не удалось получить письма {batch[0]}..{batch[-1]}")
+                break
+            INGESTED.inc(len(fetched), source='email', result='fetched')
+            for uid, notification in fetched:
+                writer.add(notification_to_row(notification))
+            # UID двигаем только после того, как пачка записана в БД
+            # (часть пачки writer мог записать сам внутри add — считаем по его итоговым счётчикам)
+            writer.flush()
+            inserted = writer.total_inserted - inserted_before
+            saved += inserted
+            print(f"Письма {batch[0]}..{batch[-1]}: сохранено {inserted}, уже были в базе {writer.total_skipped - skipped_before}")
+            missing = sorted(set(batch) - {uid for uid, _ in fetched})
+            if fetched:
+                forget_failed_uids(account, folder, uidvalidity, [uid for uid, _ in fetched])
+            if missing:
+                given_up = record_failed_uids(account, folder, uidvalidity, missing)
+                if given_up:
+                    print(f"Письма {sorted(given_up)[:10]} не получены за {MAX_UID_ATTEMPTS} попыток — пропускаем")
+                # письма после пропущенного всё равно пишем, но курсор оставляем перед ним:
+                # в следующий раз прочитаем их снова, дубликаты отсеет IngestWriter
+                missing = [uid for uid in missing if uid not in given_up]
+                if missing:
+                    print(f"Не удалось получить или разобрать письма {missing[:10]}; "
+                          f"повторим при следующей синхронизации")
+            if not blocked:
+                last_uid = max([last_uid] + [uid for uid in batch if not missing or uid < missing[0]])
+                blocked = bool(missing)
+                save_sync_state(account, folder, uidvalidity, last_uid)
+
+    if not uids:
+        save_sync_state(account, folder, uidvalidity, last_uid)
+    return saved
+
+def fetch_unread_emails():
+    for account in load_accounts():
+        try:
+            mail = connect_to_email(account)
+            for folder in account.folders:
+                sync_folder(mail, account.address, folder)
+            mail.close()
+            mail.logout()
+        except Exception as e:
+            print(f"Ошибка подключения к почте {account.address}: {e}")
+
+# === Push-режим: постоянное соединение на каждую папку, IDLE или NOOP-опрос ===
+def idle_wait(mail, timeout, stop_event=None):
+    """
+    Одна сессия IDLE (RFC 2177): ждёт, пока сервер сообщит о новых письмах, истечёт timeout
+    или будет выставлен stop_event. Возвращает True, если в папке что-то изменилось.
+    """
+    tag = mail._new_tag()
+    mail.send(tag + b' IDLE\r\n')
+    line = mail.readline()
+    if not line.startswith(b'+'):
+        raise imaplib.IMAP4.error(f"IDLE отклонён: {line!r}")
+
+    changed = False
+    deadline = time.monotonic() + timeout
+    while not changed and time.monotonic() < deadline and not (stop_event and stop_event.is_set()):
+        # короткие ожидания, чтобы вовремя заметить stop_event
+        wait = min(1.0, max(0.0, deadline - time.monotonic()))
+        pending = getattr(mail.sock, 'pending', None)
+        if not (pending and pending()) and not select.select([mail.sock], [], [], wait)[0]:
+            continue
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("соединение закрыто во время IDLE")
+        if line.rstrip().endswith((b'EXISTS', b'EXPUNGE')):
+            changed = True
+
+    mail.send(b'DONE\r\n')
+    while True:
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("соединение закрыто при выходе из IDLE")
+        if line.startswith(tag):
+            break
+        if line.rstrip().endswith(b'EXISTS'):
+            changed = True
+    return changed
+
+def noop_wait(mail, interval, stop_event=None):
+    """Запасной вариант без IDLE: NOOP раз в interval секунд, изменения — по ответу EXISTS."""
+    if stop_event:
+        stop_event.wait(interval)
+    else:
+        time.sleep(interval)
+    imap_call('NOOP', mail.noop)
+    _, data = mail.response('EXISTS')
+    return bool(data and data[0])
 
-                subject = decode_mime_words(msg.get("Subject", ""))
-                date_str = msg.get("Date", "")
+def watch_folder(account, folder, stop_event):
+    """Держит соединение с папкой и синхронизирует её при каждом изменении; при сбоях переподключается с backoff."""
+    backoff = 1
+    while not stop_event.is_set():
+        mail = None
+        try:
+            mail = connect_to_email(account)
+            sync_folder(mail, account.address, folder)
+            use_idle = 'IDLE' in mail.capabilities
+            print(f"{account.address}/{folder}: ожидание писем ({'IDLE' if use_idle else 'NOOP'})")
+            backoff = 1
+            while not stop_event.is_set():
+                if use_idle:
+                    changed = idle_wait(mail, IDLE_TIMEOUT, stop_event)
+                else:
+                    changed = noop_wait(mail, NOOP_INTERVAL, stop_event)
+                if changed:
+                    sync_folder(mail, account.address, folder)
+        except Exception as e:
+            print(f"Ошибка соединения {account.address}/{folder}: {e}; повтор через {backoff} с")
+            stop_event.wait(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+        finally:
+            if mail is not None:
                 try:
-                    email_date = email.utils.parsedate_to_datetime(date_str)
-                    date_iso = email_date.isoformat()
-                except:
-                    date_iso = datetime.utcnow().isoformat()
-
-                body = get_email_body(msg)
-                message_id = msg.get("Message-ID", str(eid))
-
-                notification = Notification(
-                    source='email',
-                    from_email=from_email,
-                    from_name=from_name,
-                    chat_title=subject,
-                    text_content=body,
-                    date=date_iso,
-                    message_id=message_id,
-                    raw_message=str(msg)[:1000]
-                )
-
-                notification.importance = calculate_importance(notification)
-                notification_id = save_message_to_db(notification)
-                if notification_id:
-                    print(f"Письмо от {notification.from_name} ({notification.from_email}) сохранено в БД с ID {notification_id}")
-
-            except Exception as e:
-                print(f"Ошибка при обработке письма {eid}: {e}")
-
-        mail.close()
-        mail.logout()
-    except Exception as e:
-        print(f"Ошибка подключения к почте: {e}")
+                    mail.logout()
+                except Exception:
+                    pass
+
+def run_push(accounts, stop_event=None):
+    """Запускает по потоку на каждую пару ящик/папка и ждёт их завершения."""
+    stop_event = stop_event or threading.Event()
+    workers = []
+    for account in accounts:
+        for folder in account.folders:
+            t = threading.Thread(target=watch_folder, args=(account, folder, stop_event),
+                                 name=f"imap:{account.address}/{folder}", daemon=True)
+            t.start()
+            workers.append(t)
+    try:
+        while any(t.is_alive() for t in workers):
+            for t in workers:
+                t.join(timeout=1)
+    except KeyboardInterrupt:
+        stop_event.set()
+    return workers
 
 def parse_email_address(from_header):
     from_header = from_header.strip()
@@ -165,24 +565,30 @@ def parse_email_address(from_header):
         return "", from_header
 
 def get_email_body(msg):
-    if msg.is_multipart():
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            content_disposition = str(part.get("Content-Disposition"))
-            if "attachment" not in content_disposition and content_type == "text/plain":
-                try:
-                    return part.get_payload(decode=True).decode('utf-8', errors='replace')
-                except:
-                    return str(part.get_payload())[:500]
-    else:
-        if msg.get_content_type() == "text/plain":
-            try:
-                return msg.get_payload(decode=True).decode('utf-8', errors='replace')
-            except:
-                return str(msg.get_payload())[:500]
-    return ""
+    """Текст разобранного письма: первая text/plain не-вложение, иначе HTML, переведённый в текст."""
+    html_part = None
+    for part in msg.walk():
+        if part.is_multipart() or part.get_content_disposition() == 'attachment':
+            continue
+        content_type = part.get_content_type()
+        if content_type == "text/plain":
+            return _decoded_payload(part)
+        if content_type == "text/html" and html_part is None:
+            html_part = part
+    return imap_fetch.html_to_text(_decoded_payload(html_part)) if html_part is not None else ""
+
+def _decoded_payload(part):
+    try:
+        return imap_fetch.decode_charset(part.get_payload(decode=True) or b'', part.get_content_charset() or 'utf-8')
+    except Exception:
+        return str(part.get_payload())[:500]
 
 def main():
+    init_sync_state()
+    metrics.start_file_export("email_reader")
+    if EMAIL_MODE == "idle":
+        run_push(load_accounts())
+        return
     while True:
         try:
             fetch_unread_emails()
@@ -0,0 +1,141 @@
+"""
+Потоковая выгрузка истории сообщений: NDJSON или CSV, по желанию в gzip.
+
+Строки читаются курсором SQLite порциями по EXPORT_CHUNK (fetchmany) и сразу кодируются
+в байты — в памяти одновременно только одна порция, сколько бы строк ни было в выгрузке.
+Фильтры те же, что у /api/messages (запрос строит app.build_messages_query): source,
+importance, date_from / date_to, search; порядок — по дате, с search — по id, в порядке
+FTS-индекса (см. app.build_export_query).
+
+    GET /api/export?format=csv&gzip=1&source=email&date_from=2024-01-01&date_to=2025-01-01
+
+    python export.py --format ndjson --gzip --source email --date-from 2024-01-01 -o messages.ndjson.gz
+    python export.py --format csv --search "отчёт" > report.csv
+
+Выгрузка — одна читающая транзакция: снимок данных согласован, но пока она идёт,
+WAL не может быть перенесён в базу дальше её начала.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import zlib
+
+import metrics
+
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "1000"))
+FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv; charset=utf-8", "csv"),
+}
+
+EXPORTED_ROWS = metrics.counter("export_rows_total", "Выгруженные строки", ("format",))
+
+
+def iter_rows(cursor, chunk=EXPORT_CHUNK):
+    """Строки выполненного запроса порциями: fetchmany вместо fetchall."""
+    while True:
+        rows = cursor.fetchmany(chunk)
+        if not rows:
+            return
+        yield rows
+
+
+def encode_ndjson(chunks, columns):
+    for rows in chunks:
+        yield ''.join(json.dumps({c: r[c] for c in columns}, ensure_ascii=False) + '\n' for r in rows).encode('utf-8')
+
+
+def encode_csv(chunks, columns):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    # BOM — чтобы Excel открыл UTF-8 без мастера импорта
+    buf.write('\ufeff')
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows([r[c] for c in columns] for r in rows)
+        yield buf.getvalue().encode('utf-8')
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode('utf-8')
+
+
+def gzip_stream(parts, level=6):
+    """Сжимает поток байт в формат gzip на лету (zlib с заголовком gzip, wbits=31)."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for part in parts:
+        data = compressor.compress(part)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream(connect, query, params, columns, fmt="ndjson", compress=False, chunk=EXPORT_CHUNK):
+    """
+    Генератор байт выгрузки; connect — фабрика соединений. Соединение берётся при первой порции
+    и закрывается, когда генератор исчерпан или закрыт (клиент оборвал скачивание): если клиент
+    ушёл раньше, чем ответ начал отдаваться, соединение так и не будет взято. Поэтому генератор
+    отдают прямо в Response.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query, params)
+
+        def counted():
+            for rows in iter_rows(cursor, chunk):
+                EXPORTED_ROWS.inc(len(rows), format=fmt)
+                yield rows
+
+        encoded = (encode_ndjson if fmt == "ndjson" else encode_csv)(counted(), columns)
+        yield from gzip_stream(encoded) if compress else encoded
+    finally:
+        # оборванная выгрузка оставляет выборку недочитанной: курсор закрываем сами, не дожидаясь
+        # сборщика мусора, — иначе соединение вернулось бы в пул с открытым чтением (снимком WAL)
+        cursor.close()
+        conn.close()
+
+
+def filename(fmt, compress, stamp):
+    return f"messages-{stamp}.{FORMATS[fmt][1]}{'.gz' if compress else ''}"
+
+
+def main():
+    # запрос и колонки — те же, что у /api/messages; app импортируется только здесь
+    import app
+    import storage
+
+    parser = argparse.ArgumentParser(description="Выгрузка истории сообщений в NDJSON / CSV")
+    parser.add_argument('--format', choices=sorted(FORMATS), default='ndjson')
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--source')
+    parser.add_argument('--importance', type=int)
+    parser.add_argument('--date-from', help="ISO-дата или секунды UTC, включительно")
+    parser.add_argument('--date-to', help="ISO-дата или секунды UTC, не включая")
+    parser.add_argument('--search', default='')
+    parser.add_argument('--sort-order', choices=('asc', 'desc'), default='asc')
+    parser.add_argument('-o', '--output', help="файл; по умолчанию — stdout")
+    args = parser.parse_args()
+
+    try:
+        query, params = app.build_export_query(args.source, args.importance, args.date_from, args.date_to,
+                                               args.search, args.sort_order)
+    except ValueError as e:
+        parser.error(str(e))
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for part in stream(storage.connect, query, params, app.LIST_COLUMNS, args.format, args.gzip):
+            out.write(part)
+    finally:
+        if args.output:
+            out.close()
+    print(f"Выгружено строк: {EXPORTED_ROWS.values.get((args.format,), 0)}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+"""
+Локальная заглушка IMAP-сервера для разработки и замеров email_reader.
+
+Понимает ровно то, что нужно ридеру: LOGIN, SELECT/EXAMINE (с UIDVALIDITY/UIDNEXT),
+SEARCH / UID SEARCH, FETCH / UID FETCH (UID, FLAGS, RFC822, RFC822.SIZE, BODYSTRUCTURE,
+BODY[...] / BODY.PEEK[...] с HEADER, TEXT, номером части и <начало.длина>), NOOP, IDLE, CLOSE, LOGOUT.
+С idle=False сервер не объявляет IDLE — так проверяется запасной NOOP-опрос.
+latency (--latency) — задержка перед ответом на каждую команду, как у удалённого сервера.
+Шифрования нет — ридер подключается к нему с IMAP_SSL=false.
+
+    python fake_imap.py --port 1143 --generate 1000
+    IMAP_SERVER=127.0.0.1 IMAP_PORT=1143 IMAP_SSL=false python email_reader.py
+"""
+import argparse
+import email
+import re
+import select
+import socketserver
+import threading
+import time
+import email.policy
+from email.message import EmailMessage
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+BODY_ITEM_RE = re.compile(r'BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)(?:\.(\d+))?>)?')
+
+
+def make_email(i, subject=None, body=None, sender=None, date=None, html=None, attachment_kb=0):
+    """Простое письмо для наполнения ящика; html — HTML-версия (без body — единственная), attachment_kb — вложение."""
+    msg = EmailMessage()
+    msg['From'] = sender or f"Отправитель {i} <sender{i % 50}@example.com>"
+    msg['To'] = "me@example.com"
+    msg['Subject'] = subject or f"Письмо номер {i}"
+    msg['Date'] = format_datetime(date or datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=i))
+    msg['Message-ID'] = f"<fake-{i}@example.com>"
+    if html and body is None:
+        msg.set_content(html, subtype='html')
+    else:
+        msg.set_content(body or f"Текст письма {i}. Просьба посмотреть до конца дня.")
+        if html:
+            msg.add_alternative(html, subtype='html')
+    if attachment_kb:
+        msg.add_attachment(bytes(range(256)) * (attachment_kb * 4), maintype='application',
+                           subtype='octet-stream', filename=f"report-{i}.bin")
+    return msg.as_bytes()
+
+
+def _quote(value):
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def part_body(part):
+    """Тело части в том виде, в каком оно лежит в письме (после заголовков, с кодировкой передачи)."""
+    payload = part.get_payload()
+    return payload.encode('utf-8', 'surrogateescape') if isinstance(payload, str) else b''
+
+
+def body_structure(part):
+    """BODYSTRUCTURE части (RFC 3501, 7.4.2) с данными расширения."""
+    if part.is_multipart():
+        children = ''.join(body_structure(p) for p in part.get_payload())
+        return f'({children} {_quote(part.get_content_subtype())} ("boundary" {_quote(part.get_boundary())}) NIL NIL NIL)'
+    params = [(k, v) for k, v in part.get_params()[1:]] if part.get_params() else []
+    params = '(' + ' '.join(f'{_quote(k)} {_quote(v)}' for k, v in params) + ')' if params else 'NIL'
+    body = part_body(part)
+    fields = (f'{_quote(part.get_content_maintype())} {_quote(part.get_content_subtype())} {params} NIL NIL '
+              f'{_quote(part.get("Content-Transfer-Encoding", "7bit"))} {len(body)}')
+    if part.get_content_maintype() == 'text':
+        fields += ' %d' % body.count(b'\n')
+    disposition = part.get_content_disposition()
+    if disposition:
+        filename = part.get_filename()
+        params = f'("filename" {_quote(filename)})' if filename else 'NIL'
+        disposition = f'({_quote(disposition)} {params})'
+    return f'({fields} NIL {disposition or "NIL"} NIL NIL)'
+
+
+def find_part(msg, spec):
+    """Часть по номеру "1.2"; у не-multipart письма часть 1 — само тело."""
+    part = msg
+    for n in spec.split('.'):
+        n = int(n)
+        if part.is_multipart():
+            children = part.get_payload()
+            if not 1 <= n <= len(children):
+                return None
+            part = children[n - 1]
+        elif n != 1:
+            return None
+    return part
+
+
+def body_section(raw, msg, section):
+    """Содержимое BODY[section]: '' — письмо целиком, HEADER, TEXT или номер части."""
+    section = section.upper()
+    split = raw.find(b'\r\n\r\n')
+    header_end = split + 4 if split >= 0 else (raw.find(b'\n\n') + 2 if b'\n\n' in raw else len(raw))
+    if section == '':
+        return raw
+    if section == 'HEADER':
+        return raw[:header_end]
+    if section == 'TEXT':
+        return raw[header_end:]
+    part = find_part(msg, section)
+    return part_body(part) if part is not None and not part.is_multipart() else b''
+
+
+class Mailbox:
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.messages = []          # [(uid, raw_bytes)]
+        self.parsed = {}            # raw_bytes → разобранное письмо (для BODYSTRUCTURE и частей)
+        self.next_uid = 1
+        self.unfetchable = set()    # UID, которые FETCH молча пропускает (письмо повреждено на сервере)
+        self.lock = threading.Lock()
+
+    def add(self, raw):
+        with self.lock:
+            uid = self.next_uid
+            self.messages.append((uid, raw))
+            self.next_uid += 1
+            return uid
+
+    def reset(self, uidvalidity):
+        """Имитирует смену UIDVALIDITY: все письма получают новые UID."""
+        with self.lock:
+            self.uidvalidity = uidvalidity
+            raws = [raw for _, raw in self.messages]
+            self.messages = [(i + 1, raw) for i, raw in enumerate(raws)]
+            self.next_uid = len(raws) + 1
+
+    def parse(self, raw):
+        msg = self.parsed.get(raw)
+        if msg is None:
+            msg = self.parsed[raw] = email.message_from_bytes(raw, policy=email.policy.default)
+        return msg
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.messages)
+
+
+def parse_sequence_set(spec, max_value):
+    """'1:5,7,10:*' → множество чисел; '*' означает максимальное значение."""
+    result = set()
+    for part in spec.split(','):
+        if ':' in part:
+            a, b = part.split(':', 1)
+            a = max_value if a == '*' else int(a)
+            b = max_value if b == '*' else int(b)
+            lo, hi = min(a, b), max(a, b)
+            result.update(range(lo, hi + 1))
+        else:
+            result.add(max_value if part == '*' else int(part))
+    return result
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    def write(self, data):
+        self.wfile.write(data)
+        with self.server.lock:
+            self.server.bytes_sent += len(data)
+
+    def send(self, line):
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        self.write(line + b'\r\n')
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        line = line.rstrip(b'\r\n')
+        # литералы в аргументах (например, пароль) дочитываем целиком
+        while True:
+            m = LITERAL_RE.search(line)
+            if not m:
+                break
+            self.send(b'+ Ready')
+            literal = self.rfile.read(int(m.group(1)))
+            rest = self.rfile.readline().rstrip(b'\r\n')
+            line = line[:m.start()] + b'"' + literal + b'"' + rest
+        return line.decode('utf-8', errors='replace')
+
+    def handle(self):
+        self.mailbox = self.server.mailbox
+        self.selected = False
+        self.send('* OK fake IMAP ready')
+        while True:
+            line = self.read_command()
+            if line is None:
+                return
+            parts = line.split(' ', 2)
+            if len(parts) < 2:
+                self.send('* BAD empty command')
+                continue
+            tag, command = parts[0], parts[1].upper()
+            args = parts[2] if len(parts) > 2 else ''
+            uid_mode = command == 'UID'
+            if uid_mode:
+                sub = args.split(' ', 1)
+                command, args = sub[0].upper(), (sub[1] if len(sub) > 1 else '')
+            handler = getattr(self, f'cmd_{command.lower()}', None)
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            if handler is None:
+                self.send(f'{tag} BAD unknown command {command}')
+                continue
+            if handler(tag, args, uid_mode) is False:
+                return
+
+    # === команды ===
+    def cmd_capability(self, tag, args, uid_mode):
+        self.send('* CAPABILITY IMAP4rev1' + (' IDLE' if self.server.idle else ''))
+        self.send(f'{tag} OK CAPABILITY completed')
+
+    def cmd_login(self, tag, args, uid_mode):
+        self.send(f'{tag} OK LOGIN completed')
+
+    def cmd_select(self, tag, args, uid_mode, readonly=False):
+        messages = self.mailbox.snapshot()
+        self.selected = True
+        self.send(f'* {len(messages)} EXISTS')
+        self.send('* 0 RECENT')
+        self.send(f'* OK [UIDVALIDITY {self.mailbox.uidvalidity}] UIDs valid')
+        self.send(f'* OK [UIDNEXT {self.mailbox.next_uid}] Predicted next UID')
+        self.send('* FLAGS (\\Seen \\Answered \\Flagged \\Deleted \\Draft)')
+        self.send(f'{tag} OK [{"READ-ONLY" if readonly else "READ-WRITE"}] SELECT completed')
+
+    def cmd_examine(self, tag, args, uid_mode):
+        self.cmd_select(tag, args, uid_mode, readonly=True)
+
+    def cmd_noop(self, tag, args, uid_mode):
+        self.send(f'* {len(self.mailbox.snapshot())} EXISTS')
+        self.send(f'{tag} OK NOOP completed')
+
+    def cmd_search(self, tag, args, uid_mode):
+        messages = self.mailbox.snapshot()
+        tokens = args.split()
+        if len(tokens) >= 2 and tokens[0].upper() == 'UID':
+            max_uid = messages[-1][0] if messages else 0
+            wanted = parse_sequence_set(tokens[1], max_uid)
+            hits = [(seq, uid) for seq, (uid, _) in enumerate(messages, 1) if uid in wanted]
+        else:
+            hits = [(seq, uid) for seq, (uid, _) in enumerate(messages, 1)]
+        values = [str(uid if uid_mode else seq) for seq, uid in hits]
+        self.send('* SEARCH' + (' ' + ' '.join(values) if values else ''))
+        self.send(f'{tag} OK SEARCH completed')
+
+    def cmd_fetch(self, tag, args, uid_mode):
+        messages = self.mailbox.snapshot()
+        spec, _, items = args.partition(' ')
+        items = items.upper()
+        if uid_mode:
+            max_uid = messages[-1][0] if messages else 0
+            wanted = parse_sequence_set(spec, max_uid)
+            selected = [(seq, uid, raw) for seq, (uid, raw) in enumerate(messages, 1) if uid in wanted]
+        else:
+            wanted = parse_sequence_set(spec, len(messages))
+            selected = [(seq, uid, raw) for seq, (uid, raw) in enumerate(messages, 1) if seq in wanted]
+        for seq, uid, raw in selected:
+            if uid in self.mailbox.unfetchable:
+                continue
+            out = [f'* {seq} FETCH (UID {uid}'.encode('utf-8')]
+            if 'FLAGS' in items:
+                out.append(b' FLAGS ()')
+            if 'RFC822.SIZE' in items:
+                out.append(f' RFC822.SIZE {len(raw)}'.encode('utf-8'))
+            if 'BODYSTRUCTURE' in items:
+                out.append(b' BODYSTRUCTURE ' + body_structure(self.mailbox.parse(raw)).encode('utf-8'))
+            for m in BODY_ITEM_RE.finditer(items):
+                section, start, length = m.group(1), m.group(2), m.group(3)
+                data = body_section(raw, self.mailbox.parse(raw), section)
+                key = f'BODY[{section}]'
+                if start is not None:
+                    data = data[int(start):int(start) + int(length)] if length else data[int(start):]
+                    key += f'<{start}>'
+                out.append(f' {key} {{{len(data)}}}\r\n'.encode('utf-8') + data)
+            if re.search(r'RFC822(?![.\w])', items):
+                out.append(f' RFC822 {{{len(raw)}}}\r\n'.encode('utf-8') + raw)
+            self.write(b''.join(out) + b')\r\n')
+        self.send(f'{tag} OK FETCH completed')
+
+    def cmd_idle(self, tag, args, uid_mode):
+        if not self.server.idle:
+            self.send(f'{tag} BAD IDLE not supported')
+            return
+        self.send('+ idling')
+        known = len(self.mailbox.snapshot())
+        while True:
+            readable = select.select([self.request], [], [], 0.05)[0]
+            count = len(self.mailbox.snapshot())
+            if count != known:
+                self.send(f'* {count} EXISTS')
+                known = count
+            if readable:
+                line = self.rfile.readline()
+                if not line or line.strip().upper() == b'DONE':
+                    break
+        if line:
+            self.send(f'{tag} OK IDLE terminated')
+
+    def cmd_close(self, tag, args, uid_mode):
+        self.selected = False
+        self.send(f'{tag} OK CLOSE completed')
+
+    def cmd_logout(self, tag, args, uid_mode):
+        self.send('* BYE logging out')
+        self.send(f'{tag} OK LOGOUT completed')
+        return False
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, mailbox=None, idle=True, latency=0.0):
+        self.mailbox = mailbox or Mailbox()
+        self.idle = idle
+        self.latency = latency
+        self.bytes_sent = 0          # сколько байт ушло клиентам — видно, сколько сэкономила выборочная загрузка
+        self.lock = threading.Lock()
+        super().__init__((host, port), IMAPHandler)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """Запускает сервер в фоновом потоке и возвращает self."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная заглушка IMAP для email_reader")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1143)
+    parser.add_argument('--generate', type=int, default=100, help="сколько писем положить в INBOX")
+    parser.add_argument('--attachment-kb', type=int, default=0, help="вложение такого размера в каждом письме")
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа на команду, с")
+    args = parser.parse_args()
+
+    server = FakeIMAPServer(args.host, args.port, latency=args.latency)
+    for i in range(args.generate):
+        server.mailbox.add(make_email(i, attachment_kb=args.attachment_kb))
+    print(f"Fake IMAP на {args.host}:{server.port}, писем: {args.generate}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Локальная заглушка Ollama для разработки и проверки summarizer.py.
+
+Отвечает на POST /api/generate так же, как Ollama: без stream — одним JSON
+{"model", "created_at", "response", "done": true, ...}, со stream — построчным NDJSON.
+В response — JSON со сводкой из слов сообщений промпта. --delay имитирует медленную модель,
+--fail-rate — долю ответов 500. Сервер считает запросы и максимум одновременных.
+
+    python fake_ollama.py --port 11435 --delay 0.5
+    OLLAMA_URL=http://127.0.0.1:11435/api/generate python summarizer.py --once
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def fake_answer(prompt):
+    # слова из строк сообщений ("- Имя: текст"), а не из инструкции
+    lines = [line.split(':', 1)[-1] for line in prompt.splitlines() if line.startswith('- ')]
+    words = [w for w in ' '.join(lines).split() if len(w) > 3]
+    return json.dumps({
+        "summary": "Обсуждают: " + " ".join(words[:6]),
+        "reply": "Спасибо, посмотрю." if "?" in prompt else "",
+        "priority": 4 if "срочно" in prompt.lower() else 3,
+    }, ensure_ascii=False)
+
+
+class OllamaHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/api/tags':
+            self._json(200, {"models": [{"name": self.server.model}]})
+        else:
+            self._json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != '/api/generate':
+            self._json(404, {"error": "not found"})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            server.prompts.append(request.get("prompt", ""))
+        try:
+            time.sleep(server.delay)
+            if random.random() < server.fail_rate:
+                self._json(500, {"error": "model failed"})
+                return
+            answer = fake_answer(request.get("prompt", ""))
+            created = datetime.now(timezone.utc).isoformat()
+            model = request.get("model", server.model)
+            if request.get("stream", True):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.end_headers()
+                for chunk in (answer[i:i + 16] for i in range(0, len(answer), 16)):
+                    self.wfile.write(json.dumps({"model": model, "created_at": created, "response": chunk, "done": False},
+                                                ensure_ascii=False).encode('utf-8') + b'\n')
+                self.wfile.write(json.dumps({"model": model, "created_at": created, "response": "", "done": True}).encode() + b'\n')
+            else:
+                self._json(200, {"model": model, "created_at": created, "response": answer, "done": True,
+                                 "total_duration": int(server.delay * 1e9)})
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0, fail_rate=0.0, model='fake'):
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.model = model
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0        # сколько запросов обрабатывалось одновременно — проверка ограничения конкурентности
+        self.prompts = []
+        self.lock = threading.Lock()
+        super().__init__((host, port), OllamaHandler)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.port}/api/generate"
+
+    def start(self):
+        """Запускает сервер в фоновом потоке и возвращает self."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Ollama /api/generate")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--delay', type=float, default=0.2, help="задержка ответа, с")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="доля ответов с ошибкой 500")
+    args = parser.parse_args()
+
+    server = FakeOllamaServer(args.host, args.port, args.delay, args.fail_rate)
+    print(f"Fake Ollama на {server.url}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
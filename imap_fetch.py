@@ -0,0 +1,202 @@
+"""
+Выборочная загрузка писем по IMAP: сначала структура и заголовки, потом только нужная текстовая часть.
+
+    UID FETCH 1:100 (UID RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER])
+    UID FETCH 1,5,9 (UID BODY.PEEK[1.1]<0.262144>)
+
+Вложения не скачиваются вовсе, а текст — не больше MAX_BODY_BYTES. Из BODYSTRUCTURE берутся
+номер части, кодировка передачи и charset; если в письме только HTML, он превращается в текст
+регулярками (без разбора DOM — нужен текст для ленты и поиска, а не вёрстка).
+
+Ответ imaplib на FETCH — вперемешку строки и кортежи (строка с {n}, литерал); parse_fetch
+собирает из него по словарю на письмо: {"UID": "5", "BODYSTRUCTURE": [...], "BODY[HEADER]": b"..."}.
+"""
+import base64
+import binascii
+import codecs
+import html
+import itertools
+import quopri
+import re
+
+ATOM_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\x00(\d+)\x00|([^\s()"\x00\[\]]+(?:\[[^\]]*\])?(?:<\d+>)?))', re.S)
+LITERAL_TAIL_RE = re.compile(rb'\{(\d+)\}$')
+QUOTED_ESCAPE_RE = re.compile(rb'\\(.)')
+
+HTML_DROP_RE = re.compile(r'<(script|style|head|title)\b.*?</\1\s*>|<!--.*?-->', re.I | re.S)
+HTML_BREAK_RE = re.compile(r'<\s*(?:br|/p|/div|/li|/tr|/h[1-6]|/table|/blockquote|hr)\b[^>]*>', re.I)
+HTML_TAG_RE = re.compile(r'<[^>]*>')
+SPACES_RE = re.compile(r'[ \t\r\f\v\xa0]+')
+BLANK_LINES_RE = re.compile(r'\n\s*\n\s*(?:\n\s*)+')
+
+
+class Literal(bytes):
+    """Литерал IMAP ({n}) — в отличие от атома, всегда строка байт, даже если похож на NIL."""
+
+
+def _tokenize(data):
+    """Склеивает ответ imaplib в один буфер; литералы заменяются метками \\x00<номер>\\x00."""
+    buf = []
+    literals = []
+    for item in data:
+        if isinstance(item, tuple):
+            head, literal = item
+            m = LITERAL_TAIL_RE.search(head)
+            buf.append(head[:m.start()] if m else head)
+            buf.append(b'\x00%d\x00' % len(literals))
+            literals.append(Literal(literal))
+        elif item:
+            buf.append(b' ' + item if isinstance(item, bytes) else b' ' + item.encode())
+    return b''.join(buf), literals
+
+
+def _parse(buf, literals):
+    """Буфер → вложенные списки; атомы — str, строки — bytes, NIL — None."""
+    stack = [[]]
+    pos = 0
+    while pos < len(buf):
+        m = ATOM_RE.match(buf, pos)
+        if not m:
+            if buf[pos:].strip():
+                raise ValueError(f"Не разобран ответ IMAP около {buf[pos:pos + 40]!r}")
+            break
+        pos = m.end()
+        opened, closed, quoted, literal, atom = m.groups()
+        if opened:
+            stack.append([])
+        elif closed:
+            if len(stack) == 1:
+                raise ValueError("Лишняя закрывающая скобка в ответе IMAP")
+            done = stack.pop()
+            stack[-1].append(done)
+        elif quoted is not None:
+            stack[-1].append(QUOTED_ESCAPE_RE.sub(rb'\1', quoted))
+        elif literal is not None:
+            stack[-1].append(literals[int(literal)])
+        else:
+            text = atom.decode('ascii', errors='replace')
+            stack[-1].append(None if text.upper() == 'NIL' else text)
+    if len(stack) != 1:
+        raise ValueError("Незакрытая скобка в ответе IMAP")
+    return stack[0]
+
+
+def parse_fetch(data):
+    """Ответ FETCH → [{элемент: значение}], ключи в верхнем регистре ("UID", "BODY[1]<0>")."""
+    items = _parse(*_tokenize(data))
+    result = []
+    # ответ — чередование "<seq> (<элементы>)"
+    for i in range(0, len(items) - 1, 2):
+        values = items[i + 1]
+        if not isinstance(values, list):
+            continue
+        fields = {}
+        for j in range(0, len(values) - 1, 2):
+            key = values[j]
+            if isinstance(key, str):
+                fields[key.upper()] = values[j + 1]
+        result.append(fields)
+    return result
+
+
+# === BODYSTRUCTURE ===
+def _text(value):
+    if value is None:
+        return ''
+    return value.decode('utf-8', errors='replace') if isinstance(value, bytes) else value
+
+
+def _params(value):
+    if not isinstance(value, list):
+        return {}
+    return {_text(value[i]).lower(): _text(value[i + 1]) for i in range(0, len(value) - 1, 2)}
+
+
+def text_parts(structure, prefix=''):
+    """
+    Текстовые части письма, не являющиеся вложениями, в порядке следования:
+    [{"part": "1.2", "subtype": "html", "charset": "utf-8", "encoding": "base64", "size": 1234}].
+    """
+    if not isinstance(structure, list) or not structure:
+        return []
+    if isinstance(structure[0], list):
+        # multipart: сначала дочерние части, затем подтип и параметры
+        children = list(itertools.takewhile(lambda p: isinstance(p, list), structure))
+        rest = structure[len(children):]
+        subtype = _text(rest[0]).lower() if rest else 'mixed'
+        parts = []
+        for i, child in enumerate(children, 1):
+            parts.extend(text_parts(child, f"{prefix}{i}."))
+        if subtype == 'alternative':
+            # из альтернатив достаточно одной: plain, если есть, иначе первая найденная
+            plain = [p for p in parts if p['subtype'] == 'plain']
+            return (plain or parts)[:1]
+        return parts
+
+    maintype, subtype = _text(structure[0]).lower(), _text(structure[1]).lower()
+    if maintype != 'text' or subtype not in ('plain', 'html'):
+        return []
+    params = _params(structure[2])
+    disposition = structure[9] if len(structure) > 9 else None
+    if isinstance(disposition, list) and disposition and _text(disposition[0]).lower() == 'attachment':
+        return []
+    if 'name' in params and disposition is None:
+        return []   # старые клиенты помечают вложения только именем в Content-Type
+    size = structure[6] if len(structure) > 6 else None
+    return [{
+        "part": (prefix + '1') if not prefix else prefix.rstrip('.'),
+        "subtype": subtype,
+        "charset": params.get('charset') or 'us-ascii',
+        "encoding": _text(structure[5]).lower() or '7bit',
+        "size": int(size) if isinstance(size, str) and size.isdigit() else None,
+    }]
+
+
+def pick_body_part(structure):
+    """Часть, из которой берётся текст письма: первая text/plain, иначе первая text/html."""
+    parts = text_parts(structure)
+    return next((p for p in parts if p['subtype'] == 'plain'), parts[0] if parts else None)
+
+
+# === Декодирование ===
+def decode_transfer(data, encoding):
+    """
+    Снимает Content-Transfer-Encoding; обрезанный по лимиту base64 дочитывается до целых квантов.
+    Испорченный base64 — ValueError: такое письмо надо загрузить целиком, а не терять текст.
+    """
+    if encoding == 'base64':
+        data = re.sub(rb'[^A-Za-z0-9+/=]', b'', data)
+        data = data[:len(data) - len(data) % 4]
+        try:
+            return base64.b64decode(data)
+        except binascii.Error as e:
+            raise ValueError(f"не удалось декодировать base64: {e}") from e
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(data)
+    return data
+
+
+def decode_charset(data, charset):
+    try:
+        codecs.lookup(charset)
+    except (LookupError, TypeError):
+        charset = 'utf-8'
+    if charset.lower() in ('us-ascii', 'ascii'):
+        charset = 'utf-8'   # «ascii» в заголовке часто врёт — utf-8 ascii не испортит
+    return data.decode(charset, errors='replace')
+
+
+def html_to_text(markup):
+    text = HTML_DROP_RE.sub(' ', markup)
+    text = HTML_BREAK_RE.sub('\n', text)
+    text = HTML_TAG_RE.sub(' ', text)
+    text = html.unescape(text)
+    text = SPACES_RE.sub(' ', text)
+    text = '\n'.join(line.strip() for line in text.split('\n'))
+    return BLANK_LINES_RE.sub('\n\n', text).strip()
+
+
+def part_text(data, part):
+    """Байты части из BODY[...] → текст с учётом кодировки передачи, charset и HTML."""
+    text = decode_charset(decode_transfer(data, part['encoding']), part['charset'])
+    return html_to_text(text) if part['subtype'] == 'html' else text
@@ -0,0 +1,391 @@
+"""
+Правила важности сообщений (1–5) — общие для всех ингесторов и пересчёта истории.
+
+Правила лежат в JSON-файле IMPORTANCE_RULES_FILE; без него действуют DEFAULT_RULES
+(прежняя зашитая в email_reader логика). Файл перечитывается при изменении — ингесторы
+подхватывают новые правила без перезапуска.
+
+    {
+      "default": 3,
+      "timezone": "Europe/Moscow",
+      "rules": [
+        {"name": "vip", "importance": 5, "senders": ["boss@company.com"], "domains": ["board.example.com"]},
+        {"name": "ночные алерты", "importance": 5, "sources": ["telegram"], "keywords": ["alert"], "hours": [22, 7]},
+        {"name": "рассылки", "importance": 2, "title_patterns": ["^\\\\[newsletter\\\\]"]},
+        {"name": "срочно", "importance": 4, "keywords": ["срочно", "важно"]}
+      ]
+    }
+
+Условия правила (все необязательные, указанные должны выполниться одновременно):
+senders — адрес или имя отправителя (без учёта регистра), domains — домен адреса с поддоменами
+(senders и domains в одном правиле — одно условие «отправитель», хватает любого совпадения);
+keywords / title_keywords — подстроки текста / заголовка чата (темы письма); title_patterns — регулярки
+по заголовку; sources — источник; hours — [с, до) в часовом поясе timezone, можно через полночь;
+weekdays — дни недели, 0 — понедельник. Побеждает первое подошедшее правило, иначе default.
+
+Ключевые слова всех правил собраны в одну регулярку, поэтому текст сообщения просматривается
+один раз, сколько бы правил ни было. Для каждого вида условий считается битовая маска
+подошедших правил, пересечение масок даёт кандидатов.
+
+После смены правил историю пересчитывает rescore(): пачками по id, UPDATE только тем строкам,
+у которых важность изменилась (на каждый UPDATE срабатывают триггеры conversations и term_stats).
+Пересчитываются только строки с importance_source = 'rules' — важность, выставленную tg.py,
+LLM или вручную, правила не перетирают.
+В веб-процессе это делает фоновый поток run_rescorer, вручную —
+
+    python importance.py rescore
+    python importance.py check --text "срочно нужен отчёт" --sender boss@company.com
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime, timezone
+
+import storage
+
+IMPORTANCE_RULES_FILE = os.getenv("IMPORTANCE_RULES_FILE")
+IMPORTANCE_TZ = os.getenv("IMPORTANCE_TZ", "UTC")
+RESCORE_BATCH = int(os.getenv("IMPORTANCE_RESCORE_BATCH", "2000"))
+RESCORE_INTERVAL = float(os.getenv("IMPORTANCE_RESCORE_INTERVAL", "60"))
+RELOAD_INTERVAL = 5   # как часто проверять mtime файла правил
+
+DEFAULT_RULES = {
+    "default": 3,
+    "rules": [
+        {"name": "руководство", "importance": 5, "senders": ["boss@company.com", "ceo@example.com"]},
+        {"name": "срочное в тексте", "importance": 4, "keywords": ["срочно", "важно", "пожалуйста"]},
+        {"name": "срочное в заголовке", "importance": 4, "title_keywords": ["срочное", "важное"]},
+    ],
+}
+
+RULES_SOURCE = "rules"   # messages.importance_source: важность посчитана этими правилами
+
+CONDITIONS = ("senders", "domains", "keywords", "title_keywords", "title_patterns", "sources", "hours", "weekdays")
+
+SENDER_EMAIL_RE = re.compile(r'^(.*?)\s*\(([^()\s]+@[^()\s]+)\)\s*$')   # "Имя (адрес)" из email_reader
+
+
+def _zone(name):
+    if not name or name.upper() == "UTC":
+        return timezone.utc
+    from zoneinfo import ZoneInfo
+    return ZoneInfo(name)
+
+
+def _keyword_matcher(keywords_by_rule):
+    """{rule_index: [слова]} → (регулярка или None, {слово: маска правил})."""
+    masks = {}
+    for index, words in keywords_by_rule.items():
+        for word in words:
+            word = word.lower()
+            if word:
+                masks[word] = masks.get(word, 0) | (1 << index)
+    if not masks:
+        return None, masks
+    # в каждой позиции регулярка находит только самое длинное слово, поэтому слово
+    # наследует маски всех слов, которые в него входят ("срочное" ⊃ "срочно")
+    words = sorted(masks, key=len, reverse=True)
+    for i, word in enumerate(words):
+        for shorter in words[i + 1:]:
+            if shorter in word:
+                masks[word] |= masks[shorter]
+    pattern = re.compile("(?=(" + "|".join(re.escape(w) for w in words) + "))")
+    return pattern, masks
+
+
+def _match_keywords(pattern, masks, text):
+    if pattern is None or not text:
+        return 0
+    found = 0
+    for m in pattern.finditer(text.lower()):
+        found |= masks[m.group(1)]
+    return found
+
+
+def row_senders(row):
+    """Кого считать отправителем строки messages: имя, адрес (из "Имя (адрес)") и from_user_id."""
+    senders = []
+    name = (row.get("from_user_name") or "").strip()
+    m = SENDER_EMAIL_RE.match(name)
+    if m:
+        senders.extend(s for s in (m.group(1), m.group(2)) if s)
+    elif name:
+        senders.append(name)
+    if row.get("from_user_id") is not None:
+        senders.append(str(row["from_user_id"]))
+    return senders
+
+
+class RuleSet:
+    def __init__(self, config):
+        self.config = config
+        self.default = int(config.get("default", 3))
+        self.zone = _zone(config.get("timezone", IMPORTANCE_TZ))
+        self.rules = list(config.get("rules", []))
+        self.fingerprint = hashlib.sha1(json.dumps(config, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+        self.importances = []
+        self.unconstrained = dict.fromkeys(CONDITIONS, 0)   # правила без условия данного вида подходят всегда
+        self.senders = {}
+        self.domains = {}
+        self.sources = {}
+        self.title_patterns = []
+        self.hours = []       # [(маска правила, с, до)]
+        self.weekdays = []    # [(маска правила, {дни})]
+        keywords, title_keywords = {}, {}
+        for index, rule in enumerate(self.rules):
+            unknown = set(rule) - set(CONDITIONS) - {"name", "importance"}
+            if unknown:
+                raise ValueError(f"Правило {rule.get('name', index)}: неизвестные поля {', '.join(sorted(unknown))}")
+            bit = 1 << index
+            self.importances.append(int(rule["importance"]))
+            for condition in CONDITIONS:
+                if not rule.get(condition):
+                    self.unconstrained[condition] |= bit
+            for sender in rule.get("senders", ()):
+                self.senders[sender.lower()] = self.senders.get(sender.lower(), 0) | bit
+            for domain in rule.get("domains", ()):
+                domain = domain.lower().lstrip("@")
+                self.domains[domain] = self.domains.get(domain, 0) | bit
+            for source in rule.get("sources", ()):
+                self.sources[source] = self.sources.get(source, 0) | bit
+            for pattern in rule.get("title_patterns", ()):
+                self.title_patterns.append((bit, re.compile(pattern, re.IGNORECASE)))
+            if rule.get("hours"):
+                start, end = rule["hours"]
+                self.hours.append((bit, int(start), int(end)))
+            if rule.get("weekdays"):
+                self.weekdays.append((bit, set(rule["weekdays"])))
+            keywords[index] = rule.get("keywords", ())
+            title_keywords[index] = rule.get("title_keywords", ())
+        self.all_rules = (1 << len(self.rules)) - 1
+        self.keyword_re, self.keyword_masks = _keyword_matcher(keywords)
+        self.title_re, self.title_masks = _keyword_matcher(title_keywords)
+
+    def _sender_mask(self, senders):
+        mask = 0
+        for sender in senders:
+            sender = (sender or "").lower()
+            mask |= self.senders.get(sender, 0)
+            if self.domains and "@" in sender:
+                parts = sender.rsplit("@", 1)[1].split(".")
+                for i in range(len(parts) - 1):
+                    mask |= self.domains.get(".".join(parts[i:]), 0)
+        return mask
+
+    def _time_masks(self, ts):
+        hours = weekdays = 0
+        if ts is None:
+            return hours, weekdays
+        local = datetime.fromtimestamp(ts, self.zone)
+        for bit, start, end in self.hours:
+            if (start <= local.hour < end) if start <= end else (local.hour >= start or local.hour < end):
+                hours |= bit
+        for bit, days in self.weekdays:
+            if local.weekday() in days:
+                weekdays |= bit
+        return hours, weekdays
+
+    def score(self, text="", title="", senders=(), source=None, ts=None):
+        """Важность по полям сообщения; ts — секунды UTC (date_ts)."""
+        if not self.rules:
+            return self.default
+        u = self.unconstrained
+        candidates = self.all_rules
+        candidates &= u["sources"] | self.sources.get(source, 0)
+        if candidates & ~u["senders"] or candidates & ~u["domains"]:
+            sender_mask = self._sender_mask(senders)
+            candidates &= (u["senders"] | sender_mask) & (u["domains"] | sender_mask)
+        if candidates & ~(u["hours"] & u["weekdays"]):
+            hours, weekdays = self._time_masks(ts)
+            candidates &= (u["hours"] | hours) & (u["weekdays"] | weekdays)
+        if candidates & ~u["title_patterns"]:
+            matched = 0
+            for bit, pattern in self.title_patterns:
+                if bit & candidates and pattern.search(title or ""):
+                    matched |= bit
+            candidates &= u["title_patterns"] | matched
+        if candidates & ~u["title_keywords"]:
+            candidates &= u["title_keywords"] | _match_keywords(self.title_re, self.title_masks, title)
+        # текст — самое длинное поле, его смотрим последним и только если он ещё что-то решает
+        if candidates & ~u["keywords"]:
+            candidates &= u["keywords"] | _match_keywords(self.keyword_re, self.keyword_masks, text)
+        if not candidates:
+            return self.default
+        first = (candidates & -candidates).bit_length() - 1
+        return self.importances[first]
+
+    def score_row(self, row):
+        """Важность для строки messages (dict или sqlite3.Row с колонками messages)."""
+        if not isinstance(row, dict):
+            row = dict(zip(row.keys(), row))
+        return self.score(
+            text=row.get("text_content"),
+            title=row.get("chat_title"),
+            senders=row_senders(row),
+            source=row.get("source") or "telegram",
+            ts=row.get("date_ts"),
+        )
+
+
+def load_rules(path=None):
+    path = path or IMPORTANCE_RULES_FILE
+    if not path:
+        return RuleSet(DEFAULT_RULES)
+    with open(path, encoding="utf-8") as f:
+        return RuleSet(json.load(f))
+
+
+_current = None
+_current_mtime = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def current():
+    """Действующие правила; файл перечитывается, если он изменился (не чаще раза в RELOAD_INTERVAL)."""
+    global _current, _current_mtime, _checked_at
+    with _lock:
+        now = time.monotonic()
+        if _current is not None and now - _checked_at < RELOAD_INTERVAL:
+            return _current
+        _checked_at = now
+        mtime = os.path.getmtime(IMPORTANCE_RULES_FILE) if IMPORTANCE_RULES_FILE and os.path.exists(IMPORTANCE_RULES_FILE) else None
+        if _current is None or mtime != _current_mtime:
+            try:
+                _current = load_rules()
+            except (OSError, ValueError, KeyError, re.error) as e:
+                # битый файл не должен ронять ингестор — остаются прежние правила
+                print(f"Не удалось загрузить правила важности: {e}")
+                if _current is None:
+                    _current = RuleSet(DEFAULT_RULES)
+            _current_mtime = mtime
+        return _current
+
+
+def score_row(row):
+    return current().score_row(row)
+
+
+# === Пересчёт истории ===
+RESCORE_COLUMNS = "id, from_user_id, from_user_name, chat_title, text_content, source, date_ts, importance"
+
+
+def init_schema(cursor):
+    cursor.execute("PRAGMA table_info(messages)")
+    if "importance_source" not in {r[1] for r in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE messages ADD COLUMN importance_source TEXT")
+        # раньше правилами считались только письма (email_reader), остальное ставил tg.py
+        cursor.execute("UPDATE messages SET importance_source = ? WHERE source = 'email'", (RULES_SOURCE,))
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS importance_rules_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            fingerprint TEXT NOT NULL,
+            rescored_at TEXT
+        )
+    """)
+
+
+def rescore(conn, rules=None, batch=RESCORE_BATCH):
+    """Пересчитывает важность сообщений, оценённых правилами; пишет только изменившиеся. Возвращает (просмотрено, изменено)."""
+    rules = rules or current()
+    scanned = changed = 0
+    last_id = 0
+    while True:
+        # каждая пачка — отдельное короткое чтение, запись не ждёт окончания всего прохода
+        rows = conn.execute(
+            f"SELECT {RESCORE_COLUMNS} FROM messages WHERE id > ? AND importance_source = ? ORDER BY id LIMIT ?",
+            (last_id, RULES_SOURCE, batch)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        scanned += len(rows)
+        updates = []
+        for row in rows:
+            importance = rules.score(
+                text=row[4], title=row[3],
+                senders=row_senders({"from_user_name": row[2], "from_user_id": row[1]}),
+                source=row[5] or "telegram", ts=row[6],
+            )
+            if importance != row[7]:
+                updates.append((importance, row[0], importance))
+        if updates:
+            # условие на importance — строка могла измениться между чтением и записью
+            storage.write(lambda c: c.executemany(
+                "UPDATE messages SET importance = ? WHERE id = ? AND importance IS NOT ? AND importance_source = 'rules'",
+                updates), conn=conn)
+            changed += len(updates)
+    return scanned, changed
+
+
+def _save_fingerprint(conn, rules):
+    storage.write(lambda c: c.execute("""
+        INSERT INTO importance_rules_state (id, fingerprint, rescored_at) VALUES (1, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET fingerprint = excluded.fingerprint, rescored_at = excluded.rescored_at
+    """, (rules.fingerprint, datetime.utcnow().isoformat())), conn=conn)
+
+
+def rescore_if_changed(conn, rules=None):
+    """Пересчёт, если правила изменились с прошлого раза. Первый запуск только запоминает отпечаток:
+    существующая история посчитана теми же правилами по умолчанию."""
+    rules = rules or current()
+    row = conn.execute("SELECT fingerprint FROM importance_rules_state WHERE id = 1").fetchone()
+    if row is not None and row[0] == rules.fingerprint:
+        return None
+    result = rescore(conn, rules) if row is not None else None
+    _save_fingerprint(conn, rules)
+    return result
+
+
+def run_rescorer(connect, interval=RESCORE_INTERVAL):
+    """Фоновый цикл веб-процесса: следит за файлом правил и пересчитывает историю после изменений."""
+    while True:
+        try:
+            conn = connect()
+            try:
+                result = rescore_if_changed(conn)
+                if result:
+                    print(f"Важность пересчитана: просмотрено {result[0]}, изменено {result[1]}")
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"Ошибка пересчёта важности: {e}")
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Правила важности сообщений")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("rescore", help="пересчитать важность всех сообщений")
+    p.add_argument("--batch", type=int, default=RESCORE_BATCH)
+    p = sub.add_parser("check", help="посчитать важность для одного сообщения")
+    p.add_argument("--text", default="")
+    p.add_argument("--title", default="")
+    p.add_argument("--sender", action="append", default=[])
+    p.add_argument("--source", default="email")
+    p.add_argument("--date", help="ISO-дата, по умолчанию сейчас")
+    args = parser.parse_args()
+
+    rules = load_rules()
+    if args.command == "check":
+        ts = datetime.fromisoformat(args.date).timestamp() if args.date else time.time()
+        print(rules.score(args.text, args.title, args.sender, args.source, int(ts)))
+        return
+    conn = storage.get_connection()
+    try:
+        storage.write(lambda c: init_schema(c.cursor()), conn=conn)
+        started = time.perf_counter()
+        scanned, changed = rescore(conn, rules, args.batch)
+        _save_fingerprint(conn, rules)
+    finally:
+        conn.close()
+    print(f"Просмотрено {scanned}, изменено {changed} за {time.perf_counter() - started:.1f} с")
+
+
+if __name__ == "__main__":
+    main()
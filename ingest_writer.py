@@ -0,0 +1,203 @@
+"""
+Общий путь записи для ингесторов (email_reader.py, tg.py).
+
+Одно долгоживущее соединение (storage.connect), строки копятся в пачку и пишутся одной транзакцией
+(по размеру пачки или по времени). Дубли отсекает уникальный индекс по
+(source, chat_id, message_id) через INSERT OR IGNORE — без предварительного SELECT.
+Если строка пришла без importance, она считается по общим правилам importance.py
+(и помечается importance_source = 'rules' — такие строки пересчитываются при смене правил).
+Исходник сообщения (raw_message, необязательно raw_content_type) пишется не в messages,
+а сжатым в message_raw (см. raw_store) — в той же транзакции, только для вставленных строк.
+Там же вставленные строки попадают в индекс почти-дубликатов (near_dups): MinHash-подписи
+считаются до транзакции, внутри — только поиск кандидатов по LSH-полосам и вставки; из очереди
+near_dups_queue, куда их ставит триггер, эти строки убираются в той же транзакции.
+
+    with IngestWriter() as writer:
+        writer.add({"source": "email", "message_id": "<id@host>", "text_content": "..."})
+        result = writer.flush()   # BatchResult(inserted=1, skipped=0)
+"""
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import importance
+import metrics
+import near_dups
+import raw_store
+import storage
+
+DATABASE = storage.DATABASE
+
+INGESTED = metrics.counter("ingest_messages_total", "Сообщения ингесторов: fetched / inserted / duplicate", ("source", "result"))
+INGEST_LAG = metrics.histogram("ingest_lag_seconds", "Задержка от даты сообщения до записи в БД", ("source",),
+                               buckets=metrics.LAG_BUCKETS)
+FLUSH_SECONDS = metrics.histogram("ingest_flush_seconds", "Время записи пачки", ("source",))
+NEAR_DUPLICATES = metrics.counter("ingest_near_duplicates_total", "Вставленные сообщения — почти-дубликаты уже известных", ("source",))
+
+# Telegram message_id уникален только в пределах чата, поэтому chat_id входит в ключ;
+# у писем chat_id пустой и ключ сводится к (source, Message-ID)
+DEDUP_INDEX = "idx_messages_source_message_id"
+DEDUP_KEY_SQL = "source, IFNULL(chat_id, 0), message_id"
+
+MESSAGE_COLUMNS = (
+    "from_user_id", "from_user_name", "chat_id", "chat_title", "text_content", "media_type", "date",
+    "date_ts", "message_id", "source", "importance", "importance_source", "ai_reply", "app_name", "is_global",
+)
+RAW_FIELDS = ("raw_message", "raw_content_type")
+
+BatchResult = namedtuple("BatchResult", ["inserted", "skipped"])
+
+
+def dedup_key(source, chat_id, message_id):
+    """Ключ уникального индекса в том виде, в каком его можно сравнить со строкой из БД."""
+    return (source or 'telegram', str(chat_id or 0), str(message_id))
+
+
+def date_to_epoch(value):
+    """ISO-дата → секунды UTC (дата без пояса считается UTC, как в SQLite); None, если не разобрать."""
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (TypeError, ValueError):
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def ensure_dedup_index(cursor):
+    """Уникальный индекс для INSERT OR IGNORE; уже накопившиеся дубли удаляются (остаётся самая ранняя строка)."""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (DEDUP_INDEX,))
+    if cursor.fetchone():
+        return
+    cursor.execute(f"""
+        DELETE FROM messages WHERE message_id IS NOT NULL AND id NOT IN (
+            SELECT MIN(id) FROM messages WHERE message_id IS NOT NULL GROUP BY {DEDUP_KEY_SQL}
+        )
+    """)
+    cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {DEDUP_INDEX} ON messages({DEDUP_KEY_SQL})")
+    cursor.execute("DROP INDEX IF EXISTS idx_messages_dedup")
+
+
+class IngestWriter:
+    def __init__(self, database=DATABASE, batch_size=200, flush_interval=2.0):
+        self.conn = storage.connect(database)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.last_flush = time.monotonic()
+        self.total_inserted = 0
+        self.total_skipped = 0
+        storage.write(lambda conn: ensure_dedup_index(conn.cursor()), conn=self.conn)
+        storage.write(lambda conn: near_dups.init_schema(conn.cursor()), conn=self.conn)
+        storage.write(lambda conn: importance.init_schema(conn.cursor()), conn=self.conn)
+
+    def add(self, row):
+        """Ставит строку в очередь; возвращает BatchResult, если пачка при этом записалась, иначе None."""
+        unknown = set(row) - set(MESSAGE_COLUMNS) - set(RAW_FIELDS)
+        if unknown:
+            raise ValueError(f"Неизвестные колонки messages: {', '.join(sorted(unknown))}")
+        if row.get('date') and row.get('date_ts') is None:
+            # date_ts — момент в UTC: по нему сортируются ленты, сравнивать строки с разными поясами нельзя
+            row = dict(row, date_ts=date_to_epoch(row['date']))
+        if row.get('importance') is None:
+            # важность считается одними правилами для всех источников (см. importance.py)
+            row = dict(row, importance=importance.score_row(row), importance_source=importance.RULES_SOURCE)
+        self.pending.append(row)
+        if len(self.pending) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """Пишет накопленное одной транзакцией."""
+        rows, self.pending = self.pending, []
+        self.last_flush = time.monotonic()
+        if not rows:
+            return BatchResult(0, 0)
+
+        # строки с разным набором полей пишем разными INSERT, чтобы не затирать DEFAULT колонок
+        by_columns = {}
+        raw_by_key = {}
+        signature_by_key = {}
+        for row in rows:
+            columns = tuple(c for c in MESSAGE_COLUMNS if c in row)
+            by_columns.setdefault(columns, []).append(tuple(row[c] for c in columns))
+            if row.get('raw_message') and row.get('message_id') is not None:
+                # сжимаем до транзакции, чтобы не держать блокировку записи
+                data, size = raw_store.compress(row['raw_message'])
+                content_type = row.get('raw_content_type') or (
+                    'application/octet-stream' if isinstance(row['raw_message'], bytes) else 'text/plain')
+                raw_by_key[dedup_key(row.get('source'), row.get('chat_id'), row['message_id'])] = (content_type, data, size)
+            if row.get('message_id') is not None and (sig := near_dups.signature(row.get('text_content'))) is not None:
+                signature_by_key[dedup_key(row.get('source'), row.get('chat_id'), row['message_id'])] = sig
+
+        def insert(conn):
+            cursor = conn.cursor()
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM messages")
+            last_id = cursor.fetchone()[0]
+            for columns, values in by_columns.items():
+                cursor.executemany(
+                    f"INSERT OR IGNORE INTO messages ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                    values
+                )
+            # вставленные строки — те, что получили id после last_id (внутри той же транзакции)
+            cursor.execute("SELECT id, source, chat_id, message_id, date_ts FROM messages WHERE id > ?", (last_id,))
+            new_rows = cursor.fetchall()
+            if raw_by_key:
+                raw_store.put_many(cursor, [
+                    (r[0],) + raw_by_key[key] for r in new_rows
+                    if (key := dedup_key(r[1], r[2], r[3])) in raw_by_key
+                ])
+            # по порядку id: копия внутри той же пачки найдёт оригинал, проиндексированный строкой раньше
+            near = []
+            for r in sorted(new_rows, key=lambda r: r[0]):
+                sig = signature_by_key.get(dedup_key(r[1], r[2], r[3]))
+                if sig is not None and near_dups.index_message(cursor, r[0], sig) is not None:
+                    near.append(r[1] or 'telegram')
+            # триггер поставил вставленные строки в очередь near_dups — они уже проиндексированы
+            cursor.execute("DELETE FROM near_dups_queue WHERE message_id > ?", (last_id,))
+            return new_rows, near
+
+        started = time.perf_counter()
+        # при занятой базе пачка повторяется целиком — INSERT OR IGNORE делает повтор безопасным
+        new_rows, near = storage.write(insert, conn=self.conn)
+        inserted = len(new_rows)
+        for source in near:
+            NEAR_DUPLICATES.inc(source=source)
+        self._record_metrics(rows, new_rows, time.perf_counter() - started)
+
+        result = BatchResult(inserted, len(rows) - inserted)
+        self.total_inserted += result.inserted
+        self.total_skipped += result.skipped
+        return result
+
+    @staticmethod
+    def _record_metrics(rows, new_rows, elapsed):
+        now = time.time()
+        by_source = {}
+        for row in rows:
+            source = row.get('source') or 'telegram'
+            by_source[source] = by_source.get(source, 0) + 1
+        for _, source, _, _, date_ts in new_rows:
+            source = source or 'telegram'
+            by_source[source] = by_source.get(source, 0) - 1
+            INGESTED.inc(source=source, result="inserted")
+            if date_ts is not None:
+                INGEST_LAG.observe(max(0, now - date_ts), source=source)
+        for source, duplicates in by_source.items():
+            if duplicates:
+                INGESTED.inc(duplicates, source=source, result="duplicate")
+            FLUSH_SECONDS.observe(elapsed, source=source)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
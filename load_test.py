@@ -0,0 +1,176 @@
+"""
+Нагрузочная проверка слоя storage: читатели и писатели одновременно на одной базе.
+
+- процессы-ингесторы пишут пачки через IngestWriter (как email_reader / tg.py);
+- потоки-читатели дёргают эндпоинты через тестовый клиент Flask;
+- поток веб-записей удаляет и архивирует сообщения через API (storage.write).
+
+В конце печатается JSON со счётчиками, ошибками и задержками; код возврата 1,
+если хоть одна операция упала (например, «database is locked»).
+
+    python load_test.py --seconds 20 --readers 8 --ingestors 3
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+
+def ingest_worker(database, worker, seconds, batch_size, result_queue):
+    from ingest_writer import IngestWriter
+
+    inserted = errors = 0
+    deadline = time.monotonic() + seconds
+    n = 0
+    try:
+        with IngestWriter(database, batch_size=batch_size, flush_interval=0.2) as writer:
+            while time.monotonic() < deadline:
+                n += 1
+                chat = random.randint(1, 30)
+                result = writer.add({
+                    "source": "telegram",
+                    "chat_id": chat,
+                    "chat_title": f"Чат {chat}",
+                    "from_user_id": random.randint(1, 200),
+                    "from_user_name": f"user{worker}",
+                    "message_id": f"{worker}-{n}",
+                    "text_content": f"нагрузка {worker} сообщение {n} срочно проверить отчёт",
+                    "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "importance": random.randint(1, 5),
+                })
+                if result:
+                    inserted += result.inserted
+            inserted += writer.flush().inserted
+    except Exception as e:
+        errors += 1
+        print(f"Ингестор {worker}: {e}", file=sys.stderr)
+    result_queue.put({"inserted": inserted, "errors": errors})
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))] * 1000, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Конкурентная нагрузка на SQLite через storage")
+    parser.add_argument('--db', help="файл базы (по умолчанию — временный)")
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--ingestors', type=int, default=2)
+    parser.add_argument('--batch', type=int, default=50)
+    args = parser.parse_args()
+
+    database = args.db or os.path.join(tempfile.mkdtemp(prefix="load_test_"), "messages.db")
+    os.environ["DATABASE_PATH"] = database
+
+    import app as web
+    import storage
+
+    web.init_db()
+
+    result_queue = multiprocessing.Queue()
+    ingestors = [
+        multiprocessing.Process(target=ingest_worker, args=(database, i, args.seconds, args.batch, result_queue))
+        for i in range(args.ingestors)
+    ]
+    for p in ingestors:
+        p.start()
+
+    latencies = defaultdict(list)
+    failures = defaultdict(int)
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.seconds
+
+    def record(name, started, ok):
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies[name].append(elapsed)
+            if not ok:
+                failures[name] += 1
+
+    def reader():
+        client = web.app.test_client()
+        urls = {
+            "grouped": "/api/grouped_messages?messages_limit=20",
+            "messages": "/api/messages?limit=50",
+            "search": "/api/messages?search=срочно&limit=20",
+            "analysis": "/api/analysis?window=day",
+        }
+        while time.monotonic() < deadline:
+            name = random.choice(list(urls))
+            started = time.perf_counter()
+            try:
+                ok = client.get(urls[name]).status_code in (200, 304)
+            except Exception as e:
+                print(f"{name}: {e}", file=sys.stderr)
+                ok = False
+            record(name, started, ok)
+
+    def web_writer():
+        client = web.app.test_client()
+        while time.monotonic() < deadline:
+            conn = storage.get_connection()
+            row = conn.execute("SELECT id FROM messages ORDER BY random() LIMIT 1").fetchone()
+            conn.close()
+            if row is None:
+                time.sleep(0.05)
+                continue
+            action = random.choice(["delete", "archive"])
+            started = time.perf_counter()
+            try:
+                if action == "delete":
+                    ok = client.delete(f"/api/messages/{row[0]}").status_code == 200
+                else:
+                    ok = client.post("/api/messages/bulk", json={"action": "archive", "ids": [row[0]]}).status_code == 200
+            except Exception as e:
+                print(f"{action}: {e}", file=sys.stderr)
+                ok = False
+            record(action, started, ok)
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=reader) for _ in range(args.readers)]
+    threads.append(threading.Thread(target=web_writer))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    ingested = [result_queue.get() for _ in ingestors]
+    for p in ingestors:
+        p.join()
+
+    report = {
+        "database": database,
+        "seconds": args.seconds,
+        "ingest": {
+            "inserted": sum(r["inserted"] for r in ingested),
+            "rows_per_sec": round(sum(r["inserted"] for r in ingested) / args.seconds, 1),
+            "errors": sum(r["errors"] for r in ingested),
+        },
+        "operations": {
+            name: {
+                "count": len(values),
+                "errors": failures[name],
+                "p50_ms": percentile(values, 0.5),
+                "p95_ms": percentile(values, 0.95),
+                "max_ms": round(max(values) * 1000, 2),
+            }
+            for name, values in sorted(latencies.items())
+        },
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    total_errors = report["ingest"]["errors"] + sum(failures.values())
+    sys.exit(1 if total_errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""
+Метрики в формате Prometheus без внешних зависимостей.
+
+Каждый процесс пишет в свой реестр (REGISTRY): счётчики, gauge и гистограммы с метками.
+Веб-процесс отдаёт их на /metrics. Ингесторы (email_reader, tg.py) — отдельные процессы,
+поэтому их реестр раз в несколько секунд сбрасывается в METRICS_DIR/<процесс>.json
+(start_file_export), а /metrics подмешивает эти снимки с меткой process.
+METRICS_DIR по умолчанию лежит рядом с базой — в docker-compose этот каталог общий.
+
+    REQUESTS = metrics.counter("http_requests_total", "Запросы", ("route",))
+    REQUESTS.inc(route="/api/messages")
+    with metrics.timer(QUERY_SECONDS, query="SELECT messages"):
+        ...
+"""
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR = os.getenv("METRICS_DIR") or os.path.join(
+    os.path.dirname(os.path.abspath(os.getenv("DATABASE_PATH", "messages.db"))), "metrics")
+EXPORT_INTERVAL = float(os.getenv("METRICS_EXPORT_INTERVAL", "5"))
+SNAPSHOT_MAX_AGE = 600   # снимки процессов, которые давно не обновлялись, не показываем
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+LAG_BUCKETS = (1, 5, 15, 60, 300, 900, 3600, 21600, 86400)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def samples(self):
+        """[(суффикс имени, {метки}, значение)] для вывода."""
+        with self.lock:
+            items = list(self.values.items())
+        return [("", dict(zip(self.labels, key)), value) for key, value in items]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self.lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items()]
+        result = []
+        for key, (counts, total, count) in items:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                result.append(("_bucket", dict(labels, le=_format_value(bound)), cumulative))
+            result.append(("_sum", labels, total))
+            result.append(("_count", labels, count))
+        return result
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            # повторная регистрация (перезагрузка модуля) возвращает уже существующую метрику
+            return self.metrics.setdefault(metric.name, metric)
+
+    def snapshot(self):
+        """Сериализуемый снимок: {имя: {type, help, samples: [[суффикс, метки, значение]]}}."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {m.name: {"type": m.kind, "help": m.help, "samples": [list(s) for s in m.samples()]} for m in metrics}
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help_text, labels=()):
+    return REGISTRY.register(Counter(name, help_text, labels))
+
+
+def gauge(name, help_text, labels=()):
+    return REGISTRY.register(Gauge(name, help_text, labels))
+
+
+def histogram(name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, help_text, labels, buckets))
+
+
+@contextmanager
+def timer(metric, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric.observe(time.perf_counter() - started, **labels)
+
+
+# === Вывод в текстовом формате Prometheus ===
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render(snapshots):
+    """snapshots — [(метки процесса, снимок)]; одноимённые метрики разных процессов выводятся вместе."""
+    families = {}
+    for extra, snapshot in snapshots:
+        for name, family in snapshot.items():
+            merged = families.setdefault(name, {"type": family["type"], "help": family["help"], "samples": []})
+            merged["samples"].extend((suffix, dict(labels, **extra), value) for suffix, labels, value in family["samples"])
+
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for suffix, labels, value in family["samples"]:
+            label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+            lines.append(f"{name}{suffix}{{{label_text}}} {_format_value(value)}" if label_text
+                         else f"{name}{suffix} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# === Обмен снимками между процессами ===
+def write_snapshot(process, directory=None):
+    directory = directory or METRICS_DIR
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{process}.json")
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"process": process, "pid": os.getpid(), "written_at": time.time(), "metrics": REGISTRY.snapshot()}, f)
+    os.replace(tmp, path)   # читатель видит либо старый, либо новый файл целиком
+
+
+def start_file_export(process, interval=EXPORT_INTERVAL, directory=None):
+    """Фоновый поток: раз в interval секунд сбрасывает реестр процесса в METRICS_DIR/<process>.json."""
+    def loop():
+        while True:
+            try:
+                write_snapshot(process, directory)
+            except OSError as e:
+                print(f"Не удалось записать метрики: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name="metrics-export", daemon=True)
+    thread.start()
+    return thread
+
+
+def read_snapshots(directory=None, exclude=()):
+    """Свежие снимки других процессов: [(метки процесса, снимок)]."""
+    directory = directory or METRICS_DIR
+    result = []
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return result
+    now = time.time()
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name), encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if data.get("process") in exclude or now - data.get("written_at", 0) > SNAPSHOT_MAX_AGE:
+            continue
+        snapshot = dict(data["metrics"])
+        snapshot["metrics_snapshot_age_seconds"] = {
+            "type": "gauge", "help": "Возраст снимка метрик процесса",
+            "samples": [["", {}, round(now - data["written_at"], 3)]],
+        }
+        result.append(({"process": data["process"]}, snapshot))
+    return result
+
+
+def exposition(process):
+    """Текст для /metrics: реестр текущего процесса и снимки остальных."""
+    return render([({"process": process}, REGISTRY.snapshot())] + read_snapshots(exclude=(process,)))
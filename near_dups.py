@@ -0,0 +1,294 @@
+"""
+Поиск почти-дубликатов: одно и то же объявление письмом, пересылкой в три чата и цитатой в ответе.
+
+У каждого сообщения (от DUP_MIN_WORDS слов) считается MinHash-подпись из NUM_PERM значений
+по словным биграммам. Подпись режется на BANDS полос по ROWS значений; хэш полосы — ключ
+в minhash_bands (LSH). Кандидаты — сообщения, совпавшие хотя бы в одной полосе: поиск идёт
+по индексу, а не по всей истории. Кандидат признаётся дубликатом, если доля совпавших значений
+подписи (оценка сходства Жаккара) не меньше NEAR_DUP_THRESHOLD.
+
+Дубликат ссылается на каноническое сообщение — самое раннее в кластере:
+message_duplicates(message_id → canonical_id). При удалении канонического его место занимает
+следующий по id дубликат (триггер). Подписи считает IngestWriter при записи пачки; всё остальное —
+сообщения, вставленные в обход него, изменённый text_content и история, накопленная до появления
+индекса, — триггеры ставят в очередь near_dups_queue (как term_queue у term_stats). Очередь разбирает
+фоновый поток веб-процесса (run_indexer) или вручную:
+
+    python near_dups.py backfill
+
+/api/grouped_messages?collapse=1 и /api/analysis?collapse=1 прячут дубликаты и показывают
+у канонического сообщения, в скольких местах оно встречалось (seen_in).
+"""
+import argparse
+import hashlib
+import os
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+
+import storage
+
+NUM_PERM = 32
+BANDS = 8
+ROWS = NUM_PERM // BANDS     # порог срабатывания LSH ≈ (1/BANDS) ** (1/ROWS) ≈ 0.6
+DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.7"))
+DUP_MIN_WORDS = int(os.getenv("NEAR_DUP_MIN_WORDS", "8"))   # короткие «ок», «спасибо» дубликатами не считаем
+BAND_CANDIDATES = 50         # кандидатов на полосу: популярная полоса (шаблонная подпись) не раздувает поиск
+QUEUE_BATCH = 500          # подписи из очереди считаются внутри транзакции — пачка небольшая
+
+_MERSENNE = (1 << 61) - 1
+_rng = random.Random(20240101)   # фиксированное зерно: подписи должны совпадать между процессами и запусками
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE), _rng.randrange(0, _MERSENNE)) for _ in range(NUM_PERM)]
+_SIGNATURE = struct.Struct(f"<{NUM_PERM}Q")
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+URL_RE = re.compile(r'https?://\S+')
+
+_queue_lock = threading.Lock()   # один разборщик очереди на процесс
+
+
+def _forget_message_sql(ref):
+    return f"""DELETE FROM minhash_bands WHERE message_id = {ref}.id;
+            DELETE FROM message_minhash WHERE message_id = {ref}.id;
+            DELETE FROM message_duplicates WHERE message_id = {ref}.id;
+            -- канонический удалён: самый ранний дубликат становится каноническим для остальных
+            UPDATE message_duplicates SET canonical_id = (SELECT MIN(message_id) FROM message_duplicates WHERE canonical_id = {ref}.id)
+                WHERE canonical_id = {ref}.id
+                  AND message_id != (SELECT MIN(message_id) FROM message_duplicates WHERE canonical_id = {ref}.id);
+            DELETE FROM message_duplicates WHERE canonical_id = {ref}.id;"""
+
+
+def init_schema(cursor):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'near_dups_queue'")
+    existed = cursor.fetchone() is not None
+
+    cursor.executescript(f"""
+        CREATE TABLE IF NOT EXISTS message_minhash (
+            message_id INTEGER PRIMARY KEY,
+            signature BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS minhash_bands (
+            band INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            PRIMARY KEY (band, bucket, message_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_minhash_bands_message ON minhash_bands(message_id);
+        CREATE TABLE IF NOT EXISTS message_duplicates (
+            message_id INTEGER PRIMARY KEY,
+            canonical_id INTEGER NOT NULL,
+            similarity REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_message_duplicates_canonical ON message_duplicates(canonical_id);
+        -- id сообщений, которые ещё нужно (пере)индексировать
+        CREATE TABLE IF NOT EXISTS near_dups_queue (
+            message_id INTEGER PRIMARY KEY
+        );
+
+        CREATE TRIGGER IF NOT EXISTS near_dups_on_insert AFTER INSERT ON messages BEGIN
+            INSERT OR IGNORE INTO near_dups_queue (message_id) VALUES (NEW.id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS near_dups_on_delete AFTER DELETE ON messages BEGIN
+            {_forget_message_sql('OLD')}
+        END;
+        -- новый текст — новая подпись: старые полосы и связи убираются сразу, подпись считает очередь
+        CREATE TRIGGER IF NOT EXISTS near_dups_on_text_update AFTER UPDATE OF text_content ON messages
+        WHEN OLD.text_content IS NOT NEW.text_content BEGIN
+            {_forget_message_sql('OLD')}
+            INSERT OR IGNORE INTO near_dups_queue (message_id) VALUES (NEW.id);
+        END;
+    """)
+
+    if not existed:
+        # первая инициализация: в очередь встаёт вся ещё не проиндексированная история
+        cursor.execute("""INSERT OR IGNORE INTO near_dups_queue (message_id)
+                          SELECT id FROM messages WHERE id NOT IN (SELECT message_id FROM message_minhash)""")
+
+
+# === Подписи ===
+def shingles(text):
+    """Хэши словных биграмм; None, если слов меньше DUP_MIN_WORDS."""
+    text = URL_RE.sub(' ', (text or '').lower().replace('ё', 'е'))
+    words = WORD_RE.findall(text)
+    if len(words) < DUP_MIN_WORDS:
+        return None
+    return {zlib.crc32(f"{a} {b}".encode('utf-8')) for a, b in zip(words, words[1:])}
+
+
+def signature(text):
+    """MinHash-подпись текста (кортеж NUM_PERM чисел) или None для слишком коротких."""
+    hashes = shingles(text)
+    if not hashes:
+        return None
+    return tuple(min((a * x + b) % _MERSENNE for x in hashes) for a, b in _PERMUTATIONS)
+
+
+def similarity(sig_a, sig_b):
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / NUM_PERM
+
+
+def band_buckets(sig):
+    """[(номер полосы, ключ полосы)] — ключ стабилен между процессами (blake2b, а не hash())."""
+    result = []
+    for band in range(BANDS):
+        chunk = struct.pack(f"<{ROWS}Q", *sig[band * ROWS:(band + 1) * ROWS])
+        result.append((band, int.from_bytes(hashlib.blake2b(chunk, digest_size=8).digest(), 'little', signed=True)))
+    return result
+
+
+# === Индекс ===
+def find_canonical(cursor, sig, buckets=None):
+    """(canonical_id, сходство) самого похожего уже проиндексированного сообщения или None."""
+    buckets = buckets or band_buckets(sig)
+    query = " UNION ".join(
+        "SELECT * FROM (SELECT message_id FROM minhash_bands WHERE band = ? AND bucket = ? ORDER BY message_id DESC LIMIT ?)"
+        for _ in buckets)
+    cursor.execute(query, [v for band, bucket in buckets for v in (band, bucket, BAND_CANDIDATES)])
+    candidates = [r[0] for r in cursor.fetchall()]
+    if not candidates:
+        return None
+    cursor.execute(
+        f"SELECT message_id, signature FROM message_minhash WHERE message_id IN ({','.join('?' * len(candidates))})",
+        candidates)
+    best = None
+    for message_id, blob in cursor.fetchall():
+        score = similarity(sig, _SIGNATURE.unpack(blob))
+        # при равном сходстве — более раннее сообщение
+        if score >= DUP_THRESHOLD and (best is None or (score, -message_id) > (best[1], -best[0])):
+            best = (message_id, score)
+    if best is None:
+        return None
+    cursor.execute("SELECT canonical_id FROM message_duplicates WHERE message_id = ?", (best[0],))
+    row = cursor.fetchone()
+    return (row[0] if row else best[0]), best[1]
+
+
+def index_message(cursor, message_id, sig):
+    """Ищет дубликат среди истории, затем добавляет подпись в индекс. Возвращает canonical_id или None."""
+    buckets = band_buckets(sig)
+    found = find_canonical(cursor, sig, buckets)
+    if found is not None and found[0] != message_id:
+        # DELETE + INSERT, а не REPLACE: на удалении срабатывает триггер счётчиков term_stats
+        cursor.execute("DELETE FROM message_duplicates WHERE message_id = ?", (message_id,))
+        cursor.execute("INSERT INTO message_duplicates (message_id, canonical_id, similarity) VALUES (?, ?, ?)",
+                       (message_id, found[0], found[1]))
+    cursor.execute("INSERT OR REPLACE INTO message_minhash (message_id, signature) VALUES (?, ?)",
+                   (message_id, _SIGNATURE.pack(*sig)))
+    cursor.executemany("INSERT OR IGNORE INTO minhash_bands (band, bucket, message_id) VALUES (?, ?, ?)",
+                       [(band, bucket, message_id) for band, bucket in buckets])
+    return found[0] if found is not None and found[0] != message_id else None
+
+
+def _process_batch(conn, batch):
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT q.message_id, m.id AS alive, m.text_content
+        FROM near_dups_queue q LEFT JOIN messages m ON m.id = q.message_id
+        ORDER BY q.message_id LIMIT ?
+    """, (batch,))
+    rows = cursor.fetchall()
+    duplicates = 0
+    for message_id, alive, text in rows:
+        if alive is None:
+            continue
+        # повторная индексация (текст изменён) начинается с чистого листа; короткий текст — без подписи
+        cursor.execute("DELETE FROM minhash_bands WHERE message_id = ?", (message_id,))
+        cursor.execute("DELETE FROM message_minhash WHERE message_id = ?", (message_id,))
+        cursor.execute("DELETE FROM message_duplicates WHERE message_id = ?", (message_id,))
+        sig = signature(text)
+        if sig is not None and index_message(cursor, message_id, sig) is not None:
+            duplicates += 1
+    cursor.executemany("DELETE FROM near_dups_queue WHERE message_id = ?", [(r[0],) for r in rows])
+    return len(rows), duplicates
+
+
+def process_queue(conn, max_items=None, batch=QUEUE_BATCH):
+    """Разбирает очередь пачками (каждая — своя транзакция записи). Возвращает (обработано, дубликатов)."""
+    processed = duplicates = 0
+    with _queue_lock:
+        while max_items is None or processed < max_items:
+            size = batch if max_items is None else min(batch, max_items - processed)
+            count, found = storage.write(lambda c: _process_batch(c, size), conn=conn)
+            if not count:
+                break
+            processed += count
+            duplicates += found
+    return processed, duplicates
+
+
+def run_indexer(connect, interval=2.0):
+    """Фоновый цикл веб-процесса: периодически разбирает очередь. connect — фабрика соединений."""
+    while True:
+        try:
+            conn = connect()
+            try:
+                processed, duplicates = process_queue(conn)
+            finally:
+                conn.close()
+            if processed >= QUEUE_BATCH:
+                print(f"Почти-дубликаты: проиндексировано {processed} сообщений, найдено {duplicates}")
+        except Exception as e:
+            print(f"Ошибка индексатора почти-дубликатов: {e}")
+        time.sleep(interval)
+
+
+# === Сворачивание в выдаче ===
+def duplicate_info(cursor, ids):
+    """
+    Для id из выдачи: (множество id-дубликатов, {canonical_id: {"copies": n, "seen_in": мест}}).
+    Место — переписка (group_key): письмо и пересылки в три чата — 4 места.
+    """
+    ids = list(ids)
+    if not ids:
+        return set(), {}
+    marks = ','.join('?' * len(ids))
+    cursor.execute(f"SELECT message_id FROM message_duplicates WHERE message_id IN ({marks})", ids)
+    duplicates = {r[0] for r in cursor.fetchall()}
+    cursor.execute(f"""
+        SELECT d.canonical_id, COUNT(*) AS copies,
+               COUNT(DISTINCT CASE WHEN m.group_key != c.group_key THEN m.group_key END) AS other_places
+        FROM message_duplicates d
+        JOIN messages m ON m.id = d.message_id
+        JOIN messages c ON c.id = d.canonical_id
+        WHERE d.canonical_id IN ({marks})
+        GROUP BY d.canonical_id
+    """, ids)
+    canonical = {r[0]: {"copies": r[1], "seen_in": r[2] + 1} for r in cursor.fetchall()}
+    return duplicates, canonical
+
+
+def collapse_messages(cursor, messages):
+    """Убирает дубликаты из списка сообщений (dict с id) и проставляет seen_in / copies каноническим."""
+    duplicates, canonical = duplicate_info(cursor, [m['id'] for m in messages])
+    result = []
+    for m in messages:
+        if m['id'] in duplicates:
+            continue
+        info = canonical.get(m['id'])
+        if info:
+            m.update(info)
+        result.append(m)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Почти-дубликаты сообщений (MinHash + LSH)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("backfill", help="разобрать очередь: история до появления индекса, изменённые сообщения")
+    p.add_argument("--batch", type=int, default=QUEUE_BATCH)
+    args = parser.parse_args()
+
+    conn = storage.get_connection()
+    try:
+        storage.write(lambda c: init_schema(c.cursor()), conn=conn)
+        processed, duplicates = process_queue(conn, batch=args.batch)
+    finally:
+        conn.close()
+    print(f"Просмотрено {processed}, найдено дубликатов {duplicates}")
+
+
+if __name__ == "__main__":
+    main()
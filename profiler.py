@@ -0,0 +1,94 @@
+"""
+Сэмплирующий профайлер для медленных роутов.
+
+Включается переменной PROFILE_ROUTES: список правил роутов через запятую
+("/api/analysis,/api/grouped_messages") или "*" для всех. Пока такой запрос
+обслуживается, фоновый поток раз в PROFILE_INTERVAL секунд снимает стек его потока
+(sys._current_frames) и копит стеки в свёрнутом виде — по строке на стек:
+
+    app.py:analysis;term_stats.py:top_terms 42
+
+Это формат flamegraph.pl / speedscope; отдаётся эндпоинтом /debug/profile — только при
+заданном PROFILE_ROUTES и только на запросы с localhost (в docker: docker compose exec web ...).
+Без PROFILE_ROUTES профайлер не запускается и запросы не замедляет.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+PROFILE_ROUTES = {r.strip() for r in os.getenv("PROFILE_ROUTES", "").split(",") if r.strip()}
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+MAX_STACKS = 10000   # разных стеков на роут; дальше новые стеки не добавляются
+
+
+def _fold(frame):
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+
+class SamplingProfiler:
+    def __init__(self, routes=(), interval=PROFILE_INTERVAL):
+        self.routes = set(routes)
+        self.interval = interval
+        self.active = {}        # id потока → роут
+        self.stacks = {}        # роут → Counter(свёрнутый стек → число сэмплов)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)   # появился активный запрос
+        self.thread = None
+
+    def enabled_for(self, route):
+        return "*" in self.routes or route in self.routes
+
+    def start_request(self, route):
+        with self.lock:
+            self.active[threading.get_ident()] = route
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self.thread.start()
+            self.wakeup.notify()
+
+    def stop_request(self):
+        with self.lock:
+            self.active.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                # проверка и ожидание под одним замком: start_request между ними не потеряется
+                self.wakeup.wait_for(lambda: self.active)
+                active = dict(self.active)
+            frames = sys._current_frames()
+            with self.lock:
+                for thread_id, route in active.items():
+                    frame = frames.get(thread_id)
+                    if frame is None:
+                        continue
+                    counter = self.stacks.setdefault(route, Counter())
+                    stack = _fold(frame)
+                    if stack in counter or len(counter) < MAX_STACKS:
+                        counter[stack] += 1
+            del frames
+            time.sleep(self.interval)
+
+    def folded(self, route=None):
+        """Накопленные стеки в свёрнутом виде; route=None — по всем роутам (роут становится корнем стека)."""
+        with self.lock:
+            items = [(r, dict(c)) for r, c in self.stacks.items() if route is None or r == route]
+        lines = []
+        for r, counter in items:
+            for stack, count in sorted(counter.items(), key=lambda kv: -kv[1]):
+                lines.append(f"{stack if route else r + ';' + stack} {count}")
+        return "\n".join(lines) + ("\n" if lines else "")
+
+    def reset(self):
+        with self.lock:
+            self.stacks.clear()
+
+
+PROFILER = SamplingProfiler(PROFILE_ROUTES)
@@ -0,0 +1,91 @@
+"""
+Холодное хранилище исходных сообщений (заголовки письма, JSON апдейта Telegram и т.п.).
+
+Хранится то, что ингестор скачал: для писем — заголовки (text/rfc822-headers), тело целиком
+email_reader не загружает; письмо полностью (message/rfc822) — только когда BODYSTRUCTURE
+непригоден и письмо пришлось скачать целиком.
+
+Исходники не нужны ни одной ленте, поэтому живут не в messages, а в отдельной таблице
+message_raw, сжатые zlib, с ключом id сообщения. Читаются только по запросу —
+через /api/messages/<id>/raw. Строка удаляется вместе с сообщением; в архив месяца
+(retention) исходник копируется до удаления.
+
+Раньше исходник лежал в колонке messages.raw_message (обрезанный до 1000 символов);
+init_schema переносит такие значения сюда и удаляет колонку — страницы горячей
+таблицы становятся заметно меньше.
+"""
+import sqlite3
+import zlib
+
+ENCODING = "zlib"
+COMPRESS_LEVEL = 6
+LEGACY_CONTENT_TYPE = "text/plain; legacy"   # перенесённые из messages.raw_message (обрезанные) значения
+MIGRATE_BATCH = 1000
+
+
+def compress(data):
+    """str/bytes → (сжатые байты, исходный размер)."""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return zlib.compress(data, COMPRESS_LEVEL), len(data)
+
+
+def init_schema(cursor):
+    cursor.executescript("""
+        CREATE TABLE IF NOT EXISTS message_raw (
+            message_id INTEGER PRIMARY KEY,
+            content_type TEXT NOT NULL,
+            encoding TEXT NOT NULL DEFAULT 'zlib',
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+        CREATE TRIGGER IF NOT EXISTS message_raw_delete AFTER DELETE ON messages BEGIN
+            DELETE FROM message_raw WHERE message_id = OLD.id;
+        END;
+    """)
+    cursor.execute("PRAGMA table_info(messages)")
+    if "raw_message" in {r[1] for r in cursor.fetchall()}:
+        migrate_legacy_column(cursor)
+
+
+def migrate_legacy_column(cursor):
+    """Одноразово: переносит messages.raw_message в message_raw и удаляет колонку."""
+    last_id = 0
+    while True:
+        cursor.execute("""
+            SELECT id, raw_message FROM messages
+            WHERE id > ? AND raw_message IS NOT NULL AND raw_message != ''
+            ORDER BY id LIMIT ?
+        """, (last_id, MIGRATE_BATCH))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        items = []
+        for message_id, raw in rows:
+            data, size = compress(raw)
+            items.append((message_id, LEGACY_CONTENT_TYPE, data, size))
+        put_many(cursor, items)
+        last_id = rows[-1][0]
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        # DROP COLUMN перезаписывает таблицу — исходники уходят со страниц messages
+        cursor.execute("ALTER TABLE messages DROP COLUMN raw_message")
+    else:
+        cursor.execute("UPDATE messages SET raw_message = NULL WHERE raw_message IS NOT NULL")
+
+
+def put_many(cursor, items):
+    """items — [(message_id, content_type, сжатые байты, исходный размер)]."""
+    cursor.executemany(
+        "INSERT OR REPLACE INTO message_raw (message_id, content_type, encoding, size, data) VALUES (?, ?, ?, ?, ?)",
+        [(message_id, content_type, ENCODING, size, data) for message_id, content_type, data, size in items]
+    )
+
+
+def load(cursor, message_id):
+    """(content_type, исходные байты) или None."""
+    cursor.execute("SELECT content_type, encoding, data FROM message_raw WHERE message_id = ?", (message_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    data = zlib.decompress(row[2]) if row[1] == ENCODING else row[2]
+    return row[0], data
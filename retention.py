@@ -0,0 +1,424 @@
+"""
+Срок хранения сообщений, помесячные архивы и постепенное освобождение места.
+
+Политики — JSON-список в RETENTION_POLICIES_FILE; для каждого сообщения действует первая
+подошедшая политика (как в правилах важности):
+
+    [
+      {"importance_min": 5, "days": null},                      # самое важное не трогаем
+      {"importance_max": 2, "days": 30},                        # неважное — 30 дней
+      {"source": "email", "days": 365, "action": "archive"},
+      {"days": 730, "action": "delete"}
+    ]
+
+Поля: source (строка или список), importance_min / importance_max, days (null — хранить всегда),
+action — archive (по умолчанию) или delete. Без файла сообщения не трогаются.
+
+archive переносит сообщения (и их исходники из message_raw) в отдельные базы по месяцам
+ARCHIVE_DIR/messages-YYYY-MM.db со своим FTS-индексом: горячая база и все её индексы растут
+только на объём, который разрешают политики, а архив ищется по запросу (/api/archive/messages).
+Перенос идёт пачками: сначала строки пишутся в архив, потом удаляются из горячей базы —
+повтор после сбоя безопасен (INSERT в архив идёт по id с заменой).
+
+Место от удалённых строк возвращается через auto_vacuum=INCREMENTAL: после прохода
+PRAGMA incremental_vacuum отдаёт свободные страницы шагами по VACUUM_STEP_PAGES, каждый шаг —
+отдельная короткая запись. Новые базы создаются с INCREMENTAL сразу, существующие переводит
+одноразовый полный VACUUM: python retention.py convert.
+
+    python retention.py run [--dry-run]
+    python retention.py vacuum
+    python retention.py convert
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+import metrics
+import storage
+
+DATABASE = storage.DATABASE
+RETENTION_POLICIES_FILE = os.getenv("RETENTION_POLICIES_FILE")
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR") or os.path.join(os.path.dirname(os.path.abspath(DATABASE)), "archive")
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "500"))
+VACUUM_STEP_PAGES = int(os.getenv("VACUUM_STEP_PAGES", "256"))
+STEP_PAUSE = 0.05   # пауза между пачками и шагами вакуума — даём пройти ингесторам
+
+ARCHIVE_FILE_RE = re.compile(r'messages-(\d{4}-\d{2})\.db$')
+ARCHIVE_FIELDS = (
+    "id", "from_user_id", "from_user_name", "chat_id", "chat_title", "text_content", "media_type", "date",
+    "date_ts", "message_id", "source", "importance", "ai_reply", "app_name", "is_global",
+)
+ARCHIVE_COLUMNS = ", ".join(ARCHIVE_FIELDS)
+FTS_COLUMNS = ('text_content', 'chat_title', 'from_user_name')
+
+RETAINED = metrics.counter("retention_messages_total", "Сообщения, ушедшие по сроку хранения", ("action",))
+VACUUMED = metrics.counter("sqlite_incremental_vacuum_pages_total", "Страницы, возвращённые incremental_vacuum")
+
+
+# === Политики ===
+def load_policies(path=None):
+    path = path or RETENTION_POLICIES_FILE
+    if not path:
+        return []
+    with open(path, encoding="utf-8") as f:
+        policies = json.load(f)
+    for policy in policies:
+        if policy.get("action", "archive") not in ("archive", "delete"):
+            raise ValueError(f"Неизвестное действие политики: {policy['action']}")
+    return policies
+
+
+def _policy_match_sql(policy):
+    conditions, params = [], []
+    sources = policy.get("source")
+    if sources:
+        sources = [sources] if isinstance(sources, str) else list(sources)
+        conditions.append(f"source IN ({','.join('?' * len(sources))})")
+        params.extend(sources)
+    if policy.get("importance_min") is not None:
+        conditions.append("importance >= ?")
+        params.append(int(policy["importance_min"]))
+    if policy.get("importance_max") is not None:
+        conditions.append("importance <= ?")
+        params.append(int(policy["importance_max"]))
+    return " AND ".join(conditions) or "1", params
+
+
+def policy_condition(policies, index, now=None):
+    """WHERE для строк, которые по политике index пора убрать: подходят под неё, не подходят под предыдущие, старше days."""
+    policy = policies[index]
+    match, params = _policy_match_sql(policy)
+    conditions = [f"({match})"]
+    for earlier in policies[:index]:
+        sql, earlier_params = _policy_match_sql(earlier)
+        conditions.append(f"NOT ({sql})")
+        params += earlier_params
+    cutoff = int((now or time.time()) - int(policy["days"]) * 86400)
+    conditions.append("date_ts < ?")
+    params.append(cutoff)
+    return " AND ".join(conditions), params
+
+
+# === Архивные базы ===
+def archive_path(month):
+    return os.path.join(ARCHIVE_DIR, f"messages-{month}.db")
+
+
+def month_of(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m")
+
+
+def archive_months():
+    """Месяцы, по которым есть архивные базы, по возрастанию."""
+    months = []
+    for path in glob.glob(os.path.join(ARCHIVE_DIR, "messages-*.db")):
+        m = ARCHIVE_FILE_RE.search(path)
+        if m:
+            months.append(m.group(1))
+    return sorted(months)
+
+
+def _fts_values(ref):
+    # ё → е, как в messages_fts горячей базы
+    return ', '.join(f"replace(replace({ref}.{c}, 'ё', 'е'), 'Ё', 'Е')" for c in FTS_COLUMNS)
+
+
+def init_archive(conn):
+    conn.executescript(f"""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            from_user_id INTEGER,
+            from_user_name TEXT,
+            chat_id INTEGER,
+            chat_title TEXT,
+            text_content TEXT,
+            media_type TEXT,
+            date TEXT,
+            date_ts INTEGER,
+            message_id INTEGER,
+            source TEXT,
+            importance INTEGER,
+            ai_reply TEXT,
+            app_name TEXT,
+            is_global INTEGER,
+            archived_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(date_ts, id);
+        CREATE TABLE IF NOT EXISTS message_raw (
+            message_id INTEGER PRIMARY KEY,
+            content_type TEXT NOT NULL,
+            encoding TEXT NOT NULL DEFAULT 'zlib',
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            {', '.join(FTS_COLUMNS)},
+            content='messages', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        );
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, {', '.join(FTS_COLUMNS)}) VALUES (NEW.id, {_fts_values('NEW')});
+        END;
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, {', '.join(FTS_COLUMNS)}) VALUES ('delete', OLD.id, {_fts_values('OLD')});
+        END;
+    """)
+
+
+def copy_to_archive(month, ids, database=DATABASE):
+    """Копирует сообщения и их исходники в архив месяца одной транзакцией архивной базы."""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    conn = sqlite3.connect(archive_path(month), timeout=storage.BUSY_TIMEOUT_MS / 1000)
+    try:
+        init_archive(conn)
+        conn.execute("ATTACH DATABASE ? AS hot", (database,))
+        marks = ','.join('?' * len(ids))
+        with conn:
+            # DELETE + INSERT, а не REPLACE: так срабатывают триггеры FTS
+            conn.execute(f"DELETE FROM messages WHERE id IN ({marks})", ids)
+            conn.execute(f"""
+                INSERT INTO messages ({ARCHIVE_COLUMNS}, archived_at)
+                SELECT {ARCHIVE_COLUMNS}, ? FROM hot.messages WHERE id IN ({marks})
+            """, [datetime.utcnow().isoformat()] + ids)
+            conn.execute(f"""
+                INSERT OR REPLACE INTO message_raw SELECT * FROM hot.message_raw WHERE message_id IN ({marks})
+            """, ids)
+        conn.execute("DETACH DATABASE hot")
+    finally:
+        conn.close()
+
+
+def apply_policies(conn, policies=None, batch=RETENTION_BATCH, dry_run=False, database=DATABASE):
+    """Применяет политики; возвращает {"archived": n, "deleted": n} (при dry_run — сколько было бы)."""
+    policies = load_policies() if policies is None else policies
+    stats = {"archived": 0, "deleted": 0}
+    for index, policy in enumerate(policies):
+        if policy.get("days") is None:
+            continue
+        where, params = policy_condition(policies, index)
+        action = policy.get("action", "archive")
+        key = "archived" if action == "archive" else "deleted"
+        if dry_run:
+            stats[key] += conn.execute(f"SELECT COUNT(*) FROM messages WHERE {where}", params).fetchone()[0]
+            continue
+        moved = move_messages(conn, where, params, archive=action == "archive", batch=batch, database=database)
+        stats[key] += moved
+        RETAINED.inc(moved, action=action)
+    return stats
+
+
+def archive_by_month(rows, database=DATABASE):
+    """[(id, date_ts)] → копии в архивах месяцев; сообщения без date_ts — в архив текущего месяца."""
+    by_month = {}
+    for message_id, ts in rows:
+        by_month.setdefault(month_of(ts if ts is not None else time.time()), []).append(message_id)
+    for month, month_ids in by_month.items():
+        copy_to_archive(month, month_ids, database)
+
+
+def archive_selection(conn, where, params, batch=RETENTION_BATCH, database=DATABASE):
+    """
+    «Обработано» из /api/messages/bulk: выборка уходит из горячей базы целиком или не уходит совсем.
+    Сначала все строки копируются в архивы месяцев (пачками, по id с заменой), затем удаляются
+    одной транзакцией горячей базы. Сбой до удаления оставляет горячую базу как была, а копии
+    в архиве заменит повтор. Возвращает число перенесённых сообщений.
+    """
+    rows = conn.execute(f"SELECT id, date_ts FROM messages WHERE {where} ORDER BY date_ts, id", params).fetchall()
+    for start in range(0, len(rows), batch):
+        archive_by_month(rows[start:start + batch], database)
+    ids = [r[0] for r in rows]
+
+    def delete(c):
+        for start in range(0, len(ids), batch):
+            chunk = ids[start:start + batch]
+            c.execute(f"DELETE FROM messages WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+    if ids:
+        storage.write(delete, conn=conn)
+    return len(ids)
+
+
+def move_messages(conn, where, params, archive=True, batch=RETENTION_BATCH, database=DATABASE):
+    """
+    Убирает из горячей базы сообщения под условием WHERE пачками по batch: при archive —
+    сначала копия в архив месяца, потом удаление. Каждая пачка — своя транзакция: после сбоя
+    часть сообщений уже перенесена, следующий проход политик доделает остальное.
+    Возвращает число сообщений.
+    """
+    moved = 0
+    while True:
+        rows = conn.execute(
+            f"SELECT id, date_ts FROM messages WHERE {where} ORDER BY date_ts, id LIMIT ?", list(params) + [batch]
+        ).fetchall()
+        if not rows:
+            return moved
+        ids = [r[0] for r in rows]
+        if archive:
+            archive_by_month(rows, database)
+        # триггеры messages обновят conversations, FTS, term_stats и журнал изменений
+        storage.write(lambda c: c.execute(
+            f"DELETE FROM messages WHERE id IN ({','.join('?' * len(ids))})", ids), conn=conn)
+        moved += len(ids)
+        time.sleep(STEP_PAUSE)
+
+
+# === Освобождение места ===
+def auto_vacuum_mode(conn):
+    return conn.execute("PRAGMA auto_vacuum").fetchone()[0]   # 0 — NONE, 1 — FULL, 2 — INCREMENTAL
+
+
+def ensure_incremental_vacuum(conn):
+    """Вызывается до создания таблиц: новая база сразу получает INCREMENTAL, для старой — подсказка."""
+    if auto_vacuum_mode(conn) == 2:
+        return True
+    if conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+        # файл уже создан переключением в WAL, поэтому режим применяет VACUUM — на пустой базе он мгновенный
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return auto_vacuum_mode(conn) == 2
+    print("База без auto_vacuum=INCREMENTAL: место после удалений не возвращается. "
+          "Переведите её один раз: python retention.py convert")
+    return False
+
+
+def _vacuum_pages(conn, pages):
+    # sqlite3 делает один sqlite3_step на execute, а incremental_vacuum освобождает по странице за шаг;
+    # executescript дошёл бы до конца, но сначала закрыл бы транзакцию storage.write
+    for _ in range(pages):
+        conn.execute("PRAGMA incremental_vacuum(1)")
+
+
+def incremental_vacuum(conn, step_pages=VACUUM_STEP_PAGES, max_steps=None):
+    """Возвращает свободные страницы файлу шагами; каждый шаг — своя короткая транзакция. Возвращает число страниц."""
+    if auto_vacuum_mode(conn) != 2:
+        return 0
+    freed = steps = 0
+    while max_steps is None or steps < max_steps:
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not free:
+            break
+        step = min(step_pages, free)
+        storage.write(lambda c: _vacuum_pages(c, step), conn=conn)
+        freed += step
+        steps += 1
+        VACUUMED.inc(step)
+        time.sleep(STEP_PAUSE)
+    return freed
+
+
+def convert_to_incremental(database=DATABASE):
+    """Одноразовый перевод существующей базы: auto_vacuum меняется только полным VACUUM."""
+    conn = storage.connect(database)
+    try:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return auto_vacuum_mode(conn)
+    finally:
+        conn.release()
+
+
+def run_worker(connect, interval=RETENTION_INTERVAL):
+    """Фоновый цикл веб-процесса: политики хранения, затем incremental_vacuum."""
+    while True:
+        try:
+            conn = connect()
+            try:
+                stats = apply_policies(conn)
+                freed = incremental_vacuum(conn)
+            finally:
+                conn.close()
+            if any(stats.values()) or freed:
+                print(f"Хранение: {stats}, освобождено страниц: {freed}")
+        except Exception as e:
+            print(f"Ошибка задачи хранения: {e}")
+        time.sleep(interval)
+
+
+# === Поиск по архиву ===
+def search_archive(fts_query=None, months=None, limit=50, before=None, importance=None):
+    """
+    Сообщения из архивных баз, от новых к старым: по FTS-запросу (как в /api/messages) или все.
+    months — список "YYYY-MM" (по умолчанию все), before — (date_ts, id) для следующей страницы.
+    """
+    selected = [m for m in archive_months() if months is None or m in months]
+    if before is not None:
+        selected = [m for m in selected if m <= month_of(before[0])]
+    result = []
+    for month in reversed(selected):
+        conn = sqlite3.connect(f"file:{archive_path(month)}?mode=ro", uri=True)
+        conn.row_factory = sqlite3.Row
+        try:
+            columns = ", ".join(f"m.{c}" for c in ARCHIVE_FIELDS) + ", m.archived_at"
+            if fts_query:
+                query = f"""SELECT {columns}, snippet(messages_fts, -1, char(2), char(3), '…', 16) AS snippet
+                            FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                            WHERE messages_fts MATCH ?"""
+                params = [fts_query]
+            else:
+                query = f"SELECT {columns} FROM messages m WHERE 1=1"
+                params = []
+            if importance:
+                query += " AND m.importance = ?"
+                params.append(int(importance))
+            if before is not None:
+                query += " AND (m.date_ts, m.id) < (?, ?)"
+                params.extend(before)
+            query += " ORDER BY m.date_ts DESC, m.id DESC LIMIT ?"
+            params.append(limit - len(result))
+            for row in conn.execute(query, params):
+                result.append(dict(row, archive_month=month))
+        finally:
+            conn.close()
+        if len(result) >= limit:
+            break
+    return result
+
+
+def archive_summary():
+    """[{month, messages, size_bytes}] по архивным базам."""
+    summary = []
+    for month in archive_months():
+        path = archive_path(month)
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            count = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        finally:
+            conn.close()
+        summary.append({"month": month, "messages": count, "size_bytes": os.path.getsize(path)})
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Срок хранения, архивы и incremental_vacuum")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("run", help="применить политики и освободить место")
+    p.add_argument("--dry-run", action="store_true", help="только посчитать, сколько сообщений уйдёт")
+    p.add_argument("--policies", help="файл политик вместо RETENTION_POLICIES_FILE")
+    sub.add_parser("vacuum", help="только incremental_vacuum")
+    sub.add_parser("convert", help="перевести базу на auto_vacuum=INCREMENTAL (полный VACUUM)")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        print(f"auto_vacuum = {convert_to_incremental()}")
+        return
+    conn = storage.get_connection(DATABASE)
+    try:
+        if args.command == "run":
+            stats = apply_policies(conn, load_policies(args.policies), dry_run=args.dry_run)
+            print(f"{'Будет' if args.dry_run else 'Готово'}: {stats}")
+            if args.dry_run:
+                return
+        started = time.perf_counter()
+        freed = incremental_vacuum(conn)
+        print(f"Освобождено страниц: {freed} за {time.perf_counter() - started:.1f} с")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
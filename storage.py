@@ -0,0 +1,221 @@
+"""
+Общий слой доступа к SQLite для веб-процесса и ингесторов: WAL и pragma на каждом соединении,
+общий пул (get_connection() / close(); соединение не передаётся в другой поток, пока его не вернули),
+write() — все записи процесса по одной под общим замком, BEGIN IMMEDIATE и повтор при блокировке.
+Рядом с базой живут -wal/-shm, поэтому в docker монтируется каталог (DATABASE_PATH), а не файл.
+"""
+import functools
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+import metrics
+
+DATABASE = os.getenv("DATABASE_PATH", "messages.db")
+
+BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",        # в WAL безопасно: теряется максимум последняя транзакция при сбое ОС
+    "cache_size": os.getenv("SQLITE_CACHE_KB", "-32000"),   # отрицательное — в КиБ
+    "mmap_size": os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)),
+    "temp_store": "MEMORY",
+    "busy_timeout": str(BUSY_TIMEOUT_MS),
+}
+STATEMENT_CACHE = 256
+POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "8"))
+WRITE_RETRIES = 5
+WRITE_RETRY_DELAY = 0.05
+SQL_METRICS = os.getenv("SQL_METRICS", "true").lower() != "false"
+
+QUERY_SECONDS = metrics.histogram(
+    "sqlite_query_seconds", "Время запросов SQLite: execute и чтение строк отдельно", ("query", "phase"))
+QUERY_ROWS = metrics.counter("sqlite_rows_total", "Строк прочитано (read) и изменено (written) запросами", ("query", "op"))
+WRITE_RETRIES_TOTAL = metrics.counter("sqlite_write_retries_total", "Повторы транзакций записи из-за блокировки базы")
+
+_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+([A-Za-z_][A-Za-z0-9_]*)', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def query_label(sql):
+    """Метка запроса для метрик — глагол и первая таблица («SELECT messages»), чтобы не плодить ряды."""
+    verb = sql.split(None, 1)[0].upper() if sql.strip() else ""
+    m = _TABLE_RE.search(sql)
+    return f"{verb} {m.group(1)}" if m else verb
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор с замерами: время execute и чтения строк, число прочитанных и изменённых строк."""
+    label = ""
+
+    def execute(self, sql, parameters=()):
+        self.label = query_label(sql)
+        started = time.perf_counter()
+        super().execute(sql, parameters)
+        QUERY_SECONDS.observe(time.perf_counter() - started, query=self.label, phase="execute")
+        if self.rowcount > 0:
+            QUERY_ROWS.inc(self.rowcount, query=self.label, op="written")
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self.label = query_label(sql)
+        started = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        QUERY_SECONDS.observe(time.perf_counter() - started, query=self.label, phase="execute")
+        if self.rowcount > 0:
+            QUERY_ROWS.inc(self.rowcount, query=self.label, op="written")
+        return self
+
+    def _fetched(self, started, rows):
+        QUERY_SECONDS.observe(time.perf_counter() - started, query=self.label, phase="fetch")
+        if rows:
+            QUERY_ROWS.inc(rows, query=self.label, op="read")
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows))
+        return rows
+
+
+class PooledConnection(sqlite3.Connection):
+    """close() возвращает соединение в пул; по-настоящему закрывает release()."""
+    pool = None
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or (TimedCursor if SQL_METRICS else sqlite3.Cursor))
+
+    # встроенные conn.execute*/executemany создают курсор в обход cursor() — направляем их через него
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        # открытая транзакция откатывается; недочитанные курсоры закрывает тот, кто их открыл
+        if self.pool is None:
+            self.release()
+            return
+        if self.in_transaction:
+            self.rollback()
+        self.pool.put_back(self)
+
+    def release(self):
+        sqlite3.Connection.close(self)
+
+
+def configure(conn):
+    for name, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+def connect(database=None, row_factory=sqlite3.Row):
+    """Новое настроенное соединение (не из пула) — для долгоживущих писателей и фоновых задач."""
+    conn = sqlite3.connect(
+        database or DATABASE,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE,
+        factory=PooledConnection,
+    )
+    conn.row_factory = row_factory
+    return configure(conn)
+
+
+class ConnectionPool:
+    def __init__(self, database=None, size=POOL_SIZE):
+        self.database = database
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def get(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = connect(self.database)
+            conn.pool = self
+        return conn
+
+    def put_back(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.release()
+
+    def clear(self):
+        while True:
+            try:
+                self.idle.get_nowait().release()
+            except queue.Empty:
+                return
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_write_lock = threading.RLock()
+_writers = {}
+
+
+def _pool(database):
+    database = database or DATABASE
+    with _pools_lock:
+        if database not in _pools:
+            _pools[database] = ConnectionPool(database)
+        return _pools[database]
+
+
+def get_connection(database=None):
+    """Соединение из пула; после работы — conn.close()."""
+    return _pool(database).get()
+
+
+def is_locked_error(e):
+    message = str(e).lower()
+    return isinstance(e, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+
+def write(fn, conn=None, database=None, retries=WRITE_RETRIES):
+    """
+    Выполняет fn(conn) как транзакцию записи и возвращает её результат.
+    Без conn используется общий писатель процесса. При блокировке базы другим
+    процессом транзакция повторяется до retries раз с растущей паузой.
+    """
+    for attempt in range(retries + 1):
+        with _write_lock:
+            target = conn or _writer(database)
+            try:
+                target.execute("BEGIN IMMEDIATE")
+                result = fn(target)
+                if target.in_transaction:
+                    target.commit()
+                return result
+            except Exception as e:
+                if target.in_transaction:
+                    target.rollback()
+                if not is_locked_error(e) or attempt == retries:
+                    raise
+                WRITE_RETRIES_TOTAL.inc()
+        time.sleep(WRITE_RETRY_DELAY * (2 ** attempt))
+
+
+def _writer(database):
+    database = database or DATABASE
+    if database not in _writers:
+        _writers[database] = connect(database)
+    return _writers[database]
@@ -0,0 +1,275 @@
+"""
+Воркер сводок: заполняет chat_summaries (summary, ai_reply, priority) ответами Ollama.
+
+Отдельный процесс, как ингесторы, — веб только читает готовые сводки и LLM никогда не ждёт.
+Цикл раз в SUMMARY_INTERVAL секунд:
+
+1. берёт переписки, у которых с прошлого прохода сменились последнее сообщение или их число
+   (сравнение conversations с summary_state — без чтения сообщений);
+2. по последним SUMMARY_MESSAGES сообщениям строит промпт, его sha256 — ключ кэша;
+3. если такой хэш уже в summary_cache — сводка берётся оттуда, иначе запрос уходит в Ollama
+   (OLLAMA_URL, /api/generate) через пул из SUMMARY_CONCURRENCY потоков с таймаутом SUMMARY_TIMEOUT.
+
+Неизменившаяся переписка повторно не суммаризуется даже после перезапуска: хэш и кэш лежат в базе.
+Ошибка или таймаут оставляют переписку в очереди, но следующая попытка откладывается
+(SUMMARY_RETRY_DELAY, вдвое дольше после каждой неудачи, не больше SUMMARY_RETRY_MAX) —
+переписка, на которой модель стабильно падает, не занимает каждый цикл.
+
+    python summarizer.py                 # постоянный цикл
+    python summarizer.py --once          # один проход
+    python fake_ollama.py --port 11435   # заглушка /api/generate для разработки
+    OLLAMA_URL=http://127.0.0.1:11435/api/generate python summarizer.py --once
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+import metrics
+import storage
+
+load_dotenv()
+
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434/api/generate")
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "qwen3:30b")
+SUMMARY_INTERVAL = float(os.getenv("SUMMARY_INTERVAL", "30"))
+SUMMARY_BATCH = int(os.getenv("SUMMARY_BATCH", "20"))              # переписок за цикл
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "2"))   # одновременных запросов к Ollama
+SUMMARY_TIMEOUT = float(os.getenv("SUMMARY_TIMEOUT", "120"))
+SUMMARY_MESSAGES = int(os.getenv("SUMMARY_MESSAGES", "30"))        # последних сообщений в промпте
+SUMMARY_RETRY_DELAY = float(os.getenv("SUMMARY_RETRY_DELAY", "60"))   # пауза после первой ошибки, с
+SUMMARY_RETRY_MAX = float(os.getenv("SUMMARY_RETRY_MAX", "3600"))
+MESSAGE_CHARS = 500                                                # обрезка длинных сообщений в промпте
+PROMPT_VERSION = 1   # увеличить при смене промпта — старый кэш перестанет совпадать
+
+DATABASE = storage.DATABASE
+
+LLM_SECONDS = metrics.histogram("summary_llm_seconds", "Время ответа Ollama", ("result",),
+                                buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+SUMMARIES = metrics.counter("summaries_total", "Сводки: generated / cached / error", ("result",))
+PENDING = metrics.gauge("summary_pending", "Переписок в очереди на сводку в последнем цикле")
+
+PROMPT = """Ты помощник, который разбирает входящие сообщения.
+Переписка: {title} ({kind}).
+Последние сообщения (старые сверху):
+{messages}
+
+Ответь JSON-объектом с полями:
+"summary" — сводка переписки в 1–2 предложениях на русском,
+"reply" — короткий вариант ответа или пустая строка, если ответ не нужен,
+"priority" — срочность от 1 (можно игнорировать) до 5 (нужно ответить немедленно)."""
+
+
+def init_schema(cursor):
+    cursor.executescript("""
+        CREATE TABLE IF NOT EXISTS summary_cache (
+            content_hash TEXT PRIMARY KEY,
+            summary TEXT,
+            ai_reply TEXT,
+            priority INTEGER,
+            model TEXT,
+            created_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS summary_state (
+            group_key TEXT PRIMARY KEY,
+            last_message_id INTEGER,
+            total_messages INTEGER,
+            content_hash TEXT
+        );
+    """)
+    # неудачные попытки: счётчик и момент (секунды UTC), раньше которого переписку не берём
+    columns = {r[1] for r in cursor.execute("PRAGMA table_info(summary_state)")}
+    if "failures" not in columns:
+        cursor.execute("ALTER TABLE summary_state ADD COLUMN failures INTEGER NOT NULL DEFAULT 0")
+    if "retry_at" not in columns:
+        cursor.execute("ALTER TABLE summary_state ADD COLUMN retry_at REAL")
+
+
+def find_changed(cur, limit=SUMMARY_BATCH):
+    """Переписки, изменившиеся с прошлого прохода; сводки привязаны к chat_id, без него не делаются.
+    Переписки, у которых не истекла пауза после ошибки, пропускаются."""
+    cur.execute("""
+        SELECT c.group_key, c.chat_id, c.title, c.is_group, c.total_messages, c.total_chars, c.last_message_id
+        FROM conversations c LEFT JOIN summary_state s ON s.group_key = c.group_key
+        WHERE c.chat_id != '' AND (s.group_key IS NULL
+            OR s.last_message_id IS NOT c.last_message_id OR s.total_messages IS NOT c.total_messages)
+            AND (s.retry_at IS NULL OR s.retry_at <= ?)
+        ORDER BY c.priority DESC, c.last_ts DESC
+        LIMIT ?
+    """, (time.time(), limit))
+    return cur.fetchall()
+
+
+def build_prompt(cur, conv):
+    cur.execute("""
+        SELECT from_user_name, text_content FROM messages WHERE group_key = ?
+        ORDER BY date_ts DESC, id DESC LIMIT ?
+    """, (conv['group_key'], SUMMARY_MESSAGES))
+    lines = []
+    for name, text in reversed(cur.fetchall()):
+        text = ' '.join((text or '').split())
+        if len(text) > MESSAGE_CHARS:
+            text = text[:MESSAGE_CHARS] + '…'
+        lines.append(f"- {name or 'Без имени'}: {text}")
+    return PROMPT.format(
+        title=conv['title'] or 'без названия',
+        kind='группа' if conv['is_group'] else 'личная',
+        messages='\n'.join(lines),
+    )
+
+
+def content_hash(prompt, model=OLLAMA_MODEL):
+    return hashlib.sha256(f"{PROMPT_VERSION}\0{model}\0{prompt}".encode('utf-8')).hexdigest()
+
+
+def parse_answer(text):
+    """Ответ модели → (summary, ai_reply, priority); не-JSON ответ целиком считается сводкой."""
+    text = (text or '').strip()
+    start, end = text.find('{'), text.rfind('}')
+    try:
+        data = json.loads(text[start:end + 1]) if start >= 0 else None
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return text[:1000], '', None
+    priority = data.get('priority')
+    try:
+        priority = min(5, max(1, int(priority)))
+    except (TypeError, ValueError):
+        priority = None
+    return str(data.get('summary') or '').strip(), str(data.get('reply') or '').strip(), priority
+
+
+def generate(prompt, url=OLLAMA_URL, model=OLLAMA_MODEL, timeout=SUMMARY_TIMEOUT):
+    """Один запрос к /api/generate без стриминга; возвращает текст ответа модели."""
+    body = json.dumps({"model": model, "prompt": prompt, "stream": False, "format": "json"}).encode('utf-8')
+    req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    started = time.perf_counter()
+    result = "error"
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            answer = json.loads(resp.read().decode('utf-8'))
+        result = "ok"
+        return answer.get("response", "")
+    finally:
+        LLM_SECONDS.observe(time.perf_counter() - started, result=result)
+
+
+def save(conn, conv, digest, summary=None, fresh=False):
+    """Пишет сводку (если есть) и отметку о просмотренном состоянии переписки одной транзакцией."""
+    def apply(c):
+        if fresh:
+            c.execute(
+                "INSERT OR REPLACE INTO summary_cache (content_hash, summary, ai_reply, priority, model, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (digest,) + summary + (OLLAMA_MODEL, datetime.utcnow().isoformat())
+            )
+        if summary is not None:
+            # триггеры chat_summaries пересчитают приоритет переписки и запишут изменение в журнал
+            c.execute("""
+                INSERT INTO chat_summaries (chat_id, chat_title, is_group, summary, ai_reply, priority,
+                                            total_messages, total_chars, last_updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(chat_id) DO UPDATE SET
+                    chat_title = excluded.chat_title, is_group = excluded.is_group, summary = excluded.summary,
+                    ai_reply = excluded.ai_reply, priority = excluded.priority, total_messages = excluded.total_messages,
+                    total_chars = excluded.total_chars, last_updated = excluded.last_updated
+            """, (conv['chat_id'], conv['title'], conv['is_group'], *summary,
+                  conv['total_messages'], conv['total_chars'], datetime.utcnow().isoformat()))
+        c.execute(
+            "INSERT OR REPLACE INTO summary_state (group_key, last_message_id, total_messages, content_hash) VALUES (?, ?, ?, ?)",
+            (conv['group_key'], conv['last_message_id'], conv['total_messages'], digest)
+        )
+    storage.write(apply, conn=conn)
+
+
+def save_failure(conn, conv):
+    """Отмечает неудачу: состояние переписки не меняется, следующая попытка — после паузы."""
+    def apply(c):
+        row = c.execute("SELECT failures FROM summary_state WHERE group_key = ?", (conv['group_key'],)).fetchone()
+        failures = (row[0] if row else 0) + 1
+        retry_at = time.time() + min(SUMMARY_RETRY_MAX, SUMMARY_RETRY_DELAY * 2 ** (failures - 1))
+        c.execute("""
+            INSERT INTO summary_state (group_key, failures, retry_at) VALUES (?, ?, ?)
+            ON CONFLICT(group_key) DO UPDATE SET failures = excluded.failures, retry_at = excluded.retry_at
+        """, (conv['group_key'], failures, retry_at))
+        return failures
+    return storage.write(apply, conn=conn)
+
+
+def run_once(conn, executor, url=OLLAMA_URL, limit=SUMMARY_BATCH):
+    """Один проход; возвращает {"generated", "cached", "unchanged", "errors"}."""
+    cur = conn.cursor()
+    stats = dict.fromkeys(("generated", "cached", "unchanged", "errors"), 0)
+    pending = []
+    changed = find_changed(cur, limit)
+    PENDING.set(len(changed))
+    for conv in changed:
+        prompt = build_prompt(cur, conv)
+        digest = content_hash(prompt)
+        cur.execute("SELECT content_hash FROM summary_state WHERE group_key = ?", (conv['group_key'],))
+        state = cur.fetchone()
+        if state is not None and state[0] == digest:
+            # сообщения в промпте те же (например, удалили старое) — только запоминаем новое состояние
+            save(conn, conv, digest)
+            stats["unchanged"] += 1
+            continue
+        cur.execute("SELECT summary, ai_reply, priority FROM summary_cache WHERE content_hash = ?", (digest,))
+        cached = cur.fetchone()
+        if cached is not None:
+            save(conn, conv, digest, tuple(cached))
+            stats["cached"] += 1
+            SUMMARIES.inc(result="cached")
+            continue
+        pending.append((conv, digest, executor.submit(generate, prompt, url)))
+
+    for conv, digest, future in pending:
+        try:
+            summary = parse_answer(future.result())
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            failures = save_failure(conn, conv)
+            print(f"Сводка для {conv['group_key']} не получена ({failures}-я неудача подряд): {e}")
+            stats["errors"] += 1
+            SUMMARIES.inc(result="error")
+            continue
+        save(conn, conv, digest, summary, fresh=True)
+        stats["generated"] += 1
+        SUMMARIES.inc(result="generated")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сводки переписок через Ollama")
+    parser.add_argument('--once', action='store_true', help="один проход и выход")
+    parser.add_argument('--url', default=OLLAMA_URL)
+    parser.add_argument('--batch', type=int, default=SUMMARY_BATCH)
+    args = parser.parse_args()
+
+    storage.write(lambda c: init_schema(c.cursor()), database=DATABASE)
+    if not args.once:
+        metrics.start_file_export("summarizer")
+    with ThreadPoolExecutor(max_workers=SUMMARY_CONCURRENCY, thread_name_prefix="ollama") as executor:
+        while True:
+            try:
+                conn = storage.get_connection(DATABASE)
+                try:
+                    stats = run_once(conn, executor, args.url, args.batch)
+                finally:
+                    conn.close()
+                if any(stats.values()):
+                    print(f"Сводки: {stats}")
+            except Exception as e:
+                print(f"Ошибка воркера сводок: {e}")
+            if args.once:
+                break
+            time.sleep(SUMMARY_INTERVAL)
+
+
+if __name__ == "__main__":
+    main()
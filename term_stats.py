@@ -0,0 +1,314 @@
+"""
+Инкрементальная статистика терминов для /api/analysis.
+
+Схема (создаётся init_schema, поддерживается триггерами на messages):
+- term_queue    — id сообщений, которые ещё нужно разобрать на слова;
+- term_postings — списки вхождений: (term, message_id, ts, importance);
+- term_stats    — документная частота и сумма важности по каждому слову; dup_df / dup_importance_sum —
+                  то же только по почти-дубликатам (near_dups.message_duplicates), для collapse;
+- term_pairs    — счётчики совместной встречаемости (в обе стороны).
+
+Удаление и смена важности отрабатываются триггерами сразу; новые сообщения
+разбирает process_queue() из фонового потока веб-процесса (run_indexer).
+Токенизация (регулярка + стоп-слова) — прежняя из app.py.
+
+Пары растут с квадратом словаря, поэтому в них участвуют только PAIR_TERMS самых
+частых слов сообщения, а когда строк становится больше TERM_PAIRS_MAX, run_indexer
+удаляет редкие пары (prune_pairs) — для related_terms важны только частые.
+"""
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+import near_dups
+import storage
+
+STOPWORDS = set("""и в во не на я он она мы вы ты что это для как до через под без при же так но его её за от по или ли их о об""".split())
+WORD_RE = re.compile(r'\b[а-яА-Яa-zA-Z0-9]{3,}\b', flags=re.UNICODE)
+
+PAIR_TERMS = 8           # сколько самых частых слов сообщения участвуют в подсчёте пар (до 56 строк на сообщение)
+PAIRS_MAX = int(os.getenv("TERM_PAIRS_MAX", "1000000"))   # больше строк в term_pairs — редкие пары удаляются
+PRUNE_INTERVAL = 3600    # как часто run_indexer проверяет размер term_pairs, секунд
+QUEUE_BATCH = 500
+
+WINDOWS = {
+    'hour': 3600,
+    'day': 86400,
+    'week': 7 * 86400,
+}
+
+_queue_lock = threading.Lock()
+
+
+def tokenize(text):
+    words = WORD_RE.findall((text or '').lower())
+    return Counter(w for w in words if w not in STOPWORDS)
+
+
+def _forget_message_sql(ref):
+    # пары считаем до удаления постингов — иначе не узнать, какие слова участвовали
+    return f"""UPDATE term_pairs SET cnt = cnt - 1 WHERE (term, other) IN (
+                SELECT a.term, b.term FROM term_postings a
+                JOIN term_postings b ON b.message_id = a.message_id AND b.term != a.term AND b.in_pairs
+                WHERE a.message_id = {ref}.id AND a.in_pairs);
+            DELETE FROM term_pairs WHERE cnt <= 0
+                AND term IN (SELECT term FROM term_postings WHERE message_id = {ref}.id AND in_pairs);
+            DELETE FROM term_postings WHERE message_id = {ref}.id;"""
+
+
+# строка — почти-дубликат: её слова учитываются ещё и в dup_df / dup_importance_sum
+IS_DUPLICATE_SQL = "EXISTS (SELECT 1 FROM message_duplicates WHERE message_id = {ref}.message_id)"
+
+
+def _duplicate_delta_sql(ref, sign):
+    """Сообщение {ref}.message_id стало (+) или перестало быть (-) дубликатом: поправка счётчиков его слов."""
+    return f"""UPDATE term_stats SET
+                dup_df = dup_df {sign} 1,
+                dup_importance_sum = dup_importance_sum {sign} (
+                    SELECT importance FROM term_postings WHERE message_id = {ref}.message_id AND term = term_stats.term)
+            WHERE term IN (SELECT term FROM term_postings WHERE message_id = {ref}.message_id);"""
+
+
+def init_schema(cursor):
+    near_dups.init_schema(cursor)   # message_duplicates нужна триггерам ниже
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'term_stats'")
+    existed = cursor.fetchone() is not None
+
+    if existed:
+        cursor.execute("PRAGMA table_info(term_stats)")
+        if "dup_df" not in {r[1] for r in cursor.fetchall()}:
+            # счётчики по дубликатам появились позже: один пересчёт, дальше их ведут триггеры,
+            # прежние версии которых пересоздаются ниже
+            cursor.execute("ALTER TABLE term_stats ADD COLUMN dup_df INTEGER NOT NULL DEFAULT 0")
+            cursor.execute("ALTER TABLE term_stats ADD COLUMN dup_importance_sum INTEGER NOT NULL DEFAULT 0")
+            cursor.execute("""
+                UPDATE term_stats SET (dup_df, dup_importance_sum) = (
+                    SELECT COUNT(*), COALESCE(SUM(p.importance), 0) FROM message_duplicates d
+                    JOIN term_postings p ON p.message_id = d.message_id WHERE p.term = term_stats.term)
+            """)
+            for trigger in ("term_postings_on_insert", "term_postings_on_delete", "term_postings_on_importance"):
+                cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+    cursor.executescript(f"""
+        CREATE TABLE IF NOT EXISTS term_queue (
+            message_id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS term_stats (
+            term TEXT PRIMARY KEY,
+            df INTEGER NOT NULL DEFAULT 0,
+            importance_sum INTEGER NOT NULL DEFAULT 0,
+            dup_df INTEGER NOT NULL DEFAULT 0,
+            dup_importance_sum INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_term_stats_df ON term_stats(df DESC);
+
+        CREATE TABLE IF NOT EXISTS term_postings (
+            term TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL DEFAULT 0,
+            importance INTEGER NOT NULL DEFAULT 3,
+            in_pairs INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (term, message_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_term_postings_message ON term_postings(message_id);
+        CREATE INDEX IF NOT EXISTS idx_term_postings_term_ts ON term_postings(term, ts);
+        CREATE INDEX IF NOT EXISTS idx_term_postings_ts ON term_postings(ts, term, importance);
+
+        CREATE TABLE IF NOT EXISTS term_pairs (
+            term TEXT NOT NULL,
+            other TEXT NOT NULL,
+            cnt INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (term, other)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_term_pairs_cnt ON term_pairs(term, cnt DESC);
+
+        CREATE TRIGGER IF NOT EXISTS term_postings_on_insert AFTER INSERT ON term_postings BEGIN
+            INSERT INTO term_stats (term, df, importance_sum) VALUES (NEW.term, 1, NEW.importance)
+                ON CONFLICT(term) DO UPDATE SET df = df + 1, importance_sum = importance_sum + excluded.importance_sum;
+            UPDATE term_stats SET dup_df = dup_df + 1, dup_importance_sum = dup_importance_sum + NEW.importance
+                WHERE term = NEW.term AND {IS_DUPLICATE_SQL.format(ref='NEW')};
+        END;
+        CREATE TRIGGER IF NOT EXISTS term_postings_on_delete AFTER DELETE ON term_postings BEGIN
+            UPDATE term_stats SET df = df - 1, importance_sum = importance_sum - OLD.importance WHERE term = OLD.term;
+            UPDATE term_stats SET dup_df = dup_df - 1, dup_importance_sum = dup_importance_sum - OLD.importance
+                WHERE term = OLD.term AND {IS_DUPLICATE_SQL.format(ref='OLD')};
+            DELETE FROM term_stats WHERE term = OLD.term AND df <= 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS term_postings_on_importance AFTER UPDATE OF importance ON term_postings BEGIN
+            UPDATE term_stats SET importance_sum = importance_sum + NEW.importance - OLD.importance WHERE term = NEW.term;
+            UPDATE term_stats SET dup_importance_sum = dup_importance_sum + NEW.importance - OLD.importance
+                WHERE term = NEW.term AND {IS_DUPLICATE_SQL.format(ref='NEW')};
+        END;
+        CREATE TRIGGER IF NOT EXISTS term_stats_on_duplicate_insert AFTER INSERT ON message_duplicates BEGIN
+            {_duplicate_delta_sql('NEW', '+')}
+        END;
+        CREATE TRIGGER IF NOT EXISTS term_stats_on_duplicate_delete AFTER DELETE ON message_duplicates BEGIN
+            {_duplicate_delta_sql('OLD', '-')}
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS term_stats_on_insert AFTER INSERT ON messages BEGIN
+            INSERT OR IGNORE INTO term_queue (message_id) VALUES (NEW.id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS term_stats_on_delete AFTER DELETE ON messages BEGIN
+            {_forget_message_sql('OLD')}
+            DELETE FROM term_queue WHERE message_id = OLD.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS term_stats_on_text_update AFTER UPDATE OF text_content, date ON messages BEGIN
+            {_forget_message_sql('OLD')}
+            INSERT OR IGNORE INTO term_queue (message_id) VALUES (NEW.id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS term_stats_on_importance_update AFTER UPDATE OF importance ON messages BEGIN
+            UPDATE term_postings SET importance = COALESCE(NEW.importance, 3) WHERE message_id = NEW.id;
+        END;
+    """)
+
+    if not existed:
+        # первая инициализация: вся существующая история встаёт в очередь
+        cursor.execute("INSERT OR IGNORE INTO term_queue (message_id) SELECT id FROM messages")
+
+
+def _index_message(cursor, message_id, text, importance, ts):
+    counts = tokenize(text)
+    if not counts:
+        return
+    pair_terms = {t for t, _ in counts.most_common(PAIR_TERMS)}
+    cursor.executemany(
+        "INSERT OR IGNORE INTO term_postings (term, message_id, ts, importance, in_pairs) VALUES (?, ?, ?, ?, ?)",
+        [(t, message_id, ts, importance, 1 if t in pair_terms else 0) for t in counts]
+    )
+    cursor.executemany(
+        "INSERT INTO term_pairs (term, other, cnt) VALUES (?, ?, 1) ON CONFLICT(term, other) DO UPDATE SET cnt = cnt + 1",
+        [(a, b) for a in pair_terms for b in pair_terms if a != b]
+    )
+
+
+def _process_batch(conn, batch):
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT q.message_id, m.id AS alive, m.text_content, COALESCE(m.importance, 3) AS importance,
+               COALESCE(m.date_ts, 0) AS ts
+        FROM term_queue q LEFT JOIN messages m ON m.id = q.message_id
+        ORDER BY q.message_id LIMIT ?
+    """, (batch,))
+    rows = cursor.fetchall()
+    for r in rows:
+        if r[1] is not None:
+            _index_message(cursor, r[0], r[2], r[3], r[4])
+    cursor.executemany("DELETE FROM term_queue WHERE message_id = ?", [(r[0],) for r in rows])
+    return len(rows)
+
+
+def process_queue(conn, max_items=None):
+    """Разбирает очередь новых сообщений пачками (каждая — отдельная транзакция записи); возвращает число обработанных."""
+    processed = 0
+    with _queue_lock:
+        while max_items is None or processed < max_items:
+            batch = QUEUE_BATCH if max_items is None else min(QUEUE_BATCH, max_items - processed)
+            count = storage.write(lambda c: _process_batch(c, batch), conn=conn)
+            if not count:
+                break
+            processed += count
+    return processed
+
+
+def prune_pairs(conn, max_rows=PAIRS_MAX):
+    """
+    Если пар больше max_rows, удаляет самые редкие: сначала cnt = 1, затем cnt <= 2 и т.д.,
+    пока не уложится. Вернувшаяся пара считается заново с 1. Возвращает число удалённых строк.
+    """
+    removed = 0
+    min_count = 1
+    rows = conn.execute("SELECT COUNT(*) FROM term_pairs").fetchone()[0]
+    while rows > max_rows:
+        deleted = storage.write(lambda c: c.execute("DELETE FROM term_pairs WHERE cnt <= ?", (min_count,)).rowcount,
+                                conn=conn)
+        removed += deleted
+        rows -= deleted
+        min_count += 1
+    return removed
+
+
+def run_indexer(connect, interval=2.0):
+    """Фоновый цикл: периодически разбирает очередь и раз в PRUNE_INTERVAL подрезает term_pairs. connect — фабрика соединений."""
+    pruned_at = 0
+    while True:
+        try:
+            conn = connect()
+            try:
+                process_queue(conn)
+                if time.time() - pruned_at >= PRUNE_INTERVAL:
+                    pruned_at = time.time()
+                    removed = prune_pairs(conn)
+                    if removed:
+                        print(f"term_pairs: удалено редких пар: {removed}")
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"Ошибка индексатора терминов: {e}")
+        time.sleep(interval)
+
+
+def window_start(window):
+    seconds = WINDOWS.get(window)
+    return int(time.time()) - seconds if seconds else None
+
+
+NOT_DUPLICATE_SQL = "NOT EXISTS (SELECT 1 FROM message_duplicates d WHERE d.message_id = term_postings.message_id)"
+
+
+def top_terms(cursor, limit=10, window=None, collapse=False):
+    """
+    [(term, count, avg_importance)] — за всю историю или за окно 'hour' / 'day' / 'week'.
+    collapse=True не считает почти-дубликаты (near_dups): пересланное в три чата объявление — одно сообщение.
+    """
+    since = window_start(window)
+    if since is not None:
+        cursor.execute(f"""
+            SELECT term, COUNT(*) AS cnt, AVG(importance) FROM term_postings
+            WHERE ts >= ?{" AND " + NOT_DUPLICATE_SQL if collapse else ""} GROUP BY term ORDER BY cnt DESC LIMIT ?
+        """, (since, limit))
+        return [(r[0], r[1], r[2]) for r in cursor.fetchall()]
+    if not collapse:
+        cursor.execute(
+            "SELECT term, df, importance_sum * 1.0 / df FROM term_stats ORDER BY df DESC LIMIT ?",
+            (limit,)
+        )
+        return [(r[0], r[1], r[2]) for r in cursor.fetchall()]
+
+    # df без дубликатов не больше df: читаем term_stats по убыванию df, пока следующий df
+    # не окажется меньше худшего из уже набранных — дальше ничего в топ попасть не может
+    found = []
+    offset = 0
+    page = max(limit * 4, 50)
+    while True:
+        cursor.execute("SELECT term, df, importance_sum, dup_df, dup_importance_sum FROM term_stats "
+                       "ORDER BY df DESC LIMIT ? OFFSET ?", (page, offset))
+        rows = cursor.fetchall()
+        for term, df, importance_sum, dup_df, dup_importance_sum in rows:
+            if len(found) >= limit and df < found[limit - 1][1]:
+                return found[:limit]
+            count = df - dup_df
+            if count > 0:
+                found.append((term, count, (importance_sum - dup_importance_sum) * 1.0 / count))
+                found.sort(key=lambda t: -t[1])
+        if len(rows) < page:
+            return found[:limit]
+        offset += page
+
+
+def related_terms(cursor, term, limit=3):
+    cursor.execute("SELECT other FROM term_pairs WHERE term = ? ORDER BY cnt DESC LIMIT ?", (term, limit))
+    return [r[0] for r in cursor.fetchall()]
+
+
+def term_message_ids(cursor, term, limit=3, window=None, collapse=False):
+    """Последние сообщения со словом (по списку вхождений, без сканирования текстов)."""
+    since = window_start(window) or 0
+    cursor.execute(
+        f"SELECT message_id FROM term_postings WHERE term = ? AND ts >= ?{' AND ' + NOT_DUPLICATE_SQL if collapse else ''} "
+        "ORDER BY ts DESC LIMIT ?",
+        (term, since, limit)
+    )
+    return [r[0] for r in cursor.fetchall()]
@@ -0,0 +1,83 @@
+"""
+Общая тестовая база: временный каталог задаётся через DATABASE_PATH до импорта модулей проекта
+(storage, app и остальные читают путь при импорте). Схема создаётся один раз, после каждого
+теста сообщения и состояние синхронизации удаляются — производные таблицы чистят триггеры.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_TMP = tempfile.mkdtemp(prefix="aggregator_tests_")
+os.environ["DATABASE_PATH"] = os.path.join(_TMP, "messages.db")
+os.environ["ARCHIVE_DIR"] = os.path.join(_TMP, "archive")
+os.environ["IMPORTANCE_RULES_FILE"] = ""
+os.environ["RETENTION_POLICIES_FILE"] = ""
+
+import pytest  # noqa: E402
+
+CLEANUP_TABLES = ("imap_sync_state", "imap_failed_uids", "imap_backfill_chunks", "message_changes", "summary_state",
+                  "importance_rules_state", "summary_cache", "chat_summaries")
+
+
+@pytest.fixture(scope="session")
+def app_module():
+    import app
+    app.init_db()
+    return app
+
+
+@pytest.fixture
+def db(app_module):
+    import near_dups
+    import storage
+    import term_stats
+    yield app_module
+
+    def cleanup(conn):
+        conn.execute("DELETE FROM messages")
+        for table in CLEANUP_TABLES:
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone():
+                conn.execute(f"DELETE FROM {table}")
+    storage.write(cleanup)
+    conn = storage.get_connection()
+    term_stats.process_queue(conn)
+    near_dups.process_queue(conn)
+    conn.close()
+
+
+@pytest.fixture
+def client(db):
+    return db.app.test_client()
+
+
+@pytest.fixture
+def add_messages(db):
+    """Пишет строки через общий путь ингесторов (IngestWriter); возвращает id вставленных по порядку."""
+    from ingest_writer import IngestWriter
+
+    def add(rows):
+        with IngestWriter() as writer:
+            last_id = writer.conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+            for row in rows:
+                writer.add(dict(row))
+            writer.flush()
+            return [r[0] for r in writer.conn.execute("SELECT id FROM messages WHERE id > ? ORDER BY id", (last_id,))]
+    return add
+
+
+def chat_message(i, chat_id=1, text=None, date=None, **extra):
+    row = {
+        "source": "telegram",
+        "chat_id": chat_id,
+        "chat_title": f"Чат {chat_id}",
+        "from_user_id": 100 + chat_id,
+        "from_user_name": "Иван",
+        "message_id": i,
+        "text_content": text if text is not None else f"сообщение {i}",
+        "date": date or f"2024-05-01T10:{i // 60 % 60:02d}:{i % 60:02d}+00:00",
+    }
+    row.update(extra)
+    return row
@@ -0,0 +1,75 @@
+"""/api/messages/bulk: проверка критериев и перенос «обработанных» в помесячные архивы."""
+import pytest
+
+import retention
+import storage
+from conftest import chat_message
+
+
+def hot_count(sql, params=()):
+    conn = storage.get_connection()
+    try:
+        return conn.execute(sql, params).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_bad_criteria_are_rejected(client, db):
+    for body in ({"filter": {"older_than": "вчера"}},
+                 {"filter": {"importance": "high"}},
+                 {"filter": "email"},
+                 {"ids": ["a"]}):
+        response = client.post('/api/messages/bulk', json=body)
+        assert response.status_code == 400, body
+        assert response.get_json()["success"] is False
+
+
+def test_archive_moves_group_to_monthly_archive(client, db, add_messages):
+    ids = add_messages([chat_message(i, chat_id=7, date=f"2024-03-0{i + 1}T10:00:00") for i in range(3)]
+                       + [chat_message(10, chat_id=8, date="2024-03-05T10:00:00")])
+    group_key = hot_count("SELECT group_key FROM messages WHERE id = ?", (ids[0],))
+
+    response = client.post('/api/messages/bulk', json={"action": "archive", "group_key": group_key})
+    assert response.get_json() == {"success": True, "action": "archive", "affected": 3}
+
+    assert hot_count("SELECT COUNT(*) FROM messages WHERE group_key = ?", (group_key,)) == 0
+    assert hot_count("SELECT COUNT(*) FROM conversations WHERE group_key = ?", (group_key,)) == 0
+    archived = retention.search_archive(months=["2024-03"])
+    assert sorted(m["id"] for m in archived) == sorted(ids[:3])
+
+
+def test_older_than_accepts_iso_date(client, db, add_messages):
+    add_messages([chat_message(0, date="2024-01-01T10:00:00"), chat_message(1, date="2024-06-01T10:00:00")])
+    response = client.post('/api/messages/bulk', json={"filter": {"older_than": "2024-03-01"}})
+    assert response.get_json()["affected"] == 1
+    assert hot_count("SELECT COUNT(*) FROM messages") == 1
+
+
+
+def test_failed_archive_leaves_hot_database_untouched(db, add_messages, monkeypatch):
+    ids = add_messages([chat_message(0, date="2024-01-10T10:00:00"), chat_message(1, date="2024-02-10T10:00:00")])
+    original = retention.copy_to_archive
+
+    def fail_on_february(month, month_ids, database):
+        if month == "2024-02":
+            raise OSError("диск заполнен")
+        original(month, month_ids, database)
+
+    monkeypatch.setattr(retention, "copy_to_archive", fail_on_february)
+    conn = storage.get_connection()
+    try:
+        with pytest.raises(OSError):
+            retention.archive_selection(conn, "chat_id = ?", [1], batch=1)
+    finally:
+        conn.close()
+    assert hot_count("SELECT COUNT(*) FROM messages") == 2
+
+    monkeypatch.setattr(retention, "copy_to_archive", original)
+    conn = storage.get_connection()
+    try:
+        assert retention.archive_selection(conn, "chat_id = ?", [1], batch=1) == 2
+    finally:
+        conn.close()
+    assert hot_count("SELECT COUNT(*) FROM messages") == 0
+    # повтор заменил копию января, а не задвоил её
+    assert [m["id"] for m in retention.search_archive(months=["2024-01"])] == ids[:1]
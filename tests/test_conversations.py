@@ -0,0 +1,94 @@
+"""conversations: материализованный список переписок поддерживается триггерами при любой записи в messages."""
+import storage
+from conftest import chat_message
+
+
+def conversation(chat_id):
+    conn = storage.get_connection()
+    try:
+        row = conn.execute("SELECT c.* FROM conversations c WHERE c.group_key = "
+                           "(SELECT group_key FROM messages WHERE chat_id = ? LIMIT 1)", (chat_id,)).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+
+def conversations_count():
+    conn = storage.get_connection()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_counters_and_last_message_on_insert(db, add_messages):
+    # вставка не по порядку дат: последним остаётся сообщение с максимальным (date_ts, id)
+    ids = add_messages([
+        chat_message(0, chat_id=5, text="ab", date="2024-05-03T10:00:00", importance=2),
+        chat_message(1, chat_id=5, text="abcd", date="2024-05-01T10:00:00", importance=4),
+        chat_message(2, chat_id=5, text="abc", date="2024-05-02T10:00:00", importance=3),
+    ])
+    c = conversation(5)
+    assert (c["total_messages"], c["total_chars"], c["max_importance"]) == (3, 9, 4)
+    assert c["last_message_id"] == ids[0]
+    assert c["title"] == "Чат 5"
+
+    # то же время — побеждает больший id
+    later = add_messages([chat_message(3, chat_id=5, text="x", date="2024-05-03T10:00:00")])
+    assert conversation(5)["last_message_id"] == later[0]
+
+
+def test_delete_and_update_refresh_conversation(db, add_messages):
+    ids = add_messages([
+        chat_message(0, chat_id=6, date="2024-05-01T10:00:00", importance=5),
+        chat_message(1, chat_id=6, date="2024-05-02T10:00:00", importance=2),
+    ])
+    storage.write(lambda conn: conn.execute("DELETE FROM messages WHERE id = ?", (ids[1],)))
+    c = conversation(6)
+    assert c["total_messages"] == 1 and c["last_message_id"] == ids[0]
+    assert conversations_count() == 1
+
+    storage.write(lambda conn: conn.execute("UPDATE messages SET importance = 1 WHERE id = ?", (ids[0],)))
+    assert conversation(6)["max_importance"] == 1
+
+    storage.write(lambda conn: conn.execute("DELETE FROM messages WHERE id = ?", (ids[0],)))
+    assert conversations_count() == 0
+
+
+def test_last_ts_follows_date_change(db, add_messages):
+    ids = add_messages([
+        chat_message(0, chat_id=7, date="2024-05-01T10:00:00"),
+        chat_message(1, chat_id=7, date="2024-05-02T10:00:00"),
+    ])
+    storage.write(lambda conn: conn.execute("UPDATE messages SET date = '2024-06-01T10:00:00' WHERE id = ?", (ids[0],)))
+    c = conversation(7)
+    assert c["last_message_id"] == ids[0]
+    assert c["last_ts"] == 1717236000
+
+
+def test_direct_insert_without_date_ts_is_logged_once(db):
+    def insert(conn):
+        conn.execute("INSERT INTO messages (chat_id, chat_title, text_content, date, source) "
+                     "VALUES (8, 'Чат 8', 'напрямую', '2024-06-01T13:00:00+03:00', 'telegram')")
+        return conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+    message_id = storage.write(insert)
+
+    conn = storage.get_connection()
+    try:
+        assert conn.execute("SELECT date_ts FROM messages WHERE id = ?", (message_id,)).fetchone()[0] == 1717236000
+        changes = conn.execute("SELECT op FROM message_changes WHERE message_row_id = ?", (message_id,)).fetchall()
+    finally:
+        conn.close()
+    # дозаполнение date_ts триггером — не правка: в журнале одна запись
+    assert [r[0] for r in changes] == ["upsert"]
+    c = conversation(8)
+    assert (c["last_message_id"], c["last_ts"]) == (message_id, 1717236000)
+
+    # смена даты — одна запись в журнале, переписка идёт за новым date_ts
+    storage.write(lambda conn: conn.execute("UPDATE messages SET date = '2024-07-01T10:00:00' WHERE id = ?", (message_id,)))
+    conn = storage.get_connection()
+    try:
+        assert conn.execute("SELECT COUNT(*) FROM message_changes WHERE message_row_id = ?", (message_id,)).fetchone()[0] == 2
+    finally:
+        conn.close()
+    assert conversation(8)["last_ts"] == 1719828000
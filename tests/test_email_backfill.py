@@ -0,0 +1,80 @@
+"""email_backfill: отметки о кусках пишутся по ходу загрузки, и прерванная загрузка продолжается с них."""
+import pytest
+
+import email_backfill
+import email_reader
+import storage
+from fake_imap import FakeIMAPServer, Mailbox, make_email
+from ingest_writer import IngestWriter
+
+TOTAL = 1000
+
+
+class Killed(BaseException):
+    """Имитация Ctrl+C посреди загрузки."""
+
+
+@pytest.fixture
+def mailbox_account():
+    mailbox = Mailbox()
+    for i in range(TOTAL):
+        mailbox.add(make_email(i))
+    server = FakeIMAPServer(mailbox=mailbox).start()
+    yield email_reader.Account("me@example.com", "secret", "127.0.0.1", server.port, False, ["INBOX"])
+    server.shutdown()
+    server.server_close()
+
+
+def count(sql, params=()):
+    conn = storage.get_connection()
+    try:
+        return conn.execute(sql, params).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_interrupted_backfill_resumes_from_checkpoints(db, mailbox_account, monkeypatch):
+    monkeypatch.setattr(email_backfill, "BACKFILL_CHUNK", 100)
+    original_add = IngestWriter.add
+    added = [0]
+
+    def add_then_die(self, row):
+        added[0] += 1
+        if added[0] > 650:
+            raise Killed()
+        return original_add(self, row)
+
+    monkeypatch.setattr(IngestWriter, "add", add_then_die)
+    with pytest.raises(Killed):
+        email_backfill.run(mailbox_account, "INBOX", connections=2, workers=1, write_batch=250)
+
+    done_chunks = count("SELECT COUNT(*) FROM imap_backfill_chunks")
+    done_messages = count("SELECT COALESCE(SUM(messages), 0) FROM imap_backfill_chunks")
+    # отметки появились по ходу загрузки, а не одной пачкой в конце
+    assert 0 < done_chunks < 11
+    assert count("SELECT COUNT(*) FROM messages") >= done_messages
+
+    monkeypatch.setattr(IngestWriter, "add", original_add)
+    stats = email_backfill.run(mailbox_account, "INBOX", connections=2, workers=1, write_batch=250)
+
+    # второй запуск забирает только непомеченные куски
+    assert stats["messages"] == TOTAL - done_messages
+    assert stats["failed_chunks"] == 0
+    assert count("SELECT COUNT(*) FROM messages WHERE source = 'email'") == TOTAL
+    assert count("SELECT COALESCE(SUM(messages), 0) FROM imap_backfill_chunks") == TOTAL
+    assert email_reader.load_sync_state("me@example.com", "INBOX")[1] == TOTAL
+
+
+def test_checkpoints_written_during_long_run(db, mailbox_account, monkeypatch):
+    monkeypatch.setattr(email_backfill, "BACKFILL_CHUNK", 100)
+    marks = []
+    original_mark = email_backfill.mark_chunks_done
+
+    def record(conn, account, folder, uidvalidity, chunks):
+        marks.append(len(chunks))
+        return original_mark(conn, account, folder, uidvalidity, chunks)
+
+    monkeypatch.setattr(email_backfill, "mark_chunks_done", record)
+    email_backfill.run(mailbox_account, "INBOX", connections=2, workers=1, write_batch=250)
+    assert sum(marks) == 11          # UID 1..1000 — куски 0..10
+    assert len(marks) >= 4           # отметки после каждой записанной пачки, а не одна в конце
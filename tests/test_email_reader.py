@@ -0,0 +1,191 @@
+"""email_reader: синхронизация по UID забирает только новые письма и не перескакивает через несохранённые."""
+import json
+import threading
+import time
+
+import pytest
+
+import email_reader
+import storage
+from fake_imap import FakeIMAPServer, Mailbox, make_email
+
+ACCOUNT = "me@example.com"
+
+
+@pytest.fixture
+def imap(db):
+    email_reader.init_sync_state()
+    mailbox = Mailbox()
+    server = FakeIMAPServer(mailbox=mailbox).start()
+    account = email_reader.Account(ACCOUNT, "secret", "127.0.0.1", server.port, False, ["INBOX"])
+    mail = email_reader.connect_to_email(account)
+    yield mailbox, mail
+    mail.logout()
+    server.shutdown()
+    server.server_close()
+
+
+def email_count():
+    conn = storage.get_connection()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM messages WHERE source = 'email'").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def last_uid():
+    return email_reader.load_sync_state(ACCOUNT, "INBOX")[1]
+
+
+def test_sync_resumes_after_last_uid(imap, monkeypatch):
+    mailbox, mail = imap
+    for i in range(5):
+        mailbox.add(make_email(i))
+    assert email_reader.sync_folder(mail, ACCOUNT, "INBOX") == 5
+    assert last_uid() == 5
+
+    requested = []
+    original = email_reader.fetch_batch
+    monkeypatch.setattr(email_reader, "fetch_batch", lambda m, uids: requested.extend(uids) or original(m, uids))
+    for i in range(5, 8):
+        mailbox.add(make_email(i))
+    assert email_reader.sync_folder(mail, ACCOUNT, "INBOX") == 3
+    assert requested == [6, 7, 8]
+    assert last_uid() == 8
+    assert email_count() == 8
+
+
+def test_failed_uid_is_not_skipped(imap, monkeypatch):
+    mailbox, mail = imap
+    for i in range(10):
+        mailbox.add(make_email(i))
+    monkeypatch.setattr(email_reader, "FETCH_BATCH", 4)
+    original = email_reader.fetch_batch
+
+    def lose_uid_6(m, uids):
+        return [(uid, n) for uid, n in original(m, uids) if uid != 6]
+
+    monkeypatch.setattr(email_reader, "fetch_batch", lose_uid_6)
+    email_reader.sync_folder(mail, ACCOUNT, "INBOX")
+    # письма после пропущенного сохранены, но курсор стоит перед ним
+    assert email_count() == 9
+    assert last_uid() == 5
+
+    monkeypatch.setattr(email_reader, "fetch_batch", original)
+    assert email_reader.sync_folder(mail, ACCOUNT, "INBOX") == 1
+    assert email_count() == 10
+    assert last_uid() == 10
+
+
+def test_unfetchable_uid_is_skipped_after_attempts(imap, monkeypatch):
+    mailbox, mail = imap
+    for i in range(5):
+        mailbox.add(make_email(i))
+    mailbox.unfetchable.add(3)
+    monkeypatch.setattr(email_reader, "MAX_UID_ATTEMPTS", 3)
+    for _ in range(2):
+        email_reader.sync_folder(mail, ACCOUNT, "INBOX")
+        assert last_uid() == 2
+    assert email_count() == 4
+
+    # третья неудача — письмо пропускается, курсор уходит дальше
+    email_reader.sync_folder(mail, ACCOUNT, "INBOX")
+    assert last_uid() == 5
+    mailbox.add(make_email(5))
+    assert email_reader.sync_folder(mail, ACCOUNT, "INBOX") == 1
+    assert last_uid() == 6
+
+
+BROKEN_BASE64 = (b"From: Sender <sender@example.com>\r\n"
+                 b"To: me@example.com\r\n"
+                 b"Subject: broken\r\n"
+                 b"Message-ID: <broken@example.com>\r\n"
+                 b"Date: Mon, 01 Jan 2024 10:00:00 +0000\r\n"
+                 b"MIME-Version: 1.0\r\n"
+                 b"Content-Type: text/plain; charset=utf-8\r\n"
+                 b"Content-Transfer-Encoding: base64\r\n"
+                 b"\r\n"
+                 b"=QUJD\r\n")
+
+
+def test_undecodable_part_falls_back_to_full_fetch(imap, monkeypatch):
+    mailbox, mail = imap
+    mailbox.add(make_email(0))
+    mailbox.add(BROKEN_BASE64)
+    full = []
+    original = email_reader.fetch_full
+    monkeypatch.setattr(email_reader, "fetch_full", lambda m, uids: full.extend(uids) or original(m, uids))
+
+    mail.select("INBOX", readonly=True)
+    fetched = email_reader.fetch_batch(mail, [1, 2])
+    assert full == [2]
+    assert sorted(uid for uid, _ in fetched) == [1, 2]
+    notification = dict(fetched)[2]
+    assert notification.raw_content_type == "message/rfc822"
+
+
+def test_unparseable_structure_falls_back_to_full_fetch(imap, monkeypatch):
+    mailbox, mail = imap
+    for i in range(3):
+        mailbox.add(make_email(i))
+
+    def broken(structure):
+        raise IndexError("bad BODYSTRUCTURE")
+
+    monkeypatch.setattr(email_reader.imap_fetch, "pick_body_part", broken)
+    email_reader.sync_folder(mail, ACCOUNT, "INBOX")
+    assert email_count() == 3
+    assert last_uid() == 3
+
+
+def test_idle_wait_returns_on_new_mail(imap):
+    mailbox, mail = imap
+    mail.select("INBOX", readonly=True)
+    assert 'IDLE' in mail.capabilities
+
+    timer = threading.Timer(0.2, mailbox.add, (make_email(0),))
+    timer.start()
+    started = time.monotonic()
+    assert email_reader.idle_wait(mail, 10) is True
+    assert time.monotonic() - started < 5
+    timer.join()
+
+    # без изменений — выход по timeout или сразу по stop_event; сессия после DONE рабочая
+    assert email_reader.idle_wait(mail, 0.3) is False
+    stop = threading.Event()
+    stop.set()
+    assert email_reader.idle_wait(mail, 10, stop) is False
+    assert email_reader.sync_folder(mail, ACCOUNT, "INBOX") == 1
+
+
+def test_noop_wait_without_idle(db):
+    mailbox = Mailbox()
+    server = FakeIMAPServer(mailbox=mailbox, idle=False).start()
+    mail = email_reader.connect_to_email(email_reader.Account(ACCOUNT, "secret", "127.0.0.1", server.port, False,
+                                                              ["INBOX"]))
+    try:
+        mail.select("INBOX", readonly=True)
+        assert 'IDLE' not in mail.capabilities
+        mailbox.add(make_email(0))
+        stop = threading.Event()
+        assert email_reader.noop_wait(mail, 0.01, stop) is True
+    finally:
+        mail.logout()
+        server.shutdown()
+        server.server_close()
+
+
+def test_load_accounts_parses_ssl_strings(tmp_path, monkeypatch):
+    path = tmp_path / "accounts.json"
+    path.write_text(json.dumps([
+        {"address": "a@example.com", "password": "x", "ssl": "false"},
+        {"address": "b@example.com", "password": "x", "ssl": "False", "port": "143"},
+        {"address": "c@example.com", "password": "x", "ssl": False},
+        {"address": "d@example.com", "password": "x", "ssl": "true"},
+        {"address": "e@example.com", "password": "x"},
+    ]), encoding="utf-8")
+    monkeypatch.setattr(email_reader, "EMAIL_ACCOUNTS_FILE", str(path))
+    monkeypatch.setattr(email_reader, "IMAP_SSL", True)
+    accounts = email_reader.load_accounts()
+    assert [a.ssl for a in accounts] == [False, False, False, True, True]
+    assert accounts[1].port == 143
@@ -0,0 +1,70 @@
+"""Выгрузка: форматы, фильтры, планы без временной сортировки и соединение, которое берётся лениво."""
+import csv
+import gzip
+import io
+import json
+
+import export
+import storage
+from conftest import chat_message
+
+
+def test_ndjson_and_filters(client, add_messages):
+    ids = add_messages([chat_message(i, date=f"2024-0{i + 1}-01T10:00:00") for i in range(4)])
+    response = client.get("/api/export?format=ndjson&date_from=2024-02-01&date_to=2024-04-01")
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [r["id"] for r in rows] == ids[1:3]
+
+    response = client.get("/api/export?format=ndjson&sort_order=desc")
+    assert [json.loads(line)["id"] for line in response.get_data(as_text=True).splitlines()] == ids[::-1]
+
+    assert client.get("/api/export?date_from=когда-то").status_code == 400
+
+
+def test_csv_gzip(client, add_messages):
+    add_messages([chat_message(i) for i in range(3)])
+    response = client.get("/api/export?format=csv&gzip=1")
+    assert response.headers["Content-Disposition"].endswith('.csv.gz"')
+    text = gzip.decompress(response.get_data()).decode("utf-8-sig")
+    rows = list(csv.DictReader(io.StringIO(text)))
+    assert [r["text_content"] for r in rows] == ["сообщение 0", "сообщение 1", "сообщение 2"]
+
+
+def test_search_export_in_id_order(client, add_messages):
+    # даты против порядка поступления: выгрузка с search идёт по id
+    ids = add_messages([chat_message(i, text=f"отчёт номер {i}", date=f"2024-05-0{9 - i}T10:00:00")
+                        for i in range(3)])
+    response = client.get("/api/export?format=ndjson&search=отчет")
+    assert [json.loads(line)["id"] for line in response.get_data(as_text=True).splitlines()] == ids
+
+
+def test_export_plans_do_not_sort_in_memory(db):
+    conn = storage.get_connection()
+    try:
+        assert db.check_query_plans(conn) == []
+        query, params = db.build_export_query(search="тест", sort_order="desc")
+        plan = [r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+    finally:
+        conn.close()
+    assert not any("TEMP B-TREE" in detail for detail in plan)
+
+
+def test_connection_taken_only_when_streaming_starts(db, add_messages):
+    add_messages([chat_message(0)])
+    opened = []
+
+    def connect():
+        conn = storage.get_connection()
+        opened.append(conn)
+        return conn
+
+    query, params = db.build_export_query()
+    body = export.stream(connect, query, params, db.LIST_COLUMNS)
+    body.close()   # клиент ушёл до первой порции
+    assert opened == []
+
+    body = export.stream(connect, query, params, db.LIST_COLUMNS)
+    assert b"\n" in next(body)
+    body.close()
+    assert len(opened) == 1
@@ -0,0 +1,83 @@
+"""/api/grouped_messages: хвосты переписок, курсор догрузки и delta-синхронизация по журналу изменений."""
+import storage
+from conftest import chat_message
+
+
+def groups_by_key(payload):
+    groups = payload["groups"] if isinstance(payload, dict) else payload
+    return {g["group_key"]: g for g in groups}
+
+
+def load_all_older(client, group):
+    """Догружает историю переписки по messages_cursor, как loadOlderMessages в index.html."""
+    messages = list(group["messages"])
+    cursor, has_more = group["messages_cursor"], group["has_more_messages"]
+    while has_more:
+        page = client.get(f"/api/grouped_messages/{group['group_key']}/messages",
+                          query_string={"cursor": cursor, "limit": 2}).get_json()
+        known = {m["id"] for m in messages}
+        messages = [m for m in page["messages"] if m["id"] not in known] + messages
+        cursor, has_more = page["cursor"], page["has_more"]
+    return messages
+
+
+def test_tail_and_cursor_pages_cover_history(client, add_messages):
+    ids = add_messages([chat_message(i) for i in range(7)])
+    group = next(iter(groups_by_key(client.get("/api/grouped_messages?messages_limit=3").get_json()).values()))
+    assert [m["id"] for m in group["messages"]] == ids[-3:]
+    assert group["total_messages"] == 7 and group["has_more_messages"]
+
+    assert [m["id"] for m in load_all_older(client, group)] == ids
+
+
+def test_delta_returns_only_changes(client, add_messages):
+    ids = add_messages([chat_message(i) for i in range(4)])
+    version = client.get("/api/grouped_messages?since=0&messages_limit=2").get_json()["version"]
+
+    new_ids = add_messages([chat_message(10)])
+    delta = client.get(f"/api/grouped_messages?since={version}&messages_limit=2").get_json()
+    assert delta["reset"] is False
+    group = next(iter(groups_by_key(delta).values()))
+    assert [m["id"] for m in group["messages"]] == new_ids
+    assert group["total_messages"] == 5
+
+    storage.write(lambda conn: conn.execute("DELETE FROM messages WHERE id = ?", (ids[0],)))
+    delta = client.get(f"/api/grouped_messages?since={delta['version']}&messages_limit=2").get_json()
+    assert delta["deleted_messages"] == [ids[0]]
+    assert groups_by_key(delta)[group["group_key"]]["total_messages"] == 4
+
+
+def test_delta_with_only_deletions_keeps_cursor(client, add_messages):
+    ids = add_messages([chat_message(i) for i in range(5)])
+    version = client.get("/api/grouped_messages?since=0&messages_limit=2").get_json()["version"]
+
+    storage.write(lambda conn: conn.execute("DELETE FROM messages WHERE id = ?", (ids[1],)))
+    delta = client.get(f"/api/grouped_messages?since={version}&messages_limit=2").get_json()
+    group = next(iter(groups_by_key(delta).values()))
+    assert group["messages"] == [] and group["has_more_messages"]
+    # курсор стоит за последним сообщением: догрузка отдаёт всю оставшуюся историю, включая его
+    assert group["messages_cursor"] is not None
+    assert [m["id"] for m in load_all_older(client, group)] == [ids[0]] + ids[2:]
+
+
+def test_deleted_group_and_stale_version(client, add_messages):
+    add_messages([chat_message(0, chat_id=1), chat_message(0, chat_id=2)])
+    snapshot = client.get("/api/grouped_messages?since=0").get_json()
+    assert snapshot["reset"] is True and len(snapshot["groups"]) == 2
+    gone = next(g for g in snapshot["groups"] if g["chat_title"] == "Чат 2")
+
+    storage.write(lambda conn: conn.execute("DELETE FROM messages WHERE chat_id = 2"))
+    delta = client.get(f"/api/grouped_messages?since={snapshot['version']}").get_json()
+    assert delta["deleted_groups"] == [gone["group_key"]]
+
+    future = client.get(f"/api/grouped_messages?since={delta['version'] + 100}").get_json()
+    assert future["reset"] is True
+
+
+def test_etag_not_modified(client, add_messages):
+    add_messages([chat_message(0)])
+    response = client.get("/api/grouped_messages?messages_limit=2")
+    etag = response.headers["ETag"]
+    assert client.get("/api/grouped_messages?messages_limit=2", headers={"If-None-Match": etag}).status_code == 304
+    add_messages([chat_message(1)])
+    assert client.get("/api/grouped_messages?messages_limit=2", headers={"If-None-Match": etag}).status_code == 200
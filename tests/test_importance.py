@@ -0,0 +1,110 @@
+"""importance: правила по битовым маскам, одна регулярка на все ключевые слова, пересчёт истории и перечитывание файла."""
+import json
+import os
+
+import pytest
+
+import importance
+import storage
+from conftest import chat_message
+
+RULES = {
+    "default": 3,
+    "timezone": "UTC",
+    "rules": [
+        {"name": "vip", "importance": 5, "senders": ["boss@company.com"], "domains": ["board.example.com"]},
+        {"name": "ночные алерты", "importance": 5, "sources": ["telegram"], "keywords": ["alert"], "hours": [22, 7]},
+        {"name": "рассылки", "importance": 2, "title_patterns": ["^\\[newsletter\\]"]},
+        {"name": "срочно", "importance": 4, "keywords": ["срочно", "важно"]},
+        {"name": "срочное в теме", "importance": 1, "title_keywords": ["срочное"]},
+    ],
+}
+
+NIGHT = 1717279200   # 2024-06-01 22:00 UTC
+DAY = 1717236000     # 2024-06-01 10:00 UTC
+
+
+def with_conn(fn):
+    conn = storage.get_connection()
+    try:
+        return fn(conn)
+    finally:
+        conn.close()
+
+
+def test_rule_set_masks():
+    rules = importance.RuleSet(RULES)
+    assert rules.score(senders=["Босс", "boss@company.com"]) == 5
+    assert rules.score(senders=["someone@mail.board.example.com"]) == 5   # поддомен
+    assert rules.score(senders=["someone@example.com"]) == 3
+    # все условия правила должны выполниться одновременно
+    assert rules.score(text="ALERT на проде", source="telegram", ts=NIGHT) == 5
+    assert rules.score(text="ALERT на проде", source="telegram", ts=DAY) == 3
+    assert rules.score(text="ALERT на проде", source="email", ts=NIGHT) == 3
+    # первое подошедшее правило побеждает
+    assert rules.score(text="срочно", title="[Newsletter] май") == 2
+    assert rules.score(text="срочно") == 4
+    assert importance.RuleSet({"default": 1}).score(text="срочно") == 1
+
+
+def test_unknown_rule_field_is_rejected():
+    with pytest.raises(ValueError):
+        importance.RuleSet({"rules": [{"name": "x", "importance": 5, "sender": ["boss@company.com"]}]})
+
+
+def test_keyword_lookahead_finds_overlapping_words():
+    pattern, masks = importance._keyword_matcher({0: ["срочно"], 1: ["срочное"], 2: ["ноч"]})
+    # "срочное" содержит "срочно": длинное слово наследует его маску, перекрытия находит lookahead
+    assert masks["срочное"] == 0b011
+    assert importance._match_keywords(pattern, masks, "СРОЧНОЕ") == 0b011
+    assert importance._match_keywords(pattern, masks, "срочно, ночью") == 0b101
+    assert importance._match_keywords(pattern, masks, "") == 0
+    assert importance._keyword_matcher({0: []}) == (None, {})
+
+    rules = importance.RuleSet(RULES)
+    assert rules.score(title="Срочное: отчёт") == 1
+
+
+def test_rescore_if_changed_touches_only_rule_scored_rows(db, add_messages):
+    ids = add_messages([
+        chat_message(0, text="нужно срочно"),
+        chat_message(1, text="обычное сообщение"),
+        chat_message(2, text="срочно, но важность выставил tg.py", importance=1),
+    ])
+    rows = with_conn(lambda c: c.execute(
+        "SELECT importance, importance_source FROM messages ORDER BY id").fetchall())
+    assert [tuple(r) for r in rows] == [(4, "rules"), (3, "rules"), (1, None)]
+
+    defaults = importance.RuleSet(importance.DEFAULT_RULES)
+    # первый запуск только запоминает отпечаток, повторный с теми же правилами ничего не делает
+    assert with_conn(lambda c: importance.rescore_if_changed(c, defaults)) is None
+    assert with_conn(lambda c: importance.rescore_if_changed(c, defaults)) is None
+
+    changed = importance.RuleSet({"default": 2, "rules": [{"name": "срочно", "importance": 5, "keywords": ["срочно"]}]})
+    assert with_conn(lambda c: importance.rescore_if_changed(c, changed)) == (2, 2)
+    assert with_conn(lambda c: importance.rescore_if_changed(c, changed)) is None
+    rows = with_conn(lambda c: c.execute(f"SELECT importance FROM messages WHERE id IN ({ids[0]}, {ids[1]}, {ids[2]}) "
+                                         "ORDER BY id").fetchall())
+    assert [r[0] for r in rows] == [5, 2, 1]
+
+
+def test_rules_file_is_reloaded(tmp_path, monkeypatch):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps(RULES), encoding="utf-8")
+    monkeypatch.setattr(importance, "IMPORTANCE_RULES_FILE", str(path))
+    monkeypatch.setattr(importance, "RELOAD_INTERVAL", 0)
+    monkeypatch.setattr(importance, "_current", None)
+    monkeypatch.setattr(importance, "_current_mtime", None)
+
+    assert importance.score_row({"text_content": "срочно"}) == 4
+    first = importance.current()
+    assert importance.current() is first   # файл не менялся — правила не пересобираются
+
+    path.write_text(json.dumps({"default": 1}), encoding="utf-8")
+    os.utime(path, (1, 1))
+    assert importance.score_row({"text_content": "срочно"}) == 1
+
+    # битый файл не роняет ингестор — остаются прежние правила
+    path.write_text("{не json", encoding="utf-8")
+    os.utime(path, (2, 2))
+    assert importance.score_row({"text_content": "срочно"}) == 1
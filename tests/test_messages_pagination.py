@@ -0,0 +1,42 @@
+"""/api/messages: keyset-пагинация по (date_ts, id) и по (rank, id) без пропусков и повторов."""
+from conftest import chat_message
+
+
+def all_pages(client, **args):
+    ids, cursor, pages = [], "", 0
+    while cursor is not None:
+        page = client.get("/api/messages", query_string=dict(args, cursor=cursor, limit=3)).get_json()
+        ids += [m["id"] for m in page["messages"]]
+        cursor = page["next_cursor"]
+        pages += 1
+    return ids, pages
+
+
+def test_date_pages_with_equal_timestamps(client, add_messages):
+    # пары сообщений с одинаковой датой: порядок внутри пары — по id
+    ids = add_messages([chat_message(i, date=f"2024-05-0{i // 2 + 1}T10:00:00") for i in range(8)])
+    desc, pages = all_pages(client)
+    assert desc == [ids[i] for i in (7, 6, 5, 4, 3, 2, 1, 0)]
+    assert pages == 3
+    asc, _ = all_pages(client, sort_order="asc")
+    assert asc == ids
+
+
+def test_cursor_pages_with_filters(client, add_messages):
+    ids = add_messages([chat_message(i, importance=5 if i % 2 else 2) for i in range(10)])
+    important, _ = all_pages(client, importance=5)
+    assert important == ids[1::2][::-1]
+
+
+def test_relevance_pages_are_complete(client, add_messages):
+    ids = add_messages([chat_message(i, text="отчёт " * (i + 1) + "конец") for i in range(7)])
+    found, _ = all_pages(client, search="отчет")
+    assert sorted(found) == ids and len(set(found)) == len(ids)
+
+
+def test_offset_mode_returns_next_cursor_header(client, add_messages):
+    ids = add_messages([chat_message(i) for i in range(5)])
+    response = client.get("/api/messages?limit=2")
+    assert [m["id"] for m in response.get_json()] == ids[:-3:-1]
+    next_page = client.get("/api/messages", query_string={"limit": 2, "cursor": response.headers["X-Next-Cursor"]})
+    assert [m["id"] for m in next_page.get_json()["messages"]] == [ids[2], ids[1]]
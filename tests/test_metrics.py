@@ -0,0 +1,66 @@
+"""metrics: счётчики, gauge и гистограммы, текстовый формат Prometheus и снимки других процессов."""
+import json
+import os
+import time
+
+import metrics
+
+
+def make_registry():
+    registry = metrics.Registry()
+    requests = registry.register(metrics.Counter("test_requests_total", "Запросы", ("route",)))
+    queue = registry.register(metrics.Gauge("test_queue", "Очередь"))
+    latency = registry.register(metrics.Histogram("test_seconds", "Время", buckets=(0.1, 1)))
+    return registry, requests, queue, latency
+
+
+def test_samples_and_exposition():
+    registry, requests, queue, latency = make_registry()
+    requests.inc(route="/api/messages")
+    requests.inc(2, route="/api/messages")
+    requests.inc(route='/a"b')
+    queue.set(5)
+    queue.dec(2)
+    for value in (0.05, 0.5, 0.5, 3):
+        latency.observe(value)
+    # повторная регистрация возвращает уже существующую метрику
+    assert registry.register(metrics.Counter("test_requests_total", "другая")) is requests
+
+    text = metrics.render([({"process": "web"}, registry.snapshot())])
+    lines = text.splitlines()
+    assert "# TYPE test_requests_total counter" in lines
+    assert 'test_requests_total{route="/api/messages",process="web"} 3' in lines
+    assert 'test_requests_total{route="/a\\"b",process="web"} 1' in lines
+    assert 'test_queue{process="web"} 3' in lines
+    # бакеты гистограммы накопительные
+    assert 'test_seconds_bucket{le="0.1",process="web"} 1' in lines
+    assert 'test_seconds_bucket{le="1",process="web"} 3' in lines
+    assert 'test_seconds_bucket{le="+Inf",process="web"} 4' in lines
+    assert 'test_seconds_sum{process="web"} 4.05' in lines
+    assert 'test_seconds_count{process="web"} 4' in lines
+
+
+def test_timer_observes_duration():
+    _, _, _, latency = make_registry()
+    with metrics.timer(latency):
+        pass
+    assert [v for suffix, _, v in latency.samples() if suffix == "_count"] == [1]
+
+
+def test_snapshots_of_other_processes(tmp_path, monkeypatch):
+    registry, requests, _, _ = make_registry()
+    requests.inc(route="/ingest")
+    monkeypatch.setattr(metrics, "REGISTRY", registry)
+    metrics.write_snapshot("email", str(tmp_path))
+
+    stale = {"process": "old", "pid": 1, "written_at": time.time() - metrics.SNAPSHOT_MAX_AGE - 1, "metrics": {}}
+    (tmp_path / "old.json").write_text(json.dumps(stale), encoding="utf-8")
+    (tmp_path / "broken.json").write_text("{", encoding="utf-8")
+    assert sorted(os.listdir(tmp_path)) == ["broken.json", "email.json", "old.json"]   # запись атомарная, без .tmp
+
+    snapshots = metrics.read_snapshots(str(tmp_path))
+    assert [labels for labels, _ in snapshots] == [{"process": "email"}]
+    assert metrics.read_snapshots(str(tmp_path), exclude=("email",)) == []
+    text = metrics.render(snapshots)
+    assert 'test_requests_total{route="/ingest",process="email"} 1' in text
+    assert "metrics_snapshot_age_seconds{process=\"email\"}" in text
@@ -0,0 +1,67 @@
+"""near_dups: копии находит и IngestWriter, и очередь для строк, записанных в обход него."""
+import near_dups
+import storage
+from conftest import chat_message
+
+ANNOUNCEMENT = "Завтра в десять утра в большом зале пройдёт общее собрание сотрудников отдела продаж, явка обязательна"
+
+
+def query(sql, params=()):
+    conn = storage.get_connection()
+    try:
+        return [tuple(r) for r in conn.execute(sql, params)]
+    finally:
+        conn.close()
+
+
+def process():
+    conn = storage.get_connection()
+    try:
+        return near_dups.process_queue(conn)
+    finally:
+        conn.close()
+
+
+def test_ingest_writer_indexes_inline(db, add_messages):
+    ids = add_messages([chat_message(0, chat_id=1, text=ANNOUNCEMENT),
+                        chat_message(0, chat_id=2, text="Переслано: " + ANNOUNCEMENT)])
+    assert query("SELECT message_id, canonical_id FROM message_duplicates") == [(ids[1], ids[0])]
+    assert query("SELECT COUNT(*) FROM near_dups_queue")[0][0] == 0
+
+
+def test_direct_insert_is_indexed_from_queue(db, add_messages):
+    ids = add_messages([chat_message(0, chat_id=1, text=ANNOUNCEMENT)])
+    storage.write(lambda conn: conn.execute(
+        "INSERT INTO messages (source, chat_id, message_id, text_content, date) VALUES ('telegram', 3, 1, ?, ?)",
+        (ANNOUNCEMENT + "!", "2024-05-02T10:00:00")))
+    copy_id = query("SELECT MAX(id) FROM messages")[0][0]
+    assert query("SELECT message_id FROM near_dups_queue") == [(copy_id,)]
+
+    assert process() == (1, 1)
+    assert query("SELECT message_id, canonical_id FROM message_duplicates") == [(copy_id, ids[0])]
+
+
+def test_text_update_reindexes(db, add_messages):
+    ids = add_messages([chat_message(0, chat_id=1, text=ANNOUNCEMENT),
+                        chat_message(0, chat_id=2, text=ANNOUNCEMENT)])
+    assert query("SELECT message_id FROM message_duplicates") == [(ids[1],)]
+
+    # стало коротким — связь, подпись и полосы уходят
+    storage.write(lambda conn: conn.execute("UPDATE messages SET text_content = 'ок' WHERE id = ?", (ids[1],)))
+    process()
+    assert query("SELECT COUNT(*) FROM message_duplicates")[0][0] == 0
+    assert query("SELECT COUNT(*) FROM minhash_bands WHERE message_id = ?", (ids[1],))[0][0] == 0
+    assert query("SELECT COUNT(*) FROM message_minhash WHERE message_id = ?", (ids[1],))[0][0] == 0
+
+    # снова копия — связь восстанавливается по новой подписи
+    storage.write(lambda conn: conn.execute("UPDATE messages SET text_content = ? WHERE id = ?",
+                                            (ANNOUNCEMENT, ids[1])))
+    process()
+    assert query("SELECT message_id, canonical_id FROM message_duplicates") == [(ids[1], ids[0])]
+    assert query("SELECT COUNT(*) FROM minhash_bands WHERE message_id = ?", (ids[1],))[0][0] == near_dups.BANDS
+
+
+def test_deleting_canonical_promotes_earliest_copy(db, add_messages):
+    ids = add_messages([chat_message(0, chat_id=c, text=ANNOUNCEMENT) for c in (1, 2, 3)])
+    storage.write(lambda conn: conn.execute("DELETE FROM messages WHERE id = ?", (ids[0],)))
+    assert query("SELECT message_id, canonical_id FROM message_duplicates") == [(ids[2], ids[1])]
@@ -0,0 +1,49 @@
+"""profiler: сэмплы стеков активных запросов и доступ к /debug/profile."""
+import threading
+import time
+
+import profiler
+
+
+def busy_request(sampler, route, seconds=0.2):
+    def spin():
+        sampler.start_request(route)
+        try:
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                pass
+        finally:
+            sampler.stop_request()
+    thread = threading.Thread(target=spin)
+    thread.start()
+    thread.join()
+
+
+def test_samples_only_active_requests():
+    sampler = profiler.SamplingProfiler({"/slow"}, interval=0.001)
+    assert sampler.enabled_for("/slow") and not sampler.enabled_for("/fast")
+    assert profiler.SamplingProfiler({"*"}).enabled_for("/fast")
+
+    busy_request(sampler, "/slow")
+    stacks = sampler.folded("/slow")
+    assert "test_profiler.py:spin" in stacks
+    first = sum(int(line.rsplit(" ", 1)[1]) for line in stacks.splitlines())
+    assert first > 0
+
+    # пока запросов нет, поток ждёт; следующий запрос снова его будит
+    time.sleep(0.05)
+    busy_request(sampler, "/slow")
+    second = sum(int(line.rsplit(" ", 1)[1]) for line in sampler.folded("/slow").splitlines())
+    assert second > first
+    assert all(line.startswith("/slow;") for line in sampler.folded().splitlines())
+
+    sampler.reset()
+    assert sampler.folded() == ""
+
+
+def test_debug_profile_needs_profiler_and_localhost(client, monkeypatch):
+    assert client.get("/debug/profile").status_code == 404
+
+    monkeypatch.setattr(profiler.PROFILER, "routes", {"/api/analysis"})
+    assert client.get("/debug/profile").status_code == 200
+    assert client.get("/debug/profile", environ_base={"REMOTE_ADDR": "10.0.0.5"}).status_code == 404
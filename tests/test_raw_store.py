@@ -0,0 +1,80 @@
+"""raw_store: сжатие zlib туда и обратно, перенос старой колонки messages.raw_message и удаление вместе с сообщением."""
+import sqlite3
+
+import raw_store
+import storage
+from conftest import chat_message
+
+HEADERS = "From: boss@company.com\r\nSubject: Отчёт\r\n\r\n"
+
+
+def query(sql, params=()):
+    conn = storage.get_connection()
+    try:
+        return [tuple(r) for r in conn.execute(sql, params)]
+    finally:
+        conn.close()
+
+
+def test_compress_round_trip():
+    conn = sqlite3.connect(":memory:")
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY, text_content TEXT)")
+    raw_store.init_schema(cursor)
+
+    data, size = raw_store.compress(HEADERS * 50)
+    assert size == len((HEADERS * 50).encode("utf-8")) and len(data) < size
+    raw_store.put_many(cursor, [(1, "text/rfc822-headers", data, size)])
+    assert raw_store.load(cursor, 1) == ("text/rfc822-headers", (HEADERS * 50).encode("utf-8"))
+
+    # байты сжимаются как есть; повторная запись заменяет исходник
+    data, size = raw_store.compress(b"\x00\xff")
+    raw_store.put_many(cursor, [(1, "application/octet-stream", data, size)])
+    assert raw_store.load(cursor, 1) == ("application/octet-stream", b"\x00\xff")
+    assert raw_store.load(cursor, 2) is None
+
+    # строка с другим encoding отдаётся без распаковки
+    cursor.execute("INSERT INTO message_raw (message_id, content_type, encoding, size, data) VALUES (3, 'text/plain', "
+                   "'identity', 2, X'6f6b')")
+    assert raw_store.load(cursor, 3) == ("text/plain", b"ok")
+    conn.close()
+
+
+def test_legacy_column_is_migrated(tmp_path, monkeypatch):
+    monkeypatch.setattr(raw_store, "MIGRATE_BATCH", 2)
+    conn = sqlite3.connect(str(tmp_path / "legacy.db"))
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY, text_content TEXT, raw_message TEXT)")
+    cursor.executemany("INSERT INTO messages (id, text_content, raw_message) VALUES (?, ?, ?)",
+                       [(1, "a", "raw 1"), (2, "b", None), (3, "c", ""), (4, "d", "raw 4"), (5, "e", "raw 5")])
+
+    raw_store.init_schema(cursor)
+    assert [raw_store.load(cursor, i) for i in range(1, 6)] == [
+        (raw_store.LEGACY_CONTENT_TYPE, b"raw 1"), None, None,
+        (raw_store.LEGACY_CONTENT_TYPE, b"raw 4"), (raw_store.LEGACY_CONTENT_TYPE, b"raw 5"),
+    ]
+    columns = {r[1] for r in cursor.execute("PRAGMA table_info(messages)")}
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        assert "raw_message" not in columns
+    else:
+        assert cursor.execute("SELECT COUNT(*) FROM messages WHERE raw_message IS NOT NULL").fetchone()[0] == 0
+
+    # повторная инициализация ничего не переносит заново
+    raw_store.init_schema(cursor)
+    assert cursor.execute("SELECT COUNT(*) FROM message_raw").fetchone()[0] == 3
+    conn.close()
+
+
+def test_raw_is_deleted_with_message(client, add_messages):
+    ids = add_messages([
+        chat_message(0, raw_message=HEADERS, raw_content_type="text/rfc822-headers"),
+        chat_message(1, raw_message='{"update_id": 1}', raw_content_type="application/json"),
+    ])
+    response = client.get(f"/api/messages/{ids[0]}/raw")
+    assert response.status_code == 200
+    assert response.content_type == "text/rfc822-headers; charset=utf-8"
+    assert response.get_data(as_text=True) == HEADERS
+
+    storage.write(lambda conn: conn.execute("DELETE FROM messages WHERE id = ?", (ids[0],)))
+    assert query("SELECT message_id FROM message_raw") == [(ids[1],)]
+    assert client.get(f"/api/messages/{ids[0]}/raw").status_code == 404
@@ -0,0 +1,120 @@
+"""retention: политики хранения, помесячные архивы с FTS и incremental_vacuum шагами."""
+import json
+import sqlite3
+
+import pytest
+
+import retention
+import storage
+from conftest import chat_message
+
+POLICIES = [
+    {"importance_min": 5, "days": None},
+    {"source": "email", "days": 30},
+    {"days": 30, "action": "delete"},
+]
+
+
+@pytest.fixture
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(retention, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    monkeypatch.setattr(retention, "STEP_PAUSE", 0)
+    return tmp_path / "archive"
+
+
+def with_conn(fn):
+    conn = storage.get_connection()
+    try:
+        return fn(conn)
+    finally:
+        conn.close()
+
+
+def hot_ids():
+    return with_conn(lambda c: [r[0] for r in c.execute("SELECT id FROM messages ORDER BY id")])
+
+
+def test_json_policies_archive_and_delete(db, add_messages, archive_dir, tmp_path):
+    path = tmp_path / "policies.json"
+    path.write_text(json.dumps(POLICIES), encoding="utf-8")
+    policies = retention.load_policies(str(path))
+    ids = add_messages([
+        chat_message(0, date="2024-01-10T10:00:00", importance=5),                    # важное — хранится всегда
+        chat_message(1, date="2024-01-11T10:00:00", source="email", importance=3),    # в архив
+        chat_message(2, date="2024-02-12T10:00:00", importance=3),                    # удаляется
+        chat_message(3, date="2099-01-01T10:00:00", importance=3),                    # ещё не срок
+    ])
+
+    assert with_conn(lambda c: retention.apply_policies(c, policies, dry_run=True)) == {"archived": 1, "deleted": 1}
+    assert hot_ids() == ids
+
+    assert with_conn(lambda c: retention.apply_policies(c, policies, batch=1)) == {"archived": 1, "deleted": 1}
+    assert hot_ids() == [ids[0], ids[3]]
+    assert retention.archive_months() == ["2024-01"]
+    assert [m["id"] for m in retention.search_archive()] == [ids[1]]
+
+
+def test_unknown_policy_action_is_rejected(tmp_path):
+    path = tmp_path / "policies.json"
+    path.write_text(json.dumps([{"days": 1, "action": "shred"}]), encoding="utf-8")
+    with pytest.raises(ValueError):
+        retention.load_policies(str(path))
+    assert retention.load_policies("") == []
+
+
+def test_monthly_archives_are_searchable(db, add_messages, archive_dir):
+    ids = add_messages([
+        chat_message(0, text="квартальный отчёт готов", date="2024-01-10T10:00:00", importance=4),
+        chat_message(1, text="обед в час", date="2024-01-20T10:00:00"),
+        chat_message(2, text="отчет за февраль", date="2024-02-05T10:00:00"),
+        chat_message(3, text="новый отчёт", date="2024-03-05T10:00:00"),
+    ])
+    moved = with_conn(lambda c: retention.move_messages(c, "id IN (?, ?, ?, ?)", ids, batch=2))
+    assert moved == 4 and hot_ids() == []
+    assert retention.archive_months() == ["2024-01", "2024-02", "2024-03"]
+    conn = sqlite3.connect(retention.archive_path("2024-01"))
+    try:
+        assert conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 2
+    finally:
+        conn.close()
+
+    # FTS по всем месяцам, от новых к старым; ё и е не различаются
+    found = retention.search_archive('"отчет"')
+    assert [m["id"] for m in found] == [ids[3], ids[2], ids[0]]
+    assert [m["archive_month"] for m in found] == ["2024-03", "2024-02", "2024-01"]
+    assert "\x02" in found[0]["snippet"]
+
+    # следующая страница продолжается с курсора (date_ts, id) и переходит в предыдущий месяц
+    page = retention.search_archive('"отчет"', limit=2)
+    last = page[-1]
+    rest = retention.search_archive('"отчет"', limit=2, before=(last["date_ts"], last["id"]))
+    assert [m["id"] for m in page + rest] == [ids[3], ids[2], ids[0]]
+
+    assert [m["id"] for m in retention.search_archive('"отчет"', months=["2024-01"])] == [ids[0]]
+    assert [m["id"] for m in retention.search_archive(importance=4)] == [ids[0]]
+
+    summary = retention.archive_summary()
+    assert [(s["month"], s["messages"]) for s in summary] == [("2024-01", 2), ("2024-02", 1), ("2024-03", 1)]
+    assert all(s["size_bytes"] > 0 for s in summary)
+
+
+def test_incremental_vacuum_respects_max_steps(tmp_path, monkeypatch):
+    monkeypatch.setattr(retention, "STEP_PAUSE", 0)
+    path = str(tmp_path / "vacuum.db")
+    with sqlite3.connect(path) as setup:
+        setup.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        setup.execute("CREATE TABLE blobs (data BLOB)")
+        setup.executemany("INSERT INTO blobs VALUES (zeroblob(4000))", [()] * 50)
+        setup.execute("DELETE FROM blobs")
+    setup.close()
+
+    conn = storage.connect(path)
+    try:
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        assert free > 10
+        assert retention.incremental_vacuum(conn, step_pages=3, max_steps=2) == 6
+        assert conn.execute("PRAGMA freelist_count").fetchone()[0] == free - 6
+        assert retention.incremental_vacuum(conn, step_pages=100) == free - 6
+        assert conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+    finally:
+        conn.release()
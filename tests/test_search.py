@@ -0,0 +1,41 @@
+"""Поиск FTS5: индекс ведут триггеры, ё = е, основы слов, подсветка в snippet_html."""
+import storage
+from conftest import chat_message
+
+
+def search(client, text, **args):
+    return client.get("/api/messages", query_string=dict(args, search=text)).get_json()
+
+
+def test_fts_follows_insert_update_delete(client, add_messages):
+    ids = add_messages([chat_message(0, text="Квартальный отчёт готов"), chat_message(1, text="Обед в час")])
+    assert [m["id"] for m in search(client, "отчет")] == [ids[0]]
+    # основа слова: «отчёты» находит «отчёт»
+    assert [m["id"] for m in search(client, "отчёты")] == [ids[0]]
+
+    storage.write(lambda conn: conn.execute("UPDATE messages SET text_content = 'Годовой план' WHERE id = ?", (ids[0],)))
+    assert search(client, "отчет") == []
+    assert [m["id"] for m in search(client, "план")] == [ids[0]]
+
+    storage.write(lambda conn: conn.execute("DELETE FROM messages WHERE id = ?", (ids[0],)))
+    assert search(client, "план") == []
+
+
+def test_all_words_required_and_title_searched(client, add_messages):
+    ids = add_messages([chat_message(0, chat_id=11, text="созвон по бюджету"),
+                        chat_message(1, chat_id=12, text="созвон завтра")])
+    assert [m["id"] for m in search(client, "созвон бюджет")] == [ids[0]]
+    assert [m["id"] for m in search(client, "чат 12")] == [ids[1]]
+
+
+def test_snippet_is_escaped_and_highlighted(client, add_messages):
+    add_messages([chat_message(0, text="<b>Срочно</b>: отчёт")])
+    [message] = search(client, "отчет")
+    assert "<mark>" in message["snippet_html"]
+    assert "<b>" not in message["snippet_html"] and "&lt;b&gt;" in message["snippet_html"]
+
+
+def test_punctuation_only_search_is_empty(client, add_messages):
+    add_messages([chat_message(0)])
+    assert search(client, "!!!") == []
+    assert search(client, "!!!", cursor="") == {"messages": [], "next_cursor": None}
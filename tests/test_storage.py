@@ -0,0 +1,101 @@
+"""storage: общий пул соединений между потоками, повтор записи при блокировке и общий замок записи."""
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import storage
+
+
+def test_pool_reuses_connection_across_threads(db):
+    conn = storage.get_connection()
+    conn.close()
+    seen = []
+
+    def borrow():
+        c = storage.get_connection()
+        try:
+            seen.append((c, c.execute("SELECT COUNT(*) FROM messages").fetchone()[0]))
+        finally:
+            c.close()
+
+    thread = threading.Thread(target=borrow)
+    thread.start()
+    thread.join()
+    # то же соединение, взятое в другом потоке (check_same_thread=False), работает
+    assert seen == [(conn, 0)]
+
+
+
+def retries_total():
+    return sum(value for _, _, value in storage.WRITE_RETRIES_TOTAL.samples())
+
+
+def test_write_retries_while_database_is_locked(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "WRITE_RETRY_DELAY", 0.02)
+    path = str(tmp_path / "locked.db")
+    conn = storage.connect(path)
+    conn.execute("PRAGMA busy_timeout = 0")
+    conn.execute("CREATE TABLE t (x INTEGER)")
+    conn.commit()
+    holder = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    holder.execute("BEGIN IMMEDIATE")   # другой «процесс» держит блокировку записи
+    before = retries_total()
+    threading.Timer(0.1, holder.rollback).start()
+    try:
+        assert storage.write(lambda c: c.execute("INSERT INTO t VALUES (1)").rowcount, conn=conn) == 1
+        assert retries_total() > before
+        assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 1
+    finally:
+        conn.release()
+        holder.close()
+
+
+def test_write_gives_up_and_does_not_retry_other_errors(monkeypatch):
+    monkeypatch.setattr(storage, "WRITE_RETRY_DELAY", 0)
+    calls = []
+
+    def locked(conn):
+        calls.append(1)
+        raise sqlite3.OperationalError("database is locked")
+
+    with pytest.raises(sqlite3.OperationalError):
+        storage.write(locked, retries=2)
+    assert len(calls) == 3
+
+    def broken(conn):
+        calls.append(1)
+        conn.execute("INSERT INTO no_such_table VALUES (1)")
+
+    calls.clear()
+    with pytest.raises(sqlite3.OperationalError):
+        storage.write(broken)
+    assert len(calls) == 1
+    assert not storage._writer(None).in_transaction
+
+
+def test_writes_in_process_go_one_at_a_time(tmp_path):
+    # разные файлы — SQLite их не сериализует, порядок держит только общий замок write()
+    first, second = storage.connect(str(tmp_path / "a.db")), storage.connect(str(tmp_path / "b.db"))
+    inside, release, order = threading.Event(), threading.Event(), []
+
+    def slow(conn):
+        order.append("first start")
+        inside.set()
+        release.wait(5)
+        order.append("first end")
+
+    thread = threading.Thread(target=storage.write, args=(slow,), kwargs={"conn": first})
+    thread.start()
+    inside.wait(5)
+    other = threading.Thread(target=storage.write, args=(lambda c: order.append("second"),), kwargs={"conn": second})
+    other.start()
+    time.sleep(0.1)
+    assert order == ["first start"]
+    release.set()
+    thread.join()
+    other.join()
+    assert order == ["first start", "first end", "second"]
+    first.release()
+    second.release()
@@ -0,0 +1,94 @@
+"""summarizer: кэш сводок по хэшу промпта и пауза после ошибок Ollama (с заглушкой fake_ollama)."""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import storage
+import summarizer
+from conftest import chat_message
+from fake_ollama import FakeOllamaServer
+
+
+@pytest.fixture
+def ollama(db):
+    storage.write(lambda conn: summarizer.init_schema(conn.cursor()))
+    server = FakeOllamaServer().start()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        yield server, executor
+    server.shutdown()
+    server.server_close()
+
+
+def run_once(server, executor):
+    conn = storage.get_connection()
+    try:
+        return summarizer.run_once(conn, executor, server.url)
+    finally:
+        conn.close()
+
+
+def stats(generated=0, cached=0, unchanged=0, errors=0):
+    return {"generated": generated, "cached": cached, "unchanged": unchanged, "errors": errors}
+
+
+def summary_state():
+    conn = storage.get_connection()
+    try:
+        return dict(conn.execute("SELECT * FROM summary_state").fetchone())
+    finally:
+        conn.close()
+
+
+def test_content_hash_decides_between_cache_and_model(ollama, add_messages, monkeypatch):
+    server, executor = ollama
+    monkeypatch.setattr(summarizer, "SUMMARY_MESSAGES", 2)
+    ids = add_messages([chat_message(i, text=f"обсуждаем задачу {i} срочно") for i in range(3)])
+    assert run_once(server, executor) == stats(generated=1)
+    assert run_once(server, executor) == stats()
+
+    # новое сообщение меняет промпт — новый запрос к модели
+    new = add_messages([chat_message(3, text="ещё одно сообщение")])
+    assert run_once(server, executor) == stats(generated=1)
+    assert server.requests == 2
+
+    # сообщение удалили — промпт снова прежний, сводка берётся из кэша
+    storage.write(lambda conn: conn.execute("DELETE FROM messages WHERE id = ?", (new[0],)))
+    assert run_once(server, executor) == stats(cached=1)
+    # удалили сообщение за окном промпта — переписка изменилась, промпт нет
+    storage.write(lambda conn: conn.execute("DELETE FROM messages WHERE id = ?", (ids[0],)))
+    assert run_once(server, executor) == stats(unchanged=1)
+    assert server.requests == 2
+
+    conn = storage.get_connection()
+    try:
+        summary, priority = conn.execute("SELECT summary, priority FROM chat_summaries").fetchone()
+    finally:
+        conn.close()
+    assert summary.startswith("Обсуждают:") and priority == 4
+
+
+def test_failed_conversation_waits_before_retry(ollama, add_messages, monkeypatch):
+    server, executor = ollama
+    server.fail_rate = 1.0
+    add_messages([chat_message(0)])
+    assert run_once(server, executor) == stats(errors=1)
+    state = summary_state()
+    assert state["failures"] == 1 and state["content_hash"] is None
+
+    # пауза не истекла — переписку не берём, запросов больше нет
+    assert run_once(server, executor) == stats()
+    assert server.requests == 1
+
+    storage.write(lambda conn: conn.execute("UPDATE summary_state SET retry_at = 0"))
+    assert run_once(server, executor) == stats(errors=1)
+    state = summary_state()
+    # пауза удваивается с каждой неудачей
+    assert state["failures"] == 2
+    assert state["retry_at"] - time.time() > summarizer.SUMMARY_RETRY_DELAY * 1.5
+
+    server.fail_rate = 0.0
+    storage.write(lambda conn: conn.execute("UPDATE summary_state SET retry_at = 0"))
+    assert run_once(server, executor) == stats(generated=1)
+    state = summary_state()
+    assert state["failures"] == 0 and state["retry_at"] is None and state["content_hash"]
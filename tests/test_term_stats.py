@@ -0,0 +1,134 @@
+"""term_stats: очередь и триггеры держат статистику слов равной пересчёту с нуля."""
+from collections import Counter
+
+import near_dups
+import storage
+import term_stats
+from conftest import chat_message
+
+TEXTS = [
+    "отчет по продажам готов, отчет отправлен",
+    "продажи выросли, отчет завтра",
+    "обед перенесли на завтра",
+    "продажи и обед, отчет",
+]
+
+
+def with_conn(fn):
+    conn = storage.get_connection()
+    try:
+        return fn(conn)
+    finally:
+        conn.close()
+
+
+def recomputed():
+    """(df, importance_sum, пары) по текущим сообщениям — так, как их посчитал бы полный пересчёт."""
+    rows = with_conn(lambda c: c.execute("SELECT text_content, COALESCE(importance, 3) FROM messages").fetchall())
+    df, importance_sum, pairs = Counter(), Counter(), Counter()
+    for text, importance in rows:
+        counts = term_stats.tokenize(text)
+        for term in counts:
+            df[term] += 1
+            importance_sum[term] += importance
+        top = {t for t, _ in counts.most_common(term_stats.PAIR_TERMS)}
+        pairs.update((a, b) for a in top for b in top if a != b)
+    return df, importance_sum, pairs
+
+
+def stored():
+    def read(conn):
+        term_stats.process_queue(conn)
+        stats = conn.execute("SELECT term, df, importance_sum FROM term_stats").fetchall()
+        pairs = conn.execute("SELECT term, other, cnt FROM term_pairs").fetchall()
+        return ({t: d for t, d, _ in stats}, {t: s for t, _, s in stats}, {(a, b): n for a, b, n in pairs})
+    return with_conn(read)
+
+
+def assert_consistent():
+    df, importance_sum, pairs = recomputed()
+    got_df, got_sum, got_pairs = stored()
+    assert got_df == dict(df)
+    assert got_sum == dict(importance_sum)
+    assert got_pairs == dict(pairs)
+
+
+def test_stats_follow_writes(db, add_messages):
+    ids = add_messages([chat_message(i, text=t, importance=2 + i) for i, t in enumerate(TEXTS)])
+    assert_consistent()
+    assert stored()[0]["отчет"] == 3
+
+    storage.write(lambda conn: conn.execute("UPDATE messages SET text_content = 'обед отменили' WHERE id = ?", (ids[0],)))
+    assert_consistent()
+    storage.write(lambda conn: conn.execute("UPDATE messages SET importance = 5 WHERE id = ?", (ids[1],)))
+    assert_consistent()
+    storage.write(lambda conn: conn.execute("DELETE FROM messages WHERE id = ?", (ids[3],)))
+    assert_consistent()
+
+
+def test_top_terms_and_examples(db, add_messages):
+    ids = add_messages([chat_message(i, text=t) for i, t in enumerate(TEXTS)])
+    top = with_conn(lambda c: (term_stats.process_queue(c), term_stats.top_terms(c.cursor(), limit=2))[1])
+    assert top[0][:2] == ("отчет", 3)
+    examples = with_conn(lambda c: term_stats.term_message_ids(c.cursor(), "обед", limit=5))
+    assert sorted(examples) == [ids[2], ids[3]]
+    assert "завтра" in with_conn(lambda c: term_stats.related_terms(c.cursor(), "обед", limit=10))
+
+
+def test_analysis_endpoint_uses_stats(client, add_messages):
+    add_messages([chat_message(i, text=t) for i, t in enumerate(TEXTS)])
+    with_conn(term_stats.process_queue)   # в работе очередь разбирает фоновый индексатор
+    response = client.get("/api/analysis")
+    assert response.status_code == 200
+    assert "отчет" in response.get_json()["html"]
+
+
+ANNOUNCEMENT = "Завтра в десять утра в большом зале пройдёт общее собрание сотрудников отдела продаж, явка обязательна"
+
+
+def assert_duplicates_consistent():
+    def read(conn):
+        term_stats.process_queue(conn)
+        near_dups.process_queue(conn)
+        expected = conn.execute("""
+            SELECT p.term, COUNT(*), SUM(p.importance) FROM message_duplicates d
+            JOIN term_postings p ON p.message_id = d.message_id GROUP BY p.term
+        """).fetchall()
+        got = conn.execute("SELECT term, dup_df, dup_importance_sum FROM term_stats WHERE dup_df != 0 "
+                           "OR dup_importance_sum != 0").fetchall()
+        return sorted(map(tuple, expected)), sorted(map(tuple, got))
+    expected, got = with_conn(read)
+    assert got == expected
+    return dict((t, n) for t, n, _ in got)
+
+
+def test_duplicate_counters_follow_near_dups(db, add_messages):
+    ids = add_messages([chat_message(0, chat_id=c, text=ANNOUNCEMENT, importance=2 + c) for c in (1, 2, 3)])
+    assert assert_duplicates_consistent()["собрание"] == 2
+    top = with_conn(lambda c: dict((t, n) for t, n, _ in term_stats.top_terms(c.cursor(), limit=50, collapse=True)))
+    assert top["собрание"] == 1
+
+    storage.write(lambda conn: conn.execute("UPDATE messages SET importance = 5 WHERE id = ?", (ids[2],)))
+    assert_duplicates_consistent()
+    storage.write(lambda conn: conn.execute("UPDATE messages SET text_content = 'обед отменили' WHERE id = ?",
+                                            (ids[1],)))
+    assert assert_duplicates_consistent()["собрание"] == 1
+    # удаление оригинала: первая копия становится каноном и выпадает из дубликатов
+    storage.write(lambda conn: conn.execute("DELETE FROM messages WHERE id = ?", (ids[0],)))
+    assert assert_duplicates_consistent() == {}
+
+
+def test_prune_pairs_drops_rare_pairs(db, add_messages):
+    ids = add_messages([chat_message(i, text=t) for i, t in enumerate(TEXTS)])
+    pairs = stored()[2]
+    assert with_conn(lambda c: term_stats.prune_pairs(c, max_rows=len(pairs))) == 0
+
+    removed = with_conn(lambda c: term_stats.prune_pairs(c, max_rows=len(pairs) - 1))
+    kept = stored()[2]
+    assert removed == sum(1 for n in pairs.values() if n == 1)
+    assert kept == {p: n for p, n in pairs.items() if n > 1}
+    assert "продажи" in with_conn(lambda c: term_stats.related_terms(c.cursor(), "отчет", limit=10))
+
+    # удаление сообщения не уводит оставшиеся счётчики в минус
+    storage.write(lambda conn: conn.execute("DELETE FROM messages WHERE id IN (?, ?)", (ids[0], ids[3])))
+    assert all(n > 0 for n in stored()[2].values())
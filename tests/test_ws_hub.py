@@ -0,0 +1,112 @@
+"""ws_hub: слияние delta-событий, очередь клиента из одной ячейки и версия журнала без слушателей."""
+import asyncio
+
+import ws_hub
+
+
+def message(i, ts=None):
+    return {"id": i, "date_ts": ts if ts is not None else i}
+
+
+def delta(since, version, groups=None, deleted_groups=(), deleted_messages=()):
+    return {
+        "action": "delta", "since": since, "version": version, "reset": False,
+        "groups": [{"group_key": key, "messages": msgs} for key, msgs in (groups or {}).items()],
+        "deleted_groups": list(deleted_groups), "deleted_messages": list(deleted_messages),
+    }
+
+
+def ids(event, key):
+    return [[m["id"] for m in g["messages"]] for g in event["groups"] if g["group_key"] == key]
+
+
+def test_merge_events_coalesces_deltas():
+    a = delta(1, 2, {"group::1": [message(1), message(2)], "group::2": [message(5)]}, deleted_messages=[7])
+    b = delta(2, 3, {"group::1": [message(3), message(2, ts=10)], "group::3": [message(6)]},
+              deleted_groups=["group::2"], deleted_messages=[1])
+    merged = ws_hub.merge_events(a, b)
+
+    assert (merged["action"], merged["since"], merged["version"]) == ("delta", 1, 3)
+    # удалённое в b уходит из сообщений a, более позднее изменение побеждает, порядок — по (date_ts, id)
+    assert ids(merged, "group::1") == [[3, 2]]
+    assert ids(merged, "group::3") == [[6]]
+    assert ids(merged, "group::2") == []
+    assert merged["deleted_groups"] == ["group::2"]
+    assert merged["deleted_messages"] == [1, 7]
+
+    # группа, удалённая в a и снова появившаяся в b, из deleted_groups пропадает
+    revived = ws_hub.merge_events(delta(1, 2, deleted_groups=["group::4"]), delta(2, 3, {"group::4": [message(8)]}))
+    assert revived["deleted_groups"] == [] and ids(revived, "group::4") == [[8]]
+
+    assert ws_hub.merge_events(a, {"action": "resync", "version": 4}) == {"action": "resync", "version": 4}
+    assert ws_hub.merge_events({"action": "resync", "version": 2}, b) == {"action": "resync", "version": 3}
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, payload):
+        self.sent.append(payload)
+
+
+def test_client_keeps_one_pending_event():
+    async def scenario():
+        websocket = FakeWebSocket()
+        client = ws_hub._Client(websocket, max_pending=3)
+        # пока отправитель не запущен, события сливаются в одну ячейку
+        client.push(delta(1, 2, {"group::1": [message(1)]}))
+        client.push(delta(2, 3, {"group::1": [message(2)]}))
+        assert client.pending["since"] == 1 and ids(client.pending, "group::1") == [[1, 2]]
+
+        sender = asyncio.create_task(client.run())
+        await asyncio.sleep(0)
+        assert len(websocket.sent) == 1 and client.pending is None
+
+        # больше max_pending сообщений — вместо delta клиент получает resync
+        client.push(delta(3, 4, {"group::1": [message(i) for i in range(3, 6)]}, deleted_messages=[1]))
+        assert client.pending == {"action": "resync", "version": 4}
+        client.push(delta(4, 5, {"group::1": [message(6)]}))
+        assert client.pending == {"action": "resync", "version": 5}
+        await asyncio.sleep(0)
+        sender.cancel()
+        return websocket.sent
+
+    sent = asyncio.run(scenario())
+    assert len(sent) == 2 and '"resync"' in sent[1]
+
+
+def test_version_moves_without_clients():
+    calls = []
+    journal = {"version": 1}
+
+    def load_changes(since):
+        calls.append(since)
+        version = journal["version"]
+        if since is None or since == version:
+            return version, None
+        return version, delta(since, version, {"group::1": [message(version)]})
+
+    async def scenario():
+        hub = ws_hub.ChangeHub(load_changes, poll_interval=0.01)
+        hub._wakeup = asyncio.Event()
+        poller = asyncio.create_task(hub._poll_forever())
+        await asyncio.sleep(0.05)
+        assert hub.version == 1
+
+        # запись без слушателей: версия сдвигается, delta не читается
+        journal["version"] = 2
+        await asyncio.sleep(0.05)
+        assert hub.version == 2 and set(calls) == {None}
+
+        websocket = FakeWebSocket()
+        client = ws_hub._Client(websocket, max_pending=10)
+        hub.clients.add(client)
+        journal["version"] = 3
+        await asyncio.sleep(0.05)
+        poller.cancel()
+        return client.pending
+
+    pending = asyncio.run(scenario())
+    # подключившийся клиент получает изменения после версии, известной до его подключения
+    assert pending["since"] == 2 and pending["version"] == 3
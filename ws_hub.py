@@ -0,0 +1,160 @@
+"""
+WebSocket-хаб: рассылка изменений переписок подключённым клиентам.
+
+Источник изменений — таблица message_changes, которую заполняют триггеры БД при
+записи из любого процесса (веб, email_reader, tg.py). Хаб опрашивает её из
+собственного event loop раз в poll_interval (или сразу после poke() из веб-процесса)
+и раздаёт клиентам delta-события в том же формате, что /api/grouped_messages?since=.
+
+У каждого клиента одна ячейка ожидания: пока предыдущее сообщение отправляется,
+новые события сливаются в одно; если накопилось больше max_pending сообщений,
+клиент получает {"action": "resync"} и догружает изменения по HTTP.
+"""
+import asyncio
+import json
+import threading
+import time
+
+import websockets
+
+import metrics
+
+CLIENTS = metrics.gauge("websocket_clients", "Подключённые WebSocket-клиенты")
+EVENTS = metrics.counter("websocket_events_total", "События из журнала изменений, разосланные клиентам", ("action",))
+FANOUT_SECONDS = metrics.histogram("websocket_broadcast_seconds", "Время раздачи события по очередям всех клиентов")
+SEND_SECONDS = metrics.histogram("websocket_send_seconds", "Время отправки сообщения одному клиенту")
+SEND_BYTES = metrics.histogram("websocket_message_bytes", "Размер отправленного сообщения", buckets=metrics.SIZE_BUCKETS)
+
+
+def merge_events(a, b):
+    """Сливает два последовательных события в одно (b — более позднее)."""
+    if a['action'] != 'delta' or b['action'] != 'delta':
+        return {"action": "resync", "version": b['version']}
+
+    removed = set(b['deleted_messages'])
+    groups = {}
+    for g in a['groups']:
+        groups[g['group_key']] = dict(g, messages=[m for m in g['messages'] if m['id'] not in removed])
+    for g in b['groups']:
+        prev = groups.get(g['group_key'])
+        if prev:
+            by_id = {m['id']: m for m in prev['messages']}
+            by_id.update((m['id'], m) for m in g['messages'])
+            g = dict(g, messages=sorted(by_id.values(), key=lambda m: (m['date_ts'] or 0, m['id'])))
+        groups[g['group_key']] = g
+    for key in b['deleted_groups']:
+        groups.pop(key, None)
+
+    return {
+        "action": "delta",
+        "since": a['since'],
+        "version": b['version'],
+        "reset": False,
+        "groups": list(groups.values()),
+        "deleted_groups": sorted((set(a['deleted_groups']) - set(groups)) | set(b['deleted_groups'])),
+        "deleted_messages": sorted(set(a['deleted_messages']) | removed),
+    }
+
+
+def event_size(event):
+    if event['action'] != 'delta':
+        return 0
+    return sum(len(g['messages']) for g in event['groups']) + len(event['deleted_messages'])
+
+
+class _Client:
+    def __init__(self, websocket, max_pending):
+        self.websocket = websocket
+        self.max_pending = max_pending
+        self.pending = None
+        self.wakeup = asyncio.Event()
+
+    def push(self, event):
+        if self.pending is not None:
+            event = merge_events(self.pending, event)
+        if event_size(event) > self.max_pending:
+            event = {"action": "resync", "version": event['version']}
+        self.pending = event
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            event, self.pending = self.pending, None
+            if event is not None:
+                payload = json.dumps(event, ensure_ascii=False)
+                started = time.perf_counter()
+                await self.websocket.send(payload)
+                SEND_SECONDS.observe(time.perf_counter() - started)
+                SEND_BYTES.observe(len(payload))
+
+
+class ChangeHub:
+    def __init__(self, load_changes, poll_interval=0.5, max_pending=500):
+        """
+        load_changes(since) -> (version, event | None) — читает журнал изменений после since
+        (выполняется в пуле потоков, не в event loop); при since=None только текущая версия.
+        """
+        self.load_changes = load_changes
+        self.poll_interval = poll_interval
+        self.max_pending = max_pending
+        self.clients = set()
+        self.version = None
+        self.loop = None
+        self._wakeup = None
+
+    def start(self, host, port):
+        """Запускает сервер и опрос журнала в отдельном потоке со своим event loop."""
+        thread = threading.Thread(target=lambda: asyncio.run(self._serve(host, port)), name="ws-hub", daemon=True)
+        thread.start()
+        return thread
+
+    def poke(self):
+        """Потокобезопасно: проверить журнал изменений сейчас, не дожидаясь опроса."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _serve(self, host, port):
+        self.loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        async with websockets.serve(self._handle, host, port):
+            print(f"WebSocket запущен на {host}:{port}")
+            await self._poll_forever()
+
+    async def _handle(self, websocket, path=None):
+        client = _Client(websocket, self.max_pending)
+        self.clients.add(client)
+        CLIENTS.set(len(self.clients))
+        sender = asyncio.create_task(client.run())
+        try:
+            await websocket.wait_closed()
+        finally:
+            self.clients.discard(client)
+            CLIENTS.set(len(self.clients))
+            sender.cancel()
+
+    async def _poll_forever(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            # без слушателей только сдвигаем версию (since=None — без чтения delta): клиент,
+            # подключившийся между опросами, получит всё, что записано после его HTTP-синхронизации
+            since = self.version if self.clients else None
+            try:
+                self.version, event = await asyncio.to_thread(self.load_changes, since)
+            except Exception as e:
+                print(f"Ошибка чтения журнала изменений: {e}")
+                continue
+            if event is not None:
+                self.broadcast(event)
+
+    def broadcast(self, event):
+        started = time.perf_counter()
+        for client in list(self.clients):
+            client.push(event)
+        FANOUT_SECONDS.observe(time.perf_counter() - started)
+        EVENTS.inc(action=event['action'])